@@ -0,0 +1,67 @@
+"""割り当てが済んだbatchが大量にある長寿命のSKUについて、アーカイブの前後でProductの読み込み時間を比較する.
+
+実行: python -m benchmarks.bench_archival
+"""
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters import archive, orm, repository
+from src.allocation.domain import model
+
+N_EXHAUSTED = 1_000
+N_ACTIVE = 10
+LINES_PER_BATCH = 5
+N_LOADS = 5
+
+
+def seed(session_factory) -> None:
+    batches = []
+    for b in range(N_EXHAUSTED + N_ACTIVE):
+        batch = model.Batch(f"batch{b}", "OLD-SKU", LINES_PER_BATCH * 2, None)
+        n_lines = LINES_PER_BATCH * 2 if b < N_EXHAUSTED else LINES_PER_BATCH
+        for o in range(n_lines):
+            batch.allocate(model.OrderLine(f"order{b}-{o}", "OLD-SKU", 1))
+        batches.append(batch)
+    session = session_factory()
+    session.add(model.Product("OLD-SKU", batches))
+    session.commit()
+    session.close()
+
+
+def time_loads(session_factory) -> float:
+    timings = []
+    for _ in range(N_LOADS):
+        session = session_factory()
+        start = time.perf_counter()
+        product = repository.SqlAlchemyRepository(session).get("OLD-SKU")
+        product.allocate(model.OrderLine("probe", "OLD-SKU", 1))  # 全batchの走査と割り当ての読み込みまで含める.
+        timings.append(time.perf_counter() - start)
+        session.rollback()
+        session.close()
+    return statistics.median(timings) * 1000
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.db'}")
+        orm.metadata.create_all(engine)
+        orm.start_mappers()
+        try:
+            session_factory = sessionmaker(bind=engine)
+            seed(session_factory)
+            print(f"before compaction: load+allocate p50={time_loads(session_factory):8.2f}ms")
+            start = time.perf_counter()
+            archived = archive.compact(session_factory)
+            print(f"compaction: archived {archived} batches in {time.perf_counter() - start:.2f}s")
+            print(f"after compaction:  load+allocate p50={time_loads(session_factory):8.2f}ms")
+        finally:
+            clear_mappers()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""broker consumerのスループット(messages/s)を、1回に読む件数(batch_size)を変えて比較する.
+
+InMemoryBrokerとSQLiteを使うので、Redis・Postgresは不要.
+実行: python -m benchmarks.bench_broker_consumer
+"""
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters import broker, orm
+from src.allocation.domain import events
+from src.allocation.entrypoints.broker_consumer import BrokerConsumer
+from src.allocation.service_layer import unit_of_work
+
+N_SKUS = 50
+N_ALLOCATIONS = 5_000
+
+
+def run(db_path: Path, batch_size: int) -> None:
+    engine = create_engine(f"sqlite:///{db_path}")
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    try:
+        session_factory = sessionmaker(bind=engine)
+        message_broker = broker.InMemoryBroker()
+        broker.DEFAULT_PUBLISHER = message_broker
+        for s in range(N_SKUS):
+            message_broker.publish(broker.INBOUND_STREAM, events.BatchCreated(f"batch{s}", f"sku{s}", 10**6))
+        for i in range(N_ALLOCATIONS):
+            message_broker.publish(broker.INBOUND_STREAM, events.AllocationRequired(f"o{i}", f"sku{i % N_SKUS}", 1))
+        consumer = BrokerConsumer(
+            message_broker,
+            lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+            consumer="bench",
+            batch_size=batch_size,
+            block_ms=0,
+        )
+
+        total = N_SKUS + N_ALLOCATIONS
+        start = time.perf_counter()
+        processed = 0
+        while processed < total:
+            processed += consumer.run_once()
+        elapsed = time.perf_counter() - start
+        published = len(message_broker.events(broker.OUTBOUND_STREAM))
+        print(f"batch_size={batch_size:>4} {total / elapsed:10,.0f} messages/s published={published}")
+    finally:
+        broker.DEFAULT_PUBLISHER = None
+        clear_mappers()
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        for batch_size in (1, 10, 100, 500):
+            run(Path(tmp) / f"bench{batch_size}.db", batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Flaskアプリのimport時間と起動時間(import + 最初のリクエスト)を計測し、閾値を超えたら失敗する.
+
+import時間は `python -X importtime` の出力から、対象モジュールの累積時間を取り出す.
+各計測は新しいプロセスで行い、中央値を使う.
+
+実行: python -m benchmarks.bench_cold_start [--import-threshold-ms 700] [--boot-threshold-ms 1500]
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TARGET = "src.allocation.entrypoints.flask_app"
+BOOT_SCRIPT = f"""
+import {TARGET} as flask_app
+client = flask_app.app.test_client()
+assert client.get("/metrics/admission").status_code == 200
+"""
+HEAVY_MODULES = ("hypothesis", "numpy", "psycopg2")
+
+
+def import_time_ms() -> float:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {TARGET}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)$", line)
+        if match and match.group(2) == TARGET:
+            return int(match.group(1)) / 1000
+    raise RuntimeError(f"{TARGET} not found in importtime output")
+
+
+def boot_time_ms() -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", BOOT_SCRIPT], cwd=ROOT, check=True, capture_output=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def heavy_modules_loaded() -> list:
+    script = f"import sys, {TARGET}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+    return [m for m in result.stdout.strip().split(",") if m]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--import-threshold-ms", type=float, default=700)
+    parser.add_argument("--boot-threshold-ms", type=float, default=1500)
+    args = parser.parse_args()
+
+    import_ms = statistics.median(import_time_ms() for _ in range(args.runs))
+    boot_ms = statistics.median(boot_time_ms() for _ in range(args.runs))
+    heavy = heavy_modules_loaded()
+    print(f"import={import_ms:7.1f}ms (threshold {args.import_threshold_ms:.0f}ms)")
+    print(f"boot  ={boot_ms:7.1f}ms (threshold {args.boot_threshold_ms:.0f}ms)")
+    print(f"heavy modules loaded at import: {heavy or 'none'}")
+
+    failures = []
+    if import_ms > args.import_threshold_ms:
+        failures.append("import time regressed")
+    if boot_ms > args.boot_threshold_ms:
+        failures.append("boot time regressed")
+    if heavy:
+        failures.append(f"heavy modules imported eagerly: {heavy}")
+    if failures:
+        sys.exit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""EventStoreRepository と SqlAlchemyRepository(SQLite) の Product 読み込みレイテンシを比較する.
+
+実行: python -m benchmarks.bench_event_store
+"""
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters import orm, repository
+from src.allocation.adapters.event_store import EventStore
+from src.allocation.domain import model
+
+N_SKUS = 50
+N_BATCHES = 20
+N_LINES_PER_BATCH = 20
+N_LOADS = 200
+
+
+def make_product(sku: str) -> model.Product:
+    batches = []
+    for b in range(N_BATCHES):
+        batch = model.Batch(f"{sku}-batch{b}", sku, 1000, date(2021, 1, 1) + timedelta(days=b))
+        for o in range(N_LINES_PER_BATCH):
+            batch.allocate(model.OrderLine(f"{sku}-order{b}-{o}", sku, 1))
+        batches.append(batch)
+    return model.Product(sku, batches)
+
+
+def time_loads(load) -> list:
+    timings = []
+    for i in range(N_LOADS):
+        sku = f"sku{i % N_SKUS}"
+        start = time.perf_counter()
+        product = load(sku)
+        timings.append(time.perf_counter() - start)
+        assert product.sku == sku
+    return timings
+
+
+def bench_sqlalchemy(db_path: Path) -> list:
+    engine = create_engine(f"sqlite:///{db_path}")
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    try:
+        session_factory = sessionmaker(bind=engine)
+        session = session_factory()
+        repo = repository.SqlAlchemyRepository(session)
+        for s in range(N_SKUS):
+            repo.add(make_product(f"sku{s}"))
+        session.commit()
+        session.close()
+
+        def load(sku):
+            session = session_factory()
+            try:
+                product = repository.SqlAlchemyRepository(session).get(sku)
+                for batch in product.batches:
+                    batch.available_quantity  # allocationsのlazy loadまで含めて計測する.
+                return product
+            finally:
+                session.close()
+
+        return time_loads(load)
+    finally:
+        clear_mappers()
+
+
+def bench_event_store(root: Path, snapshot_interval: int) -> list:
+    store = EventStore(root, snapshot_interval=snapshot_interval)
+    for s in range(N_SKUS):
+        repo = repository.EventStoreRepository(store)
+        repo.add(make_product(f"sku{s}"))
+        repo.save_changes()
+    return time_loads(lambda sku: repository.EventStoreRepository(EventStore(root)).get(sku))
+
+
+def report(name: str, timings: list) -> None:
+    timings = sorted(timings)
+    p50 = statistics.median(timings) * 1000
+    p99 = timings[int(len(timings) * 0.99) - 1] * 1000
+    print(f"{name:<32} p50={p50:8.3f}ms p99={p99:8.3f}ms")
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path = Path(tmp)
+        report("SqlAlchemyRepository(sqlite)", bench_sqlalchemy(tmp_path / "bench.db"))
+        report("EventStoreRepository(replay)", bench_event_store(tmp_path / "replay", snapshot_interval=10**9))
+        report("EventStoreRepository(snapshot)", bench_event_store(tmp_path / "snapshot", snapshot_interval=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""1つのhot SKUに対する同時クライアント数を増やした時のスループットを、group commitの有無で比較する.
+
+トランザクションのモデル(所要時間・optimistic lockingの衝突)は `load_admission` と同じ.
+
+実行: python -m benchmarks.bench_group_commit
+"""
+import threading
+import time
+
+from benchmarks.load_admission import HotProduct
+from src.allocation.service_layer import group_commit
+
+REQUESTS_PER_CLIENT = 20
+
+
+def run(n_clients: int, use_group_commit: bool) -> None:
+    product = HotProduct()
+    committer = group_commit.GroupCommitter(product.run_batch, window=0.001)
+
+    def client(client_id: int) -> None:
+        for i in range(REQUESTS_PER_CLIENT):
+            item = client_id * REQUESTS_PER_CLIENT + i
+            if use_group_commit:
+                committer.submit("HOT-SKU", item)
+            else:
+                product.run_batch([item])
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(n_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    total = n_clients * REQUESTS_PER_CLIENT
+    name = "group commit" if use_group_commit else "one tx per request"
+    print(
+        f"{name:<20} clients={n_clients:>3} throughput={total / elapsed:8.1f}/s "
+        f"commits={product.commits:>5} conflicts={product.conflicts:>6}"
+    )
+
+
+def main() -> None:
+    for n_clients in (1, 8, 32, 64):
+        run(n_clients, use_group_commit=False)
+        run(n_clients, use_group_commit=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""InMemoryUnitOfWorkでの割り当てのスループットを計測する.
+
+1件毎にUoWを使う場合、同じSKUの32件を1つのUoWで処理する場合(allocate_many)、
+messagebus(read modelの更新等の後続handlerを含む)を経由する場合を比べる.
+実行: python -m benchmarks.bench_in_memory
+"""
+import time
+
+from src.allocation.adapters.repository import InMemoryStore
+from src.allocation.domain import events, model
+from src.allocation.service_layer import handler, messagebus, unit_of_work
+
+N_SKUS = 1_000
+N_BATCHES = 3
+N_ALLOCATIONS = 200_000
+
+
+def make_store() -> InMemoryStore:
+    return InMemoryStore(
+        model.Product(f"sku{s}", [model.Batch(f"sku{s}-b{b}", f"sku{s}", 10**6, None) for b in range(N_BATCHES)])
+        for s in range(N_SKUS)
+    )
+
+
+def run(name: str, allocate, n: int, per_uow: int = 1) -> None:
+    uow = unit_of_work.InMemoryUnitOfWork(make_store())
+    batches = [
+        [events.AllocationRequired(f"order{i + j}", f"sku{i // per_uow % N_SKUS}", 1) for j in range(per_uow)]
+        for i in range(0, n, per_uow)
+    ]
+    start = time.perf_counter()
+    for batch in batches:
+        allocate(batch if per_uow > 1 else batch[0], uow)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<16} {n / elapsed:>10,.0f} allocations/s")
+
+
+def main() -> None:
+    run("handler", handler.allocate, N_ALLOCATIONS)
+    run("allocate_many", handler.allocate_many, N_ALLOCATIONS, per_uow=32)
+    run("messagebus", messagebus.handle, N_ALLOCATIONS // 4)
+
+
+if __name__ == "__main__":
+    main()
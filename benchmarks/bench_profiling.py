@@ -0,0 +1,39 @@
+"""profilingの有効・無効での、messagebus経由の割り当てのスループットを比べる.
+
+無効時は`trace`/`span`が共有の何もしないcontext managerを返すだけである事を確認する.
+実行: python -m benchmarks.bench_profiling
+"""
+import time
+
+from src.allocation.adapters.repository import InMemoryStore
+from src.allocation.domain import events, model
+from src.allocation.service_layer import messagebus, profiling, unit_of_work
+
+N_SKUS = 100
+N_ALLOCATIONS = 50_000
+
+
+def run(name: str) -> None:
+    store = InMemoryStore(
+        model.Product(f"sku{s}", [model.Batch(f"sku{s}-b0", f"sku{s}", 10**6, None)]) for s in range(N_SKUS)
+    )
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    requests = [events.AllocationRequired(f"order{i}", f"sku{i % N_SKUS}", 1) for i in range(N_ALLOCATIONS)]
+    start = time.perf_counter()
+    for event in requests:
+        messagebus.handle(event, uow)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {N_ALLOCATIONS / elapsed:>10,.0f} allocations/s")
+
+
+def main() -> None:
+    run("disabled")
+    profiling.enable(profiling.Profiler(sample_rate=0.01))
+    run("enabled (1% of traces)")
+    profiling.enable(profiling.Profiler())
+    run("enabled (all traces)")
+    profiling.disable()
+
+
+if __name__ == "__main__":
+    main()
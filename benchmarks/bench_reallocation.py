@@ -0,0 +1,90 @@
+"""batch数量を大きく減らした時の、再割り当てで発生するevent数・commit数・処理時間を比較する.
+
+- legacy: 任意のラインを1本ずつ外し、AllocationRequiredをラインごとにmessagebusへ流す(従来の挙動)
+- current: 外すラインを最少本数になる様に選び、集約内で一度に再割り当てする
+
+実行: python -m benchmarks.bench_reallocation
+"""
+import random
+import time
+from datetime import date
+from typing import Dict, List
+
+from src.allocation.adapters import repository
+from src.allocation.domain import events, model
+from src.allocation.service_layer import messagebus, unit_of_work
+
+N_LINES = 2000
+
+
+class LegacyProduct(model.Product):
+    def change_batch_quantity(self, ref: str, qty: int):
+        batch = next(b for b in self.batches if b.reference == ref)
+        batch._purchased_quantity = qty
+        while batch.available_quantity < 0:
+            line = batch.deallocate_one()
+            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty, batch.reference))
+            self.events.append(events.AllocationRequired(line.orderid, line.sku, line.qty))
+
+
+class DictRepository(repository.AbstractRepository):
+    def __init__(self, products: List[model.Product]) -> None:
+        super().__init__()
+        self._products: Dict[str, model.Product] = {p.sku: p for p in products}
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku):
+        return self._products.get(sku)
+
+    def _get_by_batchref(self, batchref):
+        return next((p for p in self._products.values() for b in p.batches if b.reference == batchref), None)
+
+
+class CountingUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    def __init__(self, product: model.Product) -> None:
+        self.products = DictRepository([product])
+        self.commits = 0
+        self.events = 0
+
+    def collect_new_events(self):
+        for event in super().collect_new_events():
+            self.events += 1
+            yield event
+
+    def _commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+def make_product(cls, seed: int = 0) -> model.Product:
+    rng = random.Random(seed)
+    qtys = [rng.randint(1, 20) for _ in range(N_LINES)]
+    shrinking = model.Batch("shrinking", "SKU", sum(qtys), eta=None)
+    spare = model.Batch("spare", "SKU", sum(qtys), eta=date(2030, 1, 1))
+    for i, qty in enumerate(qtys):
+        shrinking.allocate(model.OrderLine(f"order{i}", "SKU", qty))
+    return cls("SKU", [shrinking, spare])
+
+
+def run(cls, shrink_to_ratio: float) -> None:
+    product = make_product(cls)
+    uow = CountingUnitOfWork(product)
+    new_qty = int(product.batches[0]._purchased_quantity * shrink_to_ratio)
+    start = time.perf_counter()
+    messagebus.handle(events.BatchQuantityChanged("shrinking", new_qty), uow)
+    elapsed = time.perf_counter() - start
+    print(f"{cls.__name__:<14} shrink_to={shrink_to_ratio:.0%} events={uow.events:>6} commits={uow.commits:>5} time={elapsed * 1000:8.1f}ms")
+
+
+def main() -> None:
+    for ratio in (0.9, 0.5, 0.1):
+        run(LegacyProduct, ratio)
+        run(model.Product, ratio)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""eventのバイナリ形式とJSONの、エンコード・デコードの速度とサイズを比較する.
+
+実行: python -m benchmarks.bench_serialization
+"""
+import time
+from datetime import date, timedelta
+
+from src.allocation.adapters import serialization
+from src.allocation.domain import events
+
+N_EVENTS = 200_000
+
+
+def make_events() -> list:
+    history = []
+    for i in range(N_EVENTS // 4):
+        sku = f"SKU-{i % 500}"
+        history.append(events.BatchCreated(f"batch-{i}", sku, 100, date(2021, 1, 1) + timedelta(days=i % 30)))
+        history.append(events.AllocationRequired(f"order-{i}", sku, 3))
+        history.append(events.Allocated(f"order-{i}", sku, 3, f"batch-{i}"))
+        history.append(events.BatchQuantityChanged(f"batch-{i}", 90))
+    return history
+
+
+def measure(name: str, encode, decode_all, history: list) -> None:
+    start = time.perf_counter()
+    encoded = encode(history)
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = decode_all(encoded)
+    decode_seconds = time.perf_counter() - start
+    assert decoded == history
+    size = len(encoded) if isinstance(encoded, bytes) else sum(len(e) for e in encoded)
+    print(
+        f"{name:<8} encode={len(history) / encode_seconds:>12,.0f} events/s "
+        f"decode={len(history) / decode_seconds:>12,.0f} events/s "
+        f"size={size / len(history):6.1f} bytes/event"
+    )
+
+
+def main() -> None:
+    history = make_events()
+    measure(
+        "binary",
+        serialization.encode_many,
+        lambda data: list(serialization.iter_decode(memoryview(data))),
+        history,
+    )
+    measure(
+        "json",
+        lambda batch: [serialization.to_json(e).encode() for e in batch],
+        lambda lines: [serialization.from_json(line) for line in lines],
+        history,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""replayエンジンのスループット(events/min)を計測する. 目標は1プロセスあたり1M events/min.
+
+実行: python -m benchmarks.bench_simulation [n_events] [processes]
+"""
+import random
+import sys
+import time
+from datetime import date, timedelta
+from typing import List
+
+from src.allocation.domain import events
+from src.allocation.service_layer import simulation
+
+TARGET_EVENTS_PER_MINUTE = 1_000_000
+
+
+def make_history(n_events: int, n_skus: int = 2000, seed: int = 0) -> List[events.Event]:
+    rng = random.Random(seed)
+    history: List[events.Event] = []
+    refs: List[str] = []
+    for s in range(n_skus):
+        for b in range(4):
+            ref = f"sku{s}-batch{b}"
+            eta = None if b == 0 else date(2021, 1, 1) + timedelta(days=rng.randint(0, 60))
+            history.append(events.BatchCreated(ref, f"sku{s}", rng.randint(500, 2000), eta))
+            refs.append(ref)
+    while len(history) < n_events:
+        if rng.random() < 0.01:
+            history.append(events.BatchQuantityChanged(rng.choice(refs), rng.randint(100, 1000)))
+        else:
+            sku = f"sku{rng.randrange(n_skus)}"
+            history.append(events.AllocationRequired(f"order{len(history)}", sku, rng.randint(1, 10)))
+    return history
+
+
+def main() -> None:
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    history = make_history(n_events)
+    start = time.perf_counter()
+    report = simulation.simulate(history, processes=processes)
+    elapsed = time.perf_counter() - start
+    rate = report.events_replayed / elapsed * 60
+    print(f"replayed {report.events_replayed} events in {elapsed:.2f}s ({rate:,.0f} events/min, processes={processes})")
+    print(f"fill_rate={report.fill_rate:.3f} out_of_stock={report.out_of_stock} reallocations={report.reallocations}")
+    if rate < TARGET_EVENTS_PER_MINUTE:
+        sys.exit(f"below target of {TARGET_EVENTS_PER_MINUTE:,} events/min")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""1つのhot SKUにリクエストが集中した時の、admission controlの有無による挙動を比較する負荷試験.
+
+1回のトランザクションは `TX_SECONDS` かかり、その間に他のトランザクションがcommitすると
+optimistic lockingの衝突としてやり直しになる(version_numberの取り合いを模したもの).
+
+実行: python -m benchmarks.load_admission [n_clients] [requests_per_client]
+"""
+import statistics
+import sys
+import threading
+import time
+from typing import List
+
+from src.allocation.service_layer import admission
+
+TX_SECONDS = 0.002
+
+
+class HotProduct:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.version = 0
+        self.commits = 0
+        self.conflicts = 0
+
+    def run_batch(self, batch: List[int]) -> List[str]:
+        while True:
+            with self.lock:
+                seen = self.version
+            time.sleep(TX_SECONDS)
+            with self.lock:
+                if self.version == seen:
+                    self.version += 1
+                    self.commits += 1
+                    return ["batch1"] * len(batch)
+                self.conflicts += 1
+
+
+def run(name: str, controller: admission.AdmissionController, n_clients: int, per_client: int) -> None:
+    product = HotProduct()
+    latencies: List[float] = []
+    rejected = [0]
+    lock = threading.Lock()
+
+    def client(client_id: int) -> None:
+        for i in range(per_client):
+            start = time.perf_counter()
+            try:
+                controller.submit("HOT-SKU", client_id * per_client + i, product.run_batch)
+            except admission.Overloaded:
+                with lock:
+                    rejected[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(n_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else float("nan")
+    metrics = controller.metrics()
+    print(
+        f"{name:<22} ok={len(latencies):>5} rejected={rejected[0]:>5} throughput={len(latencies) / elapsed:8.1f}/s "
+        f"p50={statistics.median(latencies) * 1000:7.1f}ms p99={p99:7.1f}ms "
+        f"commits={product.commits:>5} conflicts={product.conflicts:>6} max_queue={metrics.max_queue_depth}"
+    )
+
+
+def main() -> None:
+    n_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    run("unbounded", admission.AdmissionController(max_in_flight=n_clients, max_queue=n_clients), n_clients, per_client)
+    run("admission", admission.AdmissionController(max_in_flight=1, max_queue=16), n_clients, per_client)
+    run("admission+coalesce", admission.AdmissionController(max_in_flight=1, max_queue=32, coalesce=True), n_clients, per_client)
+
+
+if __name__ == "__main__":
+    main()
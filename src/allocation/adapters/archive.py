@@ -0,0 +1,154 @@
+"""割り当てが済んだ(利用可能数が0の)batchのアーカイブ.
+
+長く使われるSKUではbatchが増え続け、Productを読み込む度に全てのbatchとその割り当てが読み込まれる.
+`compact` は利用可能数が0になったbatchを、割り当て・オーダーラインごとarchive用のテーブルへ移し、
+集約の読み込み・`Product.allocate` の走査を、在庫の残っているbatchだけに抑える.
+
+- 1チャンク(`chunk_size`件のbatch)毎に1トランザクションでcommitするので、長いロックは取らない.
+- 移動するbatchのProductはversion_numberを進め、移動前に読み込まれた集約のcommitを衝突させる.
+- アーカイブ後にそのbatchの数量が変更された場合は、repositoryが `restore_batch` で元のテーブルへ戻してから読み込む.
+- アーカイブされたラインは集約から見えなくなるので、リトライ対策の確認(handler.allocate等)は
+  `archived_allocations` でアーカイブ済みの(orderid, sku, qty)も確認する.
+"""
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import func, literal, select
+from sqlalchemy.orm.session import Session
+
+from src.allocation.adapters import orm
+
+
+def exhausted_batch_ids(
+    session: Session, after_id: int = 0, limit: int = 500, among: Optional[Sequence[int]] = None
+) -> List[int]:
+    """idがafter_idより大きく、利用可能数が0以下のbatchのidを、idの順に最大limit件返す.
+    amongが渡されれば、その中から選ぶ."""
+    b, a, l = orm.batches, orm.allocations, orm.order_lines
+    query = (
+        select(b.c.id)
+        .select_from(b.outerjoin(a, a.c.batch_id == b.c.id).outerjoin(l, l.c.id == a.c.orderline_id))
+        .where(b.c.id > after_id)
+        .group_by(b.c.id, b.c._purchased_quantity)
+        .having(b.c._purchased_quantity - func.coalesce(func.sum(l.c.qty), 0) <= 0)
+        .order_by(b.c.id)
+        .limit(limit)
+    )
+    if among is not None:
+        query = query.where(b.c.id.in_(among))
+    return list(session.execute(query).scalars())
+
+
+def archive_batches(session: Session, batch_ids: List[int], archived_at: float) -> List[int]:
+    """batchとその割り当て・オーダーラインをarchive用のテーブルへ移し、移したbatchのidを返す. commitは呼び出し側で行う.
+    選んでから移すまでの間に数量の変更等で在庫が戻ったbatchは移さない様に、batchの行をロックしてから
+    利用可能数が0である事を確認し直す(SQLiteはデータベース全体の書き込みロックで同じ事になる)."""
+    b, a, l = orm.batches, orm.allocations, orm.order_lines
+    session.execute(select(b.c.id).where(b.c.id.in_(batch_ids)).with_for_update()).all()
+    batch_ids = exhausted_batch_ids(session, limit=len(batch_ids), among=batch_ids)
+    if not batch_ids:
+        return []
+    skus = session.execute(select(b.c.sku).where(b.c.id.in_(batch_ids)).distinct()).scalars().all()
+    session.execute(
+        orm.products.update()
+        .where(orm.products.c.sku.in_(skus))
+        .values(version_number=orm.products.c.version_number + 1)
+    )
+    line_ids = select(a.c.orderline_id).where(a.c.batch_id.in_(batch_ids))
+
+    session.execute(
+        orm.archived_batches.insert().from_select(
+            ["id", "reference", "sku", "_purchased_quantity", "eta", "archived_at"],
+            select(b.c.id, b.c.reference, b.c.sku, b.c._purchased_quantity, b.c.eta, literal(archived_at)).where(
+                b.c.id.in_(batch_ids)
+            ),
+        )
+    )
+    session.execute(
+        orm.archived_order_lines.insert().from_select(
+            ["id", "sku", "qty", "orderid"],
+            select(l.c.id, l.c.sku, l.c.qty, l.c.orderid).where(l.c.id.in_(line_ids)),
+        )
+    )
+    session.execute(
+        orm.archived_allocations.insert().from_select(
+            ["id", "orderline_id", "batch_id"],
+            select(a.c.id, a.c.orderline_id, a.c.batch_id).where(a.c.batch_id.in_(batch_ids)),
+        )
+    )
+    archived_line_ids = session.execute(line_ids).scalars().all()
+    session.execute(a.delete().where(a.c.batch_id.in_(batch_ids)))
+    session.execute(l.delete().where(l.c.id.in_(archived_line_ids)))
+    session.execute(b.delete().where(b.c.id.in_(batch_ids)))
+    return batch_ids
+
+
+def is_archived(session: Session, sku: str, reference: str) -> bool:
+    """skuのbatchのうち、referenceのbatchがアーカイブ済みか."""
+    b = orm.archived_batches
+    query = select(b.c.id).where(b.c.reference == reference, b.c.sku == sku).limit(1)
+    return session.execute(query).first() is not None
+
+
+def archived_allocations(session: Session, orderid: str, sku: str) -> List[Tuple[str, int]]:
+    """アーカイブ済みのbatchに割り当てられた、orderid・skuのラインの(batchref, 数量)のリストを返す."""
+    b, a, l = orm.archived_batches, orm.archived_allocations, orm.archived_order_lines
+    query = (
+        select(b.c.reference, l.c.qty)
+        .select_from(l.join(a, a.c.orderline_id == l.c.id).join(b, b.c.id == a.c.batch_id))
+        .where(l.c.orderid == orderid, l.c.sku == sku)
+        .order_by(b.c.id)
+    )
+    return [(row.reference, row.qty) for row in session.execute(query)]
+
+
+def compact(
+    session_factory: Callable[[], Session],
+    chunk_size: int = 500,
+    clock: Callable[[], float] = time.time,
+) -> int:
+    """利用可能数が0のbatchを全てアーカイブし、移したbatchの数を返す."""
+    archived, after_id = 0, 0
+    while True:
+        session = session_factory()
+        try:
+            batch_ids = exhausted_batch_ids(session, after_id, chunk_size)
+            if not batch_ids:
+                return archived
+            moved = archive_batches(session, batch_ids, clock())
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        archived += len(moved)
+        after_id = batch_ids[-1]
+
+
+def restore_batch(session: Session, reference: str) -> bool:
+    """アーカイブされたbatchを元のテーブルへ戻す. idは新しく振り直す. 該当するbatchが無ければFalseを返す."""
+    row = session.execute(select(orm.archived_batches).where(orm.archived_batches.c.reference == reference)).first()
+    if row is None:
+        return False
+    batch_id = session.execute(
+        orm.batches.insert().values(
+            reference=row.reference, sku=row.sku, _purchased_quantity=row._purchased_quantity, eta=row.eta
+        )
+    ).inserted_primary_key[0]
+    allocations = session.execute(
+        select(orm.archived_allocations).where(orm.archived_allocations.c.batch_id == row.id)
+    ).all()
+    for allocation in allocations:
+        line = session.execute(
+            select(orm.archived_order_lines).where(orm.archived_order_lines.c.id == allocation.orderline_id)
+        ).one()
+        line_id = session.execute(
+            orm.order_lines.insert().values(sku=line.sku, qty=line.qty, orderid=line.orderid)
+        ).inserted_primary_key[0]
+        session.execute(orm.allocations.insert().values(orderline_id=line_id, batch_id=batch_id))
+    line_ids = [a.orderline_id for a in allocations]
+    session.execute(orm.archived_allocations.delete().where(orm.archived_allocations.c.batch_id == row.id))
+    session.execute(orm.archived_order_lines.delete().where(orm.archived_order_lines.c.id.in_(line_ids)))
+    session.execute(orm.archived_batches.delete().where(orm.archived_batches.c.id == row.id))
+    return True
@@ -0,0 +1,193 @@
+"""Redis streams形式のmessage broker.
+
+eventは`serialization`のバイナリ形式で、streamのエントリの`event` fieldに入れる.
+consumer groupで読んだメッセージはackされるまでpending(処理中)として残り、
+同じconsumerが`pending=True`で読み直すと再配送される. 配送の回数はbroker側で数えるので、consumerを再起動しても引き継がれる.
+- `RedisStreamsBroker`: redis-pyのクライアントを使う本番用の実装
+- `InMemoryBroker`: 同じ振る舞いをプロセス内で再現する、テスト・ローカル実行用の実装
+"""
+import abc
+import itertools
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src.allocation import config
+from src.allocation.adapters import serialization
+from src.allocation.domain import events
+
+INBOUND_STREAM = "allocation.inbound"
+OUTBOUND_STREAM = "allocation.outbound"
+DEAD_LETTER_STREAM = "allocation.dead_letter"
+
+
+@dataclass(frozen=True)
+class Message:
+    stream: str
+    id: str
+    payload: bytes
+    deliveries: int = 1  # このメッセージが配送された回数(今回を含む)
+
+
+class AbstractBroker(abc.ABC):
+    @abc.abstractmethod
+    def read(
+        self,
+        streams: Sequence[str],
+        group: str,
+        consumer: str,
+        count: int,
+        block_ms: Optional[int] = None,
+        pending: bool = False,
+    ) -> List[Message]:
+        """新しいメッセージを最大count件読む. pending=Trueの場合は、このconsumerが読んでまだackしていないものを読み直す."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ack(self, stream: str, group: str, ids: Sequence[str]) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add(self, stream: str, payload: bytes) -> str:
+        raise NotImplementedError
+
+    def publish(self, stream: str, event: events.Event) -> str:
+        return self.add(stream, serialization.encode(event))
+
+
+class RedisStreamsBroker(AbstractBroker):
+    def __init__(self, client=None) -> None:
+        if client is None:
+            import redis  # brokerを使うプロセスだけが依存する.
+
+            client = redis.Redis(**config.get_redis_host_and_port())
+        self.client = client
+        self._groups: set = set()
+
+    def _ensure_group(self, stream: str, group: str) -> None:
+        if (stream, group) in self._groups:
+            return
+        try:
+            self.client.xgroup_create(stream, group, id="0", mkstream=True)
+        except Exception as e:  # 既にgroupがある場合(BUSYGROUP)は問題ない.
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._groups.add((stream, group))
+
+    def read(self, streams, group, consumer, count, block_ms=None, pending=False) -> List[Message]:
+        for stream in streams:
+            self._ensure_group(stream, group)
+        start = "0" if pending else ">"
+        response = self.client.xreadgroup(
+            group, consumer, {s: start for s in streams}, count=count, block=None if pending else block_ms
+        )
+        messages = []
+        for stream, entries in response or []:
+            stream = stream.decode() if isinstance(stream, bytes) else stream
+            deliveries = self._deliveries(stream, group, consumer, entries) if pending else {}
+            for entry_id, fields in entries:
+                entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+                # event fieldの無いエントリは空のpayloadにし、decodeの失敗としてconsumerにdead letterさせる.
+                payload = fields.get(b"event", b"") if fields else b""
+                messages.append(Message(stream, entry_id, payload, deliveries.get(entry_id, 1)))
+        return messages
+
+    def _deliveries(self, stream, group, consumer, entries) -> Dict[str, int]:
+        if not entries:
+            return {}
+        first, last = entries[0][0], entries[-1][0]
+        pending = self.client.xpending_range(
+            stream, group, min=first, max=last, count=len(entries), consumername=consumer
+        )
+        return {
+            (p["message_id"].decode() if isinstance(p["message_id"], bytes) else p["message_id"]): p["times_delivered"]
+            for p in pending
+        }
+
+    def ack(self, stream, group, ids) -> None:
+        if ids:
+            self.client.xack(stream, group, *ids)
+
+    def add(self, stream, payload) -> str:
+        entry_id = self.client.xadd(stream, {"event": payload})
+        return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+
+class _Group:
+    def __init__(self) -> None:
+        self.next_index = 0
+        self.pending: "OrderedDict[str, Tuple[str, bytes, int]]" = OrderedDict()  # id -> (consumer, payload, 配送回数)
+
+
+class InMemoryBroker(AbstractBroker):
+    def __init__(self) -> None:
+        self._lock = threading.Condition()
+        self._streams: Dict[str, List[Tuple[str, bytes]]] = {}
+        self._groups: Dict[Tuple[str, str], _Group] = {}
+        self._ids = itertools.count(1)
+
+    def read(self, streams, group, consumer, count, block_ms=None, pending=False) -> List[Message]:
+        with self._lock:
+            if pending:
+                return self._read_pending(streams, group, consumer, count)
+            messages = self._read_new(streams, group, consumer, count)
+            if not messages and block_ms:
+                self._lock.wait(block_ms / 1000)
+                messages = self._read_new(streams, group, consumer, count)
+            return messages
+
+    def _read_pending(self, streams, group, consumer, count) -> List[Message]:
+        messages = []
+        for stream in streams:
+            state = self._groups.setdefault((stream, group), _Group())
+            for entry_id, (owner, payload, deliveries) in state.pending.items():
+                if owner == consumer and len(messages) < count:
+                    state.pending[entry_id] = (owner, payload, deliveries + 1)
+                    messages.append(Message(stream, entry_id, payload, deliveries + 1))
+        return messages
+
+    def _read_new(self, streams, group, consumer, count) -> List[Message]:
+        messages = []
+        for stream in streams:
+            entries = self._streams.get(stream, [])
+            state = self._groups.setdefault((stream, group), _Group())
+            while state.next_index < len(entries) and len(messages) < count:
+                entry_id, payload = entries[state.next_index]
+                state.next_index += 1
+                state.pending[entry_id] = (consumer, payload, 1)
+                messages.append(Message(stream, entry_id, payload))
+        return messages
+
+    def ack(self, stream, group, ids) -> None:
+        with self._lock:
+            state = self._groups.get((stream, group))
+            for entry_id in ids:
+                if state is not None:
+                    state.pending.pop(entry_id, None)
+
+    def add(self, stream, payload) -> str:
+        with self._lock:
+            entry_id = f"{next(self._ids)}-0"
+            self._streams.setdefault(stream, []).append((entry_id, bytes(payload)))
+            self._lock.notify_all()
+            return entry_id
+
+    def pending_count(self, stream: str, group: str) -> int:
+        with self._lock:
+            state = self._groups.get((stream, group))
+            return len(state.pending) if state is not None else 0
+
+    def events(self, stream: str) -> List[events.Event]:
+        """streamに追加された全てのevent. テストで発行されたeventを確認する為のもの."""
+        with self._lock:
+            return [serialization.decode(payload) for _, payload in self._streams.get(stream, [])]
+
+
+# 外部へeventを発行する先. 未設定(HTTPのみで動かす場合など)なら発行しない.
+DEFAULT_PUBLISHER: Optional[AbstractBroker] = None
+
+
+def publish(stream: str, event: events.Event) -> None:
+    if DEFAULT_PUBLISHER is not None:
+        DEFAULT_PUBLISHER.publish(stream, event)
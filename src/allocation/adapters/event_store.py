@@ -0,0 +1,202 @@
+"""SKU毎のappend-onlyなevent stream と Product のsnapshotを保持するEvent Store.
+
+- event は `serialization` のコンパクトなバイナリ形式で `<sku>.events` に追記される.
+- `snapshot_interval` 件毎に Product の状態を `<sku>.snapshot` に書き出し、
+  復元時は最後のsnapshot以降のeventだけを再生(replay)する.
+- 追記はstreamのファイルをflockで排他してから行うので、同じディレクトリを共有する複数のプロセスでも
+  offsetの確認と書き込みの間に他の追記が割り込まない.
+"""
+import fcntl
+import os
+import struct
+from datetime import date
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from src.allocation.adapters import serialization
+from src.allocation.domain import events, model
+
+_RECORD_HEADER = struct.Struct("<I")  # 適用後のversion_number. 続けてeventを`serialization`の形式で置く.
+_STR_LEN = struct.Struct("<H")
+_INT = struct.Struct("<q")
+_SNAPSHOT_HEADER = struct.Struct("<IQI")  # version_number, streamのoffset, batch数
+_BATCH_HEADER = struct.Struct("<qqI")  # 購入数, etaのordinal(0=None), 割り当て数
+
+
+class ConcurrencyError(Exception):
+    """読み込み後に別の書き込みがstreamに追記されていた場合に送出される."""
+
+
+def _pack_str(value: str) -> bytes:
+    raw = value.encode("utf-8")
+    return _STR_LEN.pack(len(raw)) + raw
+
+
+def _unpack_str(buf: memoryview, pos: int) -> Tuple[str, int]:
+    (length,) = _STR_LEN.unpack_from(buf, pos)
+    pos += _STR_LEN.size
+    return str(buf[pos : pos + length], "utf-8"), pos + length
+
+
+def _date_to_int(value: Optional[date]) -> int:
+    return value.toordinal() if value is not None else 0
+
+
+def _int_to_date(value: int) -> Optional[date]:
+    return date.fromordinal(value) if value else None
+
+
+def encode_event(event: events.Event, version: int) -> bytes:
+    return _RECORD_HEADER.pack(version) + serialization.encode(event)
+
+
+def decode_events(buf: memoryview) -> Iterator[Tuple[events.Event, int]]:
+    """バイト列から(event, 適用後のversion_number)を順に取り出す."""
+    pos = 0
+    while pos < len(buf):
+        (version,) = _RECORD_HEADER.unpack_from(buf, pos)
+        event, pos = serialization.decode_from(buf, pos + _RECORD_HEADER.size)
+        yield event, version
+
+
+def encode_snapshot(product: model.Product, offset: int) -> bytes:
+    parts = [_SNAPSHOT_HEADER.pack(product.version_number, offset, len(product.batches))]
+    for batch in product.batches:
+        parts.append(_pack_str(batch.reference))
+        parts.append(_BATCH_HEADER.pack(batch._purchased_quantity, _date_to_int(batch.eta), len(batch._allocations)))
+        for line in batch._allocations:
+            parts.append(_pack_str(line.orderid))
+            parts.append(_INT.pack(line.qty))
+    return b"".join(parts)
+
+
+def decode_snapshot(sku: str, buf: memoryview) -> Tuple[model.Product, int]:
+    version, offset, n_batches = _SNAPSHOT_HEADER.unpack_from(buf, 0)
+    pos = _SNAPSHOT_HEADER.size
+    batches = []
+    for _ in range(n_batches):
+        ref, pos = _unpack_str(buf, pos)
+        qty, eta, n_allocations = _BATCH_HEADER.unpack_from(buf, pos)
+        pos += _BATCH_HEADER.size
+        batch = model.Batch(ref, sku, qty, _int_to_date(eta))
+        for _ in range(n_allocations):
+            orderid, pos = _unpack_str(buf, pos)
+            (line_qty,) = _INT.unpack_from(buf, pos)
+            pos += _INT.size
+            batch._allocations.add(model.OrderLine(orderid, sku, line_qty))
+        batches.append(batch)
+    return model.Product(sku, batches, version_number=version), offset
+
+
+def apply(product: model.Product, event: events.Event) -> None:
+    """状態を変更するeventをProductに適用する. それ以外(OutOfStock等)は履歴としてのみ残る."""
+    if isinstance(event, events.BatchCreated):
+        product.batches.append(model.Batch(event.ref, event.sku, event.qty, event.eta))
+    elif isinstance(event, events.BatchQuantityChanged):
+        batch = next(b for b in product.batches if b.reference == event.ref)
+        batch._purchased_quantity = event.qty
+    elif isinstance(event, events.Allocated):
+        batch = next(b for b in product.batches if b.reference == event.batchref)
+        batch._allocations.add(model.OrderLine(event.orderid, event.sku, event.qty))
+    elif isinstance(event, events.Deallocated):
+        batch = next(b for b in product.batches if b.reference == event.batchref)
+        batch.deallocate(model.OrderLine(event.orderid, event.sku, event.qty))
+
+
+class EventStore:
+    def __init__(self, root: Path, snapshot_interval: int = 100) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.snapshot_interval = snapshot_interval
+        self._batchref_index: Dict[str, str] = {}
+        self._batchref_index_size = 0  # batchrefs.idxのうち読み込み済みのバイト数
+        self._since_snapshot: Dict[str, int] = {}
+
+    def _path(self, sku: str, suffix: str) -> Path:
+        return self.root / f"{quote(sku, safe='')}.{suffix}"
+
+    @property
+    def _index_path(self) -> Path:
+        return self.root / "batchrefs.idx"
+
+    def stream_offset(self, sku: str) -> int:
+        path = self._path(sku, "events")
+        return path.stat().st_size if path.exists() else 0
+
+    def load(self, sku: str) -> Tuple[Optional[model.Product], int]:
+        """最新のsnapshot + それ以降のeventからProductを復元し、(product, streamのoffset)を返す."""
+        product, offset = None, 0
+        snapshot_path = self._path(sku, "snapshot")
+        if snapshot_path.exists():
+            product, offset = decode_snapshot(sku, memoryview(snapshot_path.read_bytes()))
+        events_path = self._path(sku, "events")
+        if not events_path.exists():
+            return product, offset
+        with events_path.open("rb") as file:
+            file.seek(offset)
+            tail = file.read()
+        n_replayed = 0
+        for event, version in decode_events(memoryview(tail)):
+            if product is None:
+                product = model.Product(sku, batches=[])
+            apply(product, event)
+            product.version_number = version
+            n_replayed += 1
+        self._since_snapshot[sku] = n_replayed
+        return product, offset + len(tail)
+
+    def append(self, product: model.Product, new_events: List[events.Event], expected_offset: int) -> int:
+        """eventをstreamの末尾に追記し、新しいoffsetを返す."""
+        data = b"".join(encode_event(e, product.version_number) for e in new_events)
+        with self._path(product.sku, "events").open("ab") as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)  # closeで解放される.
+            if os.fstat(file.fileno()).st_size != expected_offset:
+                raise ConcurrencyError(f"stream for {product.sku} was modified concurrently")
+            file.write(data)
+            file.flush()
+        new_refs = [e.ref for e in new_events if isinstance(e, events.BatchCreated)]
+        if new_refs:
+            self._index_batchrefs(product.sku, new_refs)
+        offset = expected_offset + len(data)
+        count = self._since_snapshot.get(product.sku, 0) + len(new_events)
+        if count >= self.snapshot_interval:
+            self.snapshot(product, offset)
+            count = 0
+        self._since_snapshot[product.sku] = count
+        return offset
+
+    def snapshot(self, product: model.Product, offset: int) -> None:
+        path = self._path(product.sku, "snapshot")
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(encode_snapshot(product, offset))
+        tmp_path.replace(path)  # 書き込み途中のsnapshotを読まない様にatomicに置き換える.
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        sku = self._batchref_index.get(batchref)
+        if sku is None:  # 他のプロセス(・EventStore)が追記したbatchrefかもしれない.
+            sku = self._load_batchref_index().get(batchref)
+        return sku
+
+    def _load_batchref_index(self) -> Dict[str, str]:
+        """batchrefs.idxの前回から増えた分を読み込む. ファイルは追記のみなので、小さくなった場合だけ全体を読み直す."""
+        if not self._index_path.exists():
+            return self._batchref_index
+        with self._index_path.open("rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < self._batchref_index_size:
+                self._batchref_index, self._batchref_index_size = {}, 0
+            file.seek(self._batchref_index_size)
+            tail = file.read(size - self._batchref_index_size)
+        complete = tail[: tail.rfind(b"\n") + 1]  # 書き込み途中の行は次回に読む.
+        for row in complete.decode("utf-8").splitlines():
+            ref, sku = row.split("\t")
+            self._batchref_index[ref] = sku
+        self._batchref_index_size += len(complete)
+        return self._batchref_index
+
+    def _index_batchrefs(self, sku: str, refs: List[str]) -> None:
+        with self._index_path.open("a", encoding="utf-8") as file:
+            for ref in refs:
+                file.write(f"{ref}\t{sku}\n")
+                self._batchref_index[ref] = sku
@@ -0,0 +1,139 @@
+"""/allocate のリトライを冪等にする為の、idempotency key -> batchref のキャッシュ.
+
+プロセス内のTTL付きLRUを前段に置き、ミスした場合のみワーカー間で共有されるテーブルを引く.
+"""
+import abc
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from src.allocation.adapters import orm
+
+MAX_KEY_LENGTH = 255  # idempotency_keys.keyの長さ
+
+
+def key_for(orderid: str, sku: str, qty: int) -> str:
+    """orderid + オーダーラインのハッシュからidempotency keyを作る."""
+    line_hash = hashlib.sha1(f"{orderid}\x1f{sku}\x1f{qty}".encode("utf-8")).hexdigest()[:16]
+    return f"{orderid}:{line_hash}"
+
+
+class AbstractIdempotencyStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, key: str, min_created_at: float) -> Optional[str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put(self, key: str, batchref: str, created_at: float) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def purge(self, older_than: float) -> None:
+        raise NotImplementedError
+
+
+class SqlAlchemyIdempotencyStore(AbstractIdempotencyStore):
+    def __init__(self, session_factory) -> None:
+        self.session_factory = session_factory
+
+    def get(self, key: str, min_created_at: float) -> Optional[str]:
+        table = orm.idempotency_keys
+        session = self.session_factory()
+        try:
+            return session.execute(
+                select(table.c.batchref).where(table.c.key == key).where(table.c.created_at >= min_created_at)
+            ).scalar()
+        finally:
+            session.close()
+
+    def put(self, key: str, batchref: str, created_at: float) -> None:
+        session = self.session_factory()
+        try:
+            session.execute(orm.idempotency_keys.insert().values(key=key, batchref=batchref, created_at=created_at))
+            session.commit()
+        except IntegrityError:
+            session.rollback()  # 他のワーカーが先に記録済み.
+        finally:
+            session.close()
+
+    def purge(self, older_than: float) -> None:
+        session = self.session_factory()
+        try:
+            session.execute(orm.idempotency_keys.delete().where(orm.idempotency_keys.c.created_at < older_than))
+            session.commit()
+        finally:
+            session.close()
+
+
+class InMemoryIdempotencyStore(AbstractIdempotencyStore):
+    def __init__(self) -> None:
+        self._rows: Dict[str, Tuple[str, float]] = {}
+
+    def get(self, key: str, min_created_at: float) -> Optional[str]:
+        batchref, created_at = self._rows.get(key, (None, 0.0))
+        return batchref if created_at >= min_created_at else None
+
+    def put(self, key: str, batchref: str, created_at: float) -> None:
+        self._rows.setdefault(key, (batchref, created_at))
+
+    def purge(self, older_than: float) -> None:
+        self._rows = {k: v for k, v in self._rows.items() if v[1] >= older_than}
+
+
+class IdempotencyCache:
+    """プロセス内の上限付きTTLキャッシュ + 共有store.
+    Flaskのスレッド間で共有されるので、プロセス内のキャッシュはロックの中で操作する(共有storeへの問い合わせはロックの外)."""
+
+    PURGE_EVERY = 1000  # put何回毎に共有storeの期限切れ行を削除するか
+
+    def __init__(
+        self,
+        store: AbstractIdempotencyStore,
+        maxsize: int = 10_000,
+        ttl: float = 24 * 60 * 60,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.store = store
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._local: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def get(self, key: str) -> Optional[str]:
+        now = self.clock()
+        with self._lock:
+            hit = self._local.get(key)
+            if hit is not None:
+                batchref, created_at = hit
+                if created_at >= now - self.ttl:
+                    self._local.move_to_end(key)
+                    return batchref
+                del self._local[key]
+        batchref = self.store.get(key, min_created_at=now - self.ttl)
+        if batchref is not None:
+            with self._lock:
+                self._remember(key, batchref, now)
+        return batchref
+
+    def put(self, key: str, batchref: str) -> None:
+        now = self.clock()
+        self.store.put(key, batchref, created_at=now)
+        with self._lock:
+            self._remember(key, batchref, now)
+            self._puts += 1
+            purge = self._puts % self.PURGE_EVERY == 0
+        if purge:
+            self.store.purge(older_than=now - self.ttl)
+
+    def _remember(self, key: str, batchref: str, created_at: float) -> None:
+        self._local[key] = (batchref, created_at)
+        self._local.move_to_end(key)
+        while len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
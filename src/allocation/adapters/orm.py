@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table
+import threading
+
+from sqlalchemy import Column, Date, Float, ForeignKey, Integer, MetaData, String, Table, event, inspect
 from sqlalchemy.orm import mapper, relationship
 
 # 1. ORMはドメインモデルをインポートする（あるいは「依存する」あるいは「知っている」）のであって、その逆ではない.
@@ -13,6 +15,7 @@ order_lines = Table(  # 2.SQLAlchemy の抽象化機能を使って、データ
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
+    sqlite_autoincrement=True,
 )
 
 products = Table(
@@ -30,6 +33,7 @@ batches = Table(
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    sqlite_autoincrement=True,
 )
 
 allocations = Table(
@@ -38,6 +42,52 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
+    sqlite_autoincrement=True,
+)
+
+idempotency_keys = Table(  # /allocate のリトライ時に、前回の割り当て結果を返す為のテーブル(ドメインモデルにはマッピングしない).
+    "idempotency_keys",
+    metadata,
+    Column("key", String(255), primary_key=True),
+    Column("batchref", String(255), nullable=False),
+    Column("created_at", Float, nullable=False),
+)
+
+batchref_directory = Table(  # シャーディング時に batchref -> sku を引く為のディレクトリ.
+    "batchref_directory",
+    metadata,
+    Column("reference", String(255), primary_key=True),
+    Column("sku", String(255), nullable=False),
+)
+
+# 割り当てが済んだbatchの移動先(adapters/archive.py). ドメインモデルにはマッピングせず、集約の読み込み対象から外す.
+# idは元のテーブルのものをそのまま使う. (SQLiteは削除された最大のidを再利用するので、元のテーブルは sqlite_autoincrement にする)
+archived_batches = Table(
+    "archived_batches",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("reference", String(255), index=True),
+    Column("sku", String(255)),
+    Column("_purchased_quantity", Integer, nullable=False),
+    Column("eta", Date, nullable=True),
+    Column("archived_at", Float, nullable=False),
+)
+
+archived_order_lines = Table(
+    "archived_order_lines",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("sku", String(255)),
+    Column("qty", Integer, nullable=False),
+    Column("orderid", String(255), index=True),  # リトライ対策の確認(archive.archived_allocations)用
+)
+
+archived_allocations = Table(
+    "archived_allocations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("orderline_id", Integer, index=True),
+    Column("batch_id", Integer, index=True),
 )
 
 
@@ -59,3 +109,22 @@ def start_mappers():
         products,
         properties={"batches": relationship(batches_mapper)},
     )
+
+
+_mappers_lock = threading.Lock()
+
+
+def ensure_mappers_started():
+    """まだマッピングされていなければstart_mappersを呼ぶ. 起動時ではなく、最初に必要になった時に呼ぶ為のもの.
+    複数のスレッドが同時に最初のリクエストを処理しても、start_mappersは1回だけ呼ぶ."""
+    if inspect(model.Product, raiseerr=False) is None:
+        with _mappers_lock:
+            if inspect(model.Product, raiseerr=False) is None:
+                start_mappers()
+
+
+@event.listens_for(model.Product, "load")
+def receive_load(product, _):
+    """ORMから読み込まれたProductは__init__を経由しないので、eventsと優先順をここで初期化する."""
+    product.events = []
+    product._priority = None
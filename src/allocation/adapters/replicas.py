@@ -0,0 +1,69 @@
+"""参照系の処理を振り分ける為のread replicaのプール.
+
+各replicaの遅延(lag)は `lag_probe` で測り、`lag_ttl` 秒の間はキャッシュする.
+許容できる遅延(max_staleness)を超えるreplicaしかなければ、呼び出し側はprimaryに戻る.
+"""
+import itertools
+import time
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.session import Session
+
+LagProbe = Callable[[Session], float]
+
+
+_LAG_SQL = text(
+    "SELECT pg_is_in_recovery(), pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn(),"
+    " EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+)
+
+
+def postgres_replication_lag(session: Session) -> float:
+    """受信済みのWALを適用しきれていない場合に、最後に適用したトランザクションからの経過秒数.
+    受信したWALを全て適用済み(primaryに書き込みが無い間を含む)、またはreplicaでない場合は0.
+    (経過秒数だけでは、primaryに書き込みが無い間も遅延が増え続けて見える為)"""
+    in_recovery, caught_up, seconds = session.execute(_LAG_SQL).one()
+    if not in_recovery or caught_up or seconds is None:
+        return 0.0
+    return float(seconds)
+
+
+class ReplicaPool:
+    def __init__(
+        self,
+        session_factories: List[sessionmaker],
+        lag_probe: LagProbe = postgres_replication_lag,
+        lag_ttl: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.session_factories = session_factories
+        self.lag_probe = lag_probe
+        self.lag_ttl = lag_ttl
+        self.clock = clock
+        self._lags: Dict[int, tuple] = {}  # replicaの番号 -> (lag, 計測時刻)
+        self._next = itertools.cycle(range(len(session_factories)))
+
+    def lag(self, i: int) -> float:
+        now = self.clock()
+        cached = self._lags.get(i)
+        if cached is not None and now - cached[1] < self.lag_ttl:
+            return cached[0]
+        session = self.session_factories[i]()
+        try:
+            lag = self.lag_probe(session)
+        except Exception:
+            lag = float("inf")  # 応答しないreplicaは使わない.
+        finally:
+            session.close()
+        self._lags[i] = (lag, now)
+        return lag
+
+    def pick(self, max_staleness: Optional[float] = None) -> Optional[sessionmaker]:
+        """ラウンドロビンで、遅延がmax_staleness以下のreplicaを選ぶ. 該当がなければNone."""
+        for _ in range(len(self.session_factories)):
+            i = next(self._next)
+            if max_staleness is None or self.lag(i) <= max_staleness:
+                return self.session_factories[i]
+        return None
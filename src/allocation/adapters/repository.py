@@ -1,11 +1,15 @@
 import abc
-from typing import List, Set
+import threading
+from datetime import date
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
 
 # domain modelに依存
+from sqlalchemy import select, text
 from sqlalchemy.orm.session import Session
 
-from src.allocation.adapters import orm
-from src.allocation.domain import model
+from src.allocation.adapters import archive, orm
+from src.allocation.adapters.event_store import ConcurrencyError, EventStore
+from src.allocation.domain import events, model
 
 
 class AbstractRepository(abc.ABC):
@@ -15,6 +19,29 @@ class AbstractRepository(abc.ABC):
 
     def __init__(self) -> None:
         self.seen: Set[model.Product] = set()
+        self.events: List[events.Event] = []  # Productを経由しない操作(allocate_fast)が発行したevent
+
+    def allocate_fast(self, line: model.OrderLine) -> Optional[str]:
+        """Productを読み込まずに割り当てる. 対応していない、または単純な割り当てで済まない場合はNoneを返し、
+        呼び出し側はドメインモデル(Product.allocate)で割り当てる."""
+        return None
+
+    def archived_allocations(self, orderid: str, sku: str) -> List[Tuple[str, int]]:
+        """集約から外された(アーカイブ済みのbatchの)、orderid・skuの割り当ての(batchref, 数量)のリスト.
+        リトライ対策の確認に使う. アーカイブに対応していないrepositoryでは常に空."""
+        return []
+
+    def is_archived(self, sku: str, batchref: str) -> bool:
+        """skuのbatchrefのbatchがアーカイブ済み(集約から外されている)か. アーカイブに対応していないrepositoryでは常にFalse."""
+        return False
+
+    def record(self, command: events.Event) -> None:
+        """処理中のcommand. 受けた要求も履歴に残すrepository(EventStoreRepository)だけが使う."""
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        """batchrefの属するSKU. 参照用のUoWからも呼べる様に、データベースへ書き込まずに引く."""
+        product = self._get_by_batchref(batchref)
+        return product.sku if product is not None else None
 
     def add(self, product: model.Product) -> None:
         self._add(product)
@@ -45,17 +72,108 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
 
+# Product.allocateと同じ優先順(eta=Noneが先頭、次にetaの早い順、同順位は追加順)で、qtyが入る最初のbatch.
+# 同じラインが既に割り当て済みなら(Product.allocateは既存のbatchrefを返すので)候補なしとする.
+_CANDIDATE_SQL = """
+    SELECT b.id, b.reference FROM batches b
+    LEFT JOIN allocations a ON a.batch_id = b.id
+    LEFT JOIN order_lines l ON l.id = a.orderline_id
+    WHERE b.sku = :sku AND NOT EXISTS (
+        SELECT 1 FROM order_lines ol
+        JOIN allocations al ON al.orderline_id = ol.id
+        JOIN batches bb ON bb.id = al.batch_id
+        WHERE ol.orderid = :orderid AND ol.sku = :sku AND ol.qty = :qty AND bb.sku = :sku
+    )
+    GROUP BY b.id, b.reference, b._purchased_quantity, b.eta
+    HAVING b._purchased_quantity - COALESCE(SUM(l.qty), 0) >= :qty
+    ORDER BY b.eta IS NOT NULL, b.eta, b.id
+    LIMIT 1
+"""
+_SELECT_CANDIDATE = text(_CANDIDATE_SQL)
+_BUMP_VERSION = text("UPDATE products SET version_number = version_number + 1 WHERE sku = :sku")
+# PostgreSQLでは、batchの選択から割り当ての追加・version_numberの更新までを1つの文で行う.
+_ALLOCATE_CTE = text(
+    f"""
+    WITH candidate AS ({_CANDIDATE_SQL}),
+    product AS (
+        UPDATE products SET version_number = version_number + 1
+        WHERE sku = :sku AND EXISTS (SELECT 1 FROM candidate)
+        RETURNING sku
+    ),
+    line AS (
+        INSERT INTO order_lines (sku, qty, orderid)
+        SELECT :sku, :qty, :orderid FROM product
+        RETURNING id
+    ),
+    allocation AS (
+        INSERT INTO allocations (orderline_id, batch_id)
+        SELECT line.id, candidate.id FROM line, candidate
+    )
+    SELECT candidate.reference FROM candidate, product
+    """
+)
+
+
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, fast_path: bool = False):
+        super().__init__()
         self.session = session
+        self.fast_path = fast_path
+
+    def allocate_fast(self, line: model.OrderLine) -> Optional[str]:
+        """「割り当て済みでないラインを、優先順で最初に入るbatchへ割り当てる」だけの場合を、SQLで直接処理する.
+        batchの選択・order_lines/allocationsへの追加・version_numberの更新を同じトランザクションで行う.
+        在庫切れ・割り当て済み・このsessionで既に読み込んだProduct等の場合はNoneを返す."""
+        if not self.fast_path or any(p.sku == line.sku for p in self.seen):
+            return None
+        params = {"sku": line.sku, "qty": line.qty, "orderid": line.orderid}
+        if self.session.get_bind().dialect.name == "postgresql":
+            batchref = self.session.execute(_ALLOCATE_CTE, params).scalar()
+        else:
+            batchref = self._allocate_statements(params)
+        if batchref is not None:
+            self.events.append(events.Allocated(line.orderid, line.sku, line.qty, batchref))
+        return batchref
+
+    def _allocate_statements(self, params: dict) -> Optional[str]:
+        """CTEの中で更新できないデータベース(SQLite等)向けに、同じ処理を同じトランザクションの複数の文で行う."""
+        candidate = self.session.execute(_SELECT_CANDIDATE, params).first()
+        if candidate is None:
+            return None
+        self.session.execute(_BUMP_VERSION, params)
+        line_id = self.session.execute(orm.order_lines.insert().values(**params)).inserted_primary_key[0]
+        self.session.execute(orm.allocations.insert().values(orderline_id=line_id, batch_id=candidate.id))
+        return candidate.reference
+
+    def archived_allocations(self, orderid: str, sku: str) -> List[Tuple[str, int]]:
+        return archive.archived_allocations(self.session, orderid, sku)
+
+    def is_archived(self, sku: str, batchref: str) -> bool:
+        return archive.is_archived(self.session, sku, batchref)
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        # _get_by_batchrefと違い、アーカイブ済みのbatchを元のテーブルへ戻さずに引く.
+        for table in (orm.batches, orm.archived_batches):
+            sku = self.session.execute(select(table.c.sku).where(table.c.reference == batchref).limit(1)).scalar()
+            if sku is not None:
+                return sku
+        return None
 
     def _add(self, batch):
         self.session.add(batch)
 
     def _get(self, sku: str):
-        return self.session.query(model.Batch).filter_by(reference=sku).one()
+        return self.session.query(model.Product).filter_by(sku=sku).first()
 
     def _get_by_batchref(self, batchref: str) -> model.Product:
+        product = self._query_by_batchref(batchref)
+        if product is None and archive.restore_batch(self.session, batchref):
+            # アーカイブ済みのbatchへの変更なので、元のテーブルへ戻してから読み込む.
+            product = self._query_by_batchref(batchref)
+            self.session.expire(product, ["batches"])
+        return product
+
+    def _query_by_batchref(self, batchref: str) -> Optional[model.Product]:
         return (
             self.session.query(model.Product)
             .join(model.Batch)
@@ -67,3 +185,207 @@ class SqlAlchemyRepository(AbstractRepository):
 
     def list(self):
         return self.session.query(model.Batch).all()
+
+
+BatchState = Tuple[int, Optional[date], FrozenSet[model.OrderLine]]
+
+
+def _batch_states(product: model.Product) -> Dict[str, BatchState]:
+    return {b.reference: (b._purchased_quantity, b.eta, frozenset(b._allocations)) for b in product.batches}
+
+
+def _diff(product: model.Product, before: Dict[str, BatchState]) -> Iterator[events.Event]:
+    """読み込み時点の状態と現在の状態の差分を、状態変更を表すeventの列として返す."""
+    for batch in product.batches:
+        qty, _, allocations = before.get(batch.reference, (None, None, frozenset()))
+        if qty is None:
+            yield events.BatchCreated(batch.reference, batch.sku, batch._purchased_quantity, batch.eta)
+        elif qty != batch._purchased_quantity:
+            yield events.BatchQuantityChanged(batch.reference, batch._purchased_quantity)
+        for line in allocations - batch._allocations:
+            yield events.Deallocated(line.orderid, line.sku, line.qty, batch.reference)
+        for line in batch._allocations - allocations:
+            yield events.Allocated(line.orderid, line.sku, line.qty, batch.reference)
+
+
+class EventStoreRepository(AbstractRepository):
+    """Productをevent streamから復元する、SqlAlchemyRepositoryの代替backend."""
+
+    def __init__(self, store: EventStore):
+        super().__init__()
+        self.store = store
+        self._products: Dict[str, model.Product] = {}  # identity map
+        self._baselines: Dict[str, Tuple[int, Dict[str, BatchState]]] = {}
+        self._commands: Dict[str, List[events.Event]] = {}  # sku -> 処理中のcommand
+
+    def _add(self, product: model.Product) -> None:
+        self._products[product.sku] = product
+        self._baselines[product.sku] = (self.store.stream_offset(product.sku), {})
+
+    def _get(self, sku: str) -> Optional[model.Product]:
+        if sku in self._products:
+            return self._products[sku]
+        product, offset = self.store.load(sku)
+        if product is not None:
+            self._products[sku] = product
+            self._baselines[sku] = (offset, _batch_states(product))
+        return product
+
+    def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
+        sku = self.store.sku_for_batchref(batchref)
+        return self._get(sku) if sku is not None else None
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        return self.store.sku_for_batchref(batchref)
+
+    def record(self, command: events.Event) -> None:
+        self._commands.setdefault(command.sku, []).append(command)
+
+    def save_changes(self) -> None:
+        """seenなProductの変更をeventとしてstreamに追記する. 処理したcommandを、その結果のeventより前に置く."""
+        for product in self.seen:
+            offset, before = self._baselines[product.sku]
+            new_events = self._commands.pop(product.sku, [])
+            new_events.extend(_diff(product, before))
+            new_events.extend(e for e in product.events if isinstance(e, events.OutOfStock))
+            if new_events:
+                offset = self.store.append(product, new_events, expected_offset=offset)
+            self._baselines[product.sku] = (offset, _batch_states(product))
+
+
+class _CopyOnWriteBatch(model.CountingBatch):
+    """commit済みのbatchと割り当ての集合を共有し、最初に割り当てを変更する時にだけ集合をコピーするbatch."""
+
+    def _own_allocations(self) -> None:
+        if self._shared:
+            self._allocations = set(self._allocations)
+            self._shared = False
+
+    def allocate(self, line: model.OrderLine):
+        self._own_allocations()
+        super().allocate(line)
+
+    def deallocate(self, line: model.OrderLine):
+        self._own_allocations()
+        super().deallocate(line)
+
+    def deallocate_one(self) -> model.OrderLine:
+        self._own_allocations()
+        return super().deallocate_one()
+
+
+def _copy_batch(batch: model.Batch) -> _CopyOnWriteBatch:
+    copy = object.__new__(_CopyOnWriteBatch)
+    copy.__dict__.update(batch.__dict__)
+    if not isinstance(batch, model.CountingBatch):
+        copy._allocated_quantity = batch.allocated_quantity
+    copy._shared = True
+    return copy
+
+
+def _copy_product(product: model.Product) -> model.Product:
+    return model.Product(product.sku, [_copy_batch(b) for b in product.batches], product.version_number)
+
+
+ProductState = Tuple[int, List[Tuple[str, int, Optional[date]]]]
+
+
+def _product_state(product: model.Product) -> ProductState:
+    """割り当て以外の、変更の有無を判定する為の状態. 割り当ての変更は_CopyOnWriteBatchの_sharedで分かる."""
+    return product.version_number, [(b.reference, b._purchased_quantity, b.eta) for b in product.batches]
+
+
+def _is_modified(product: model.Product, before: ProductState) -> bool:
+    return _product_state(product) != before or any(not getattr(b, "_shared", False) for b in product.batches)
+
+
+class InMemoryStore:
+    """InMemoryRepositoryのcommit済みの状態. 複数のUoW(スレッド)で共有する.
+    commit済みのProductは変更せず(copy-on-write)、commit時に丸ごと差し替えるので、読み込みにロックは要らない."""
+
+    def __init__(self, products: Iterable[model.Product] = ()) -> None:
+        self._products: Dict[str, Tuple[int, model.Product]] = {}  # sku -> (revision, product)
+        self._sku_by_batchref: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        for product in products:
+            self._products[product.sku] = (0, product)
+            self._index(product)
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def get(self, sku: str) -> Optional[Tuple[int, model.Product]]:
+        return self._products.get(sku)
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        return self._sku_by_batchref.get(batchref)
+
+    def products(self) -> List[model.Product]:
+        return [product for _, product in list(self._products.values())]
+
+    def commit(self, changes: List[Tuple[model.Product, Optional[int]]]) -> None:
+        """(Product, 読み込み時のrevision)の組を反映する. 新規のProductのrevisionはNone.
+        読み込み後に他のUoWがcommitしていれば、何も反映せずにConcurrencyErrorを送出する."""
+        with self._lock:
+            for product, base in changes:
+                current = self._products.get(product.sku)
+                if (current[0] if current is not None else None) != base:
+                    raise ConcurrencyError(f"product {product.sku} was modified concurrently")
+            for product, base in changes:
+                current = self._products.get(product.sku)
+                if current is None or len(current[1].batches) != len(product.batches):
+                    self._index(product)
+                self._products[product.sku] = ((base or 0) + 1, product)
+
+    def _index(self, product: model.Product) -> None:
+        for batch in product.batches:
+            self._sku_by_batchref[batch.reference] = product.sku
+
+
+class InMemoryRepository(AbstractRepository):
+    """InMemoryStoreをbackendにするrepository. SKU・batchrefはどちらもdictで引く.
+    getはcommit済みのProductのコピーを返し、commitで変更されたコピーだけがcommit済みの状態になる.
+    (SqlAlchemyのexpire_on_commitと同様に、commit後のProductは変更せず、必要なら改めてgetする)"""
+
+    def __init__(self, store: InMemoryStore):
+        super().__init__()
+        self.store = store
+        self._working: Dict[str, Tuple[model.Product, Optional[int]]] = {}  # identity map
+        self._loaded: Dict[str, ProductState] = {}  # sku -> get時点の状態
+
+    def _add(self, product: model.Product) -> None:
+        self._working[product.sku] = (product, None)
+
+    def _get(self, sku: str) -> Optional[model.Product]:
+        working = self._working.get(sku)
+        if working is not None:
+            return working[0]
+        committed = self.store.get(sku)
+        if committed is None:
+            return None
+        revision, product = committed
+        product = _copy_product(product)
+        self._working[sku] = (product, revision)
+        self._loaded[sku] = _product_state(product)
+        return product
+
+    def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
+        sku = self.store.sku_for_batchref(batchref)
+        if sku is None:
+            # このUoWで追加され、まだcommitされていないbatch
+            sku = next((p.sku for p, _ in self._working.values() if any(b.reference == batchref for b in p.batches)), None)
+        return self._get(sku) if sku is not None else None
+
+    def commit(self) -> None:
+        """追加・変更されたProductだけを反映する. 読んだだけのProductは書き戻さず、衝突の判定にも含めない."""
+        changes = [
+            (product, revision)
+            for sku, (product, revision) in self._working.items()
+            if revision is None or _is_modified(product, self._loaded[sku])
+        ]
+        self.store.commit(changes)
+        self._working, self._loaded = {}, {}
+
+    def rollback(self) -> None:
+        # 変更はコピーにしか加えていないので、捨てるだけでcommit済みの状態に戻る.
+        self._working, self._loaded = {}, {}
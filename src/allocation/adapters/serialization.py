@@ -0,0 +1,174 @@
+"""domain eventのwire format. 外部への発行・outbox・ログ等で共通して使う.
+
+バイナリ形式(1件): header(type tag, schemaのversion, payload長) + 固定長部 + 文字列部
+- 固定長部: fieldの順に、文字列はバイト長(H)、整数はq、Optional[date]はordinal(i, 0=None)
+- 文字列部: 文字列fieldのUTF-8を順に連結したもの
+固定長部を1回の`unpack_from`で読み、文字列はmemoryviewのスライスから直接デコードするので中間のbytesを作らない.
+
+type tagは一度割り当てたら変更・再利用しない. fieldを変更する時はschemaのversionを上げ、
+古いversionのレイアウトとupcasterを`register_legacy_schema`で登録して、過去のデータも読める様にする.
+デバッグ用には同じ内容のJSON(`to_json`/`from_json`)も用意する.
+"""
+import dataclasses
+import json
+import struct
+from datetime import date
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union, get_type_hints
+
+from src.allocation.domain import events
+
+Buffer = Union[bytes, bytearray, memoryview]
+Upcaster = Callable[[dict], dict]
+
+# type tag -> (Eventクラス, 現在のschemaのversion)
+REGISTRY: Dict[int, Tuple[Type[events.Event], int]] = {
+    1: (events.BatchCreated, 1),
+    2: (events.AllocationRequired, 1),
+    3: (events.BatchQuantityChanged, 1),
+    4: (events.OutOfStock, 1),
+    5: (events.Allocated, 1),
+    6: (events.Deallocated, 1),
+    7: (events.SplitAllocationRequired, 1),
+    8: (events.BatchArrived, 1),
+    9: (events.AllocationConfirmed, 1),
+}
+
+HEADER = struct.Struct("<BBH")  # type tag, schemaのversion, payload長
+_FIXED_FORMATS = {"s": "H", "i": "q", "d": "i"}
+
+
+class UnknownSchemaError(Exception):
+    """登録されていないtype tag、またはこのプロセスが知らないversionのデータを読もうとした場合に送出される."""
+
+
+def _kind_of(annotation) -> str:
+    if annotation is str:
+        return "s"
+    if annotation is int:
+        return "i"
+    if annotation in (date, Optional[date]):
+        return "d"
+    raise TypeError(f"unsupported field type for serialization: {annotation!r}")
+
+
+class _Layout:
+    """あるversionのschemaのバイナリ上の並び. 古いversionはupcasterで現在のfieldに変換する."""
+
+    def __init__(self, cls: Type[events.Event], names: Sequence[str], kinds: str, upcast: Optional[Upcaster] = None):
+        self.cls = cls
+        self.names = list(names)
+        self.kinds = kinds
+        self.upcast = upcast
+        self.fixed = struct.Struct("<" + "".join(_FIXED_FORMATS[k] for k in kinds))
+
+    @classmethod
+    def of(cls, event_cls: Type[events.Event]) -> "_Layout":
+        hints = get_type_hints(event_cls)
+        fields = dataclasses.fields(event_cls)
+        return cls(event_cls, [f.name for f in fields], "".join(_kind_of(hints[f.name]) for f in fields))
+
+    def encode(self, event: events.Event) -> bytes:
+        fixed, strings = [], []
+        for name, kind in zip(self.names, self.kinds):
+            value = getattr(event, name)
+            if kind == "s":
+                raw = value.encode("utf-8")
+                strings.append(raw)
+                fixed.append(len(raw))
+            elif kind == "d":
+                fixed.append(value.toordinal() if value is not None else 0)
+            else:
+                fixed.append(value)
+        return self.fixed.pack(*fixed) + b"".join(strings)
+
+    def decode(self, buf: memoryview, pos: int) -> events.Event:
+        fixed = self.fixed.unpack_from(buf, pos)
+        pos += self.fixed.size
+        values = []
+        for kind, raw in zip(self.kinds, fixed):
+            if kind == "s":
+                values.append(str(buf[pos : pos + raw], "utf-8"))
+                pos += raw
+            elif kind == "d":
+                values.append(date.fromordinal(raw) if raw else None)
+            else:
+                values.append(raw)
+        if self.upcast is not None:
+            return self.cls(**self.upcast(dict(zip(self.names, values))))
+        return self.cls(*values)
+
+
+_LAYOUTS: Dict[Tuple[int, int], _Layout] = {
+    (tag, version): _Layout.of(cls) for tag, (cls, version) in REGISTRY.items()
+}
+_CURRENT: Dict[Type[events.Event], Tuple[int, int, _Layout]] = {
+    cls: (tag, version, _LAYOUTS[tag, version]) for tag, (cls, version) in REGISTRY.items()
+}
+
+
+def register_legacy_schema(tag: int, version: int, names: Sequence[str], kinds: str, upcast: Upcaster) -> None:
+    """過去のversionのレイアウトを登録する. upcastは古いfieldのdictを現在のfieldのdictに変換する."""
+    cls, current = REGISTRY[tag]
+    if version >= current:
+        raise ValueError(f"version {version} is not older than the current version {current} of {cls.__name__}")
+    _LAYOUTS[tag, version] = _Layout(cls, names, kinds, upcast)
+
+
+def encode(event: events.Event) -> bytes:
+    try:
+        tag, version, layout = _CURRENT[type(event)]
+    except KeyError:
+        raise UnknownSchemaError(f"{type(event).__name__} has no type tag") from None
+    payload = layout.encode(event)
+    return HEADER.pack(tag, version, len(payload)) + payload
+
+
+def encode_many(batch: List[events.Event]) -> bytes:
+    return b"".join(encode(e) for e in batch)
+
+
+def decode_from(buf: Buffer, pos: int = 0) -> Tuple[events.Event, int]:
+    """bufのposから1件を読み、(event, 次のレコードの位置)を返す."""
+    buf = buf if isinstance(buf, memoryview) else memoryview(buf)
+    tag, version, length = HEADER.unpack_from(buf, pos)
+    layout = _LAYOUTS.get((tag, version))
+    if layout is None:
+        raise UnknownSchemaError(f"unknown event schema: tag={tag} version={version}")
+    pos += HEADER.size
+    return layout.decode(buf, pos), pos + length
+
+
+def decode(buf: Buffer) -> events.Event:
+    return decode_from(buf)[0]
+
+
+def iter_decode(buf: Buffer) -> Iterator[events.Event]:
+    buf = buf if isinstance(buf, memoryview) else memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        event, pos = decode_from(buf, pos)
+        yield event
+
+
+def to_json(event: events.Event) -> str:
+    """デバッグ・ログ用のJSON. dateはISO形式の文字列になる."""
+    tag, version, _ = _CURRENT[type(event)]
+    data = {
+        name: value.isoformat() if isinstance(value, date) else value
+        for name, value in dataclasses.asdict(event).items()
+    }
+    return json.dumps({"type": type(event).__name__, "tag": tag, "version": version, "data": data})
+
+
+def from_json(text: str) -> events.Event:
+    message = json.loads(text)
+    layout = _LAYOUTS.get((message["tag"], message["version"]))
+    if layout is None:
+        raise UnknownSchemaError(f"unknown event schema: tag={message['tag']} version={message['version']}")
+    data = message["data"]
+    for name, kind in zip(layout.names, layout.kinds):
+        if kind == "d" and data.get(name) is not None:
+            data[name] = date.fromisoformat(data[name])
+    if layout.upcast is not None:
+        data = layout.upcast(data)
+    return layout.cls(**data)
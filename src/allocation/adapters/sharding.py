@@ -0,0 +1,308 @@
+"""Productを複数のデータベース(shard)に分散させる為のadapter.
+
+Product(Aggregate)が一貫性の境界なので、SKU単位であれば安全に分割できる.
+- `ConsistentHashRing`: SKU -> shard名 を consistent hashing で決める
+- `BatchrefDirectory`: `get_by_batchref` の為の batchref -> SKU のディレクトリ
+- `rebalance`: shard構成の変更後、所属が変わったProductを新しいshardへ移す
+"""
+import hashlib
+from bisect import bisect
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm.session import Session
+
+from src.allocation.adapters import archive, orm
+from src.allocation.adapters.repository import AbstractRepository
+from src.allocation.domain import model
+
+SessionFactory = Callable[[], Session]
+
+
+class BatchrefConflict(Exception):
+    """同じbatchrefが別のSKUで既にディレクトリに登録されている."""
+
+
+class ConcurrentModification(Exception):
+    """移動中のProductが他のトランザクションに変更された."""
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class ConsistentHashRing:
+    def __init__(self, shard_names: Iterable[str], vnodes: int = 64) -> None:
+        self.shard_names = list(shard_names)
+        if not self.shard_names:
+            raise ValueError("at least one shard is required")
+        points = sorted((_hash(f"{name}#{i}"), name) for name in self.shard_names for i in range(vnodes))
+        self._points = [p for p, _ in points]
+        self._owners = [name for _, name in points]
+
+    def shard_for(self, sku: str) -> str:
+        i = bisect(self._points, _hash(sku)) % len(self._points)
+        return self._owners[i]
+
+
+class BatchrefDirectory:
+    def __init__(self, session_factory: SessionFactory) -> None:
+        self.session_factory = session_factory
+
+    def lookup(self, batchref: str) -> Optional[str]:
+        session = self.session_factory()
+        try:
+            table = orm.batchref_directory
+            return session.execute(select(table.c.sku).where(table.c.reference == batchref)).scalar()
+        finally:
+            session.close()
+
+    def register(self, sku: str, batchrefs: Iterable[str]) -> List[str]:
+        """batchrefを登録し、新しく登録したものを返す. 同じSKUで登録済みのものは何もしない(shardのcommitに失敗した
+        前回の登録が残っていても、リトライで登録し直せる). 別のSKUで登録済みであればBatchrefConflictを送出する."""
+        batchrefs = list(batchrefs)
+        if not batchrefs:
+            return []
+        table = orm.batchref_directory
+        session = self.session_factory()
+        try:
+            query = select(table.c.reference, table.c.sku).where(table.c.reference.in_(batchrefs))
+            existing = dict(session.execute(query).all())
+            conflicts = [ref for ref, owner in existing.items() if owner != sku]
+            if conflicts:
+                raise BatchrefConflict(f"batchrefs {conflicts} are already registered for another sku")
+            new_refs = [ref for ref in batchrefs if ref not in existing]
+            if new_refs:
+                session.execute(table.insert(), [{"reference": ref, "sku": sku} for ref in new_refs])
+                session.commit()
+            return new_refs
+        finally:
+            session.close()
+
+    def unregister(self, batchrefs: Iterable[str]) -> None:
+        batchrefs = list(batchrefs)
+        if not batchrefs:
+            return
+        session = self.session_factory()
+        try:
+            session.execute(orm.batchref_directory.delete().where(orm.batchref_directory.c.reference.in_(batchrefs)))
+            session.commit()
+        finally:
+            session.close()
+
+
+class ShardedSqlAlchemyRepository(AbstractRepository):
+    def __init__(self, sessions: Callable[[str], Session], ring: ConsistentHashRing, directory: BatchrefDirectory):
+        super().__init__()
+        self._session_for_shard = sessions
+        self.ring = ring
+        self.directory = directory
+        self._known_refs: Dict[str, set] = {}
+
+    def session_for(self, sku: str) -> Session:
+        return self._session_for_shard(self.ring.shard_for(sku))
+
+    def _add(self, product: model.Product) -> None:
+        self.session_for(product.sku).add(product)
+        self._known_refs.setdefault(product.sku, set())
+
+    def _get(self, sku: str) -> Optional[model.Product]:
+        product = self.session_for(sku).query(model.Product).filter_by(sku=sku).first()
+        if product is not None:
+            self._known_refs.setdefault(sku, {b.reference for b in product.batches})
+        return product
+
+    def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
+        sku = self.directory.lookup(batchref)
+        if sku is None:
+            return None
+        product = self._get(sku)
+        if product is not None and all(b.reference != batchref for b in product.batches):
+            # アーカイブ済みのbatchへの変更なので、元のテーブルへ戻してから読み直す.
+            session = self.session_for(sku)
+            if archive.restore_batch(session, batchref):
+                session.expire(product, ["batches"])
+        return product
+
+    def archived_allocations(self, orderid: str, sku: str) -> List[Tuple[str, int]]:
+        return archive.archived_allocations(self.session_for(sku), orderid, sku)
+
+    def is_archived(self, sku: str, batchref: str) -> bool:
+        return archive.is_archived(self.session_for(sku), sku, batchref)
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        return self.directory.lookup(batchref)
+
+    def register_new_batchrefs(self) -> Dict[str, List[str]]:
+        """読み込み後に追加されたbatchのrefをディレクトリに登録し、新しく登録したrefをSKU毎に返す."""
+        registered = {}
+        for product in self.seen:
+            known = self._known_refs.setdefault(product.sku, set())
+            new_refs = [b.reference for b in product.batches if b.reference not in known]
+            registered[product.sku] = self.directory.register(product.sku, new_refs)
+            known.update(new_refs)
+        return registered
+
+
+def _move_product(sku: str, source: Session, target: Session) -> None:
+    """Productとそのbatch・割り当て・オーダーライン、アーカイブ済みのbatchを別のshardへ移す.
+    idはshard毎に採番されるので、コピー先で振り直して対応を取る.
+    ringの変更後にコピー先でも同じSKUのProductが作られている事があるので、コピー先に無いbatch・割り当てだけを
+    足し合わせ(merge)、全てがコピー先にある事を確かめてから元のshardから削除する.
+    コピー中の変更を失わない様に、Productの行をロックして読み、削除の前にversion_numberが変わっていない事を確認する.
+    (行ロックの無いSQLite等でもversion_numberの確認で検出できる. 変わっていればConcurrentModificationを送出する)"""
+    product_row = source.execute(select(orm.products).where(orm.products.c.sku == sku).with_for_update()).one()
+    batches = _batches_with_lines(source, sku)
+
+    _merge_into(target, sku, product_row.version_number, batches)
+    archived_ids = _move_archived(sku, source, target)
+    missing = _missing_in(target, sku, batches)
+    if missing:
+        raise RuntimeError(f"batches {missing} of product {sku} were not copied to the target shard")
+
+    unchanged = source.execute(
+        orm.products.update()
+        .where(orm.products.c.sku == sku, orm.products.c.version_number == product_row.version_number)
+        .values(version_number=product_row.version_number + 1)
+    )
+    if unchanged.rowcount != 1:
+        raise ConcurrentModification(f"product {sku} was modified while being moved")
+    batch_ids = [row.id for row, _ in batches.values()]
+    source.execute(orm.allocations.delete().where(orm.allocations.c.batch_id.in_(batch_ids)))
+    source.execute(orm.order_lines.delete().where(orm.order_lines.c.sku == sku))
+    source.execute(orm.batches.delete().where(orm.batches.c.sku == sku))
+    source.execute(orm.products.delete().where(orm.products.c.sku == sku))
+    _delete_archived(source, archived_ids)
+
+
+BatchLines = Dict[str, Tuple[object, List[Tuple[str, int]]]]  # ref -> (batchの行, 割り当てられた(orderid, qty))
+
+
+def _batches_with_lines(session: Session, sku: str) -> BatchLines:
+    b, a, l = orm.batches, orm.allocations, orm.order_lines
+    batches: BatchLines = {row.reference: (row, []) for row in session.execute(select(b).where(b.c.sku == sku))}
+    rows = session.execute(
+        select(b.c.reference, l.c.orderid, l.c.qty)
+        .select_from(a.join(b, b.c.id == a.c.batch_id).join(l, l.c.id == a.c.orderline_id))
+        .where(b.c.sku == sku)
+    )
+    for row in rows:
+        batches[row.reference][1].append((row.orderid, row.qty))
+    return batches
+
+
+def _merge_into(target: Session, sku: str, version_number: int, batches: BatchLines) -> None:
+    """コピー先に無いbatchと、コピー先のbatchに無い割り当てだけを追加する. 既にあるbatchの数量・ETAはコピー先を優先する."""
+    existing = target.execute(select(orm.products).where(orm.products.c.sku == sku).with_for_update()).first()
+    if existing is None:
+        target.execute(orm.products.insert().values(sku=sku, version_number=version_number))
+    else:  # コピー先で読み込み済みの集約のcommitを衝突させる.
+        target.execute(
+            orm.products.update().where(orm.products.c.sku == sku).values(version_number=existing.version_number + 1)
+        )
+    present = _batches_with_lines(target, sku)
+    for ref, (row, lines) in batches.items():
+        if ref in present:
+            batch_id = present[ref][0].id
+            remaining = Counter(present[ref][1])
+        else:
+            values = {k: v for k, v in row._mapping.items() if k != "id"}
+            batch_id = target.execute(orm.batches.insert().values(**values)).inserted_primary_key[0]
+            remaining = Counter()
+        for orderid, qty in lines:
+            if remaining[orderid, qty] > 0:
+                remaining[orderid, qty] -= 1
+                continue
+            line_id = target.execute(
+                orm.order_lines.insert().values(sku=sku, qty=qty, orderid=orderid)
+            ).inserted_primary_key[0]
+            target.execute(orm.allocations.insert().values(orderline_id=line_id, batch_id=batch_id))
+
+
+def _missing_in(target: Session, sku: str, batches: BatchLines) -> List[str]:
+    """元のshardのbatchのうち、コピー先にbatchか割り当てが揃っていないもののref."""
+    present = _batches_with_lines(target, sku)
+    return [
+        ref
+        for ref, (_, lines) in batches.items()
+        if ref not in present or Counter(lines) - Counter(present[ref][1])
+    ]
+
+
+def _move_archived(sku: str, source: Session, target: Session) -> List[int]:
+    """アーカイブ済みのbatchと、その割り当て・オーダーラインをコピー先へコピーし、元のshardでのidを返す.
+    コピー先ではbatches等へ一度入れて採番し直してから、archive.archive_batchesでアーカイブし直す.
+    (アーカイブ用のテーブルのidは元のテーブルのidなので、コピー先の採番と衝突させない為)"""
+    ab, aa, al = orm.archived_batches, orm.archived_allocations, orm.archived_order_lines
+    rows = source.execute(select(ab).where(ab.c.sku == sku).order_by(ab.c.id)).all()
+    already = set(target.execute(select(ab.c.reference).where(ab.c.sku == sku)).scalars())
+    by_archived_at: Dict[float, List[int]] = {}
+    for row in rows:
+        if row.reference in already:
+            continue  # 前回の実行でコピー済み
+        batch_id = target.execute(
+            orm.batches.insert().values(
+                reference=row.reference, sku=sku, _purchased_quantity=row._purchased_quantity, eta=row.eta
+            )
+        ).inserted_primary_key[0]
+        lines = source.execute(
+            select(al.c.orderid, al.c.qty)
+            .select_from(aa.join(al, al.c.id == aa.c.orderline_id))
+            .where(aa.c.batch_id == row.id)
+        ).all()
+        for line in lines:
+            line_id = target.execute(
+                orm.order_lines.insert().values(sku=sku, qty=line.qty, orderid=line.orderid)
+            ).inserted_primary_key[0]
+            target.execute(orm.allocations.insert().values(orderline_id=line_id, batch_id=batch_id))
+        by_archived_at.setdefault(row.archived_at, []).append(batch_id)
+    for archived_at, batch_ids in by_archived_at.items():
+        archive.archive_batches(target, batch_ids, archived_at)
+    copied = set(target.execute(select(ab.c.reference).where(ab.c.sku == sku)).scalars())
+    missing = [row.reference for row in rows if row.reference not in copied]
+    if missing:
+        raise RuntimeError(f"archived batches {missing} of product {sku} were not copied to the target shard")
+    return [row.id for row in rows]
+
+
+def _delete_archived(source: Session, batch_ids: List[int]) -> None:
+    aa = orm.archived_allocations
+    line_ids = select(aa.c.orderline_id).where(aa.c.batch_id.in_(batch_ids))
+    source.execute(orm.archived_order_lines.delete().where(orm.archived_order_lines.c.id.in_(line_ids)))
+    source.execute(aa.delete().where(aa.c.batch_id.in_(batch_ids)))
+    source.execute(orm.archived_batches.delete().where(orm.archived_batches.c.id.in_(batch_ids)))
+
+
+def rebalance(session_factories: Dict[str, SessionFactory], ring: ConsistentHashRing) -> List[str]:
+    """各shardを走査し、ringの上で別のshardに属するProductを移動する. 移動したSKUを返す.
+    1 SKUずつコピー先をcommitしてから元を削除するので、途中で失敗しても再実行すれば続きから移動できる.
+    移動中に変更されたProductは移動せずに残し、次に実行した時に移動する."""
+    moved = []
+    for shard_name, factory in session_factories.items():
+        source = factory()
+        try:
+            skus = source.execute(select(orm.products.c.sku)).scalars().all()
+            for sku in skus:
+                owner = ring.shard_for(sku)
+                if owner == shard_name:
+                    continue
+                target = session_factories[owner]()
+                try:
+                    _move_product(sku, source, target)
+                    target.commit()
+                    source.commit()
+                except ConcurrentModification:
+                    target.rollback()
+                    source.rollback()
+                    continue
+                except Exception:
+                    target.rollback()
+                    source.rollback()
+                    raise
+                finally:
+                    target.close()
+                moved.append(sku)
+        finally:
+            source.close()
+    return moved
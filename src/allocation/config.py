@@ -1,4 +1,5 @@
 import os
+from typing import List
 
 
 def get_postgres_uri() -> str:
@@ -9,7 +10,53 @@ def get_postgres_uri() -> str:
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_database_uri() -> str:
+    """primaryのデータベースのURI. DB_URIで上書きできる(負荷試験等で、ローカルのSQLiteを使う場合など)."""
+    return os.environ.get("DB_URI") or get_postgres_uri()
+
+
 def get_api_url() -> str:
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
     return f"http://{host}:{port}"
+
+
+def get_shard_uris() -> List[str]:
+    """Productを分散させるデータベースのURI一覧. 未設定の場合は単一のPostgresのみ."""
+    uris = os.environ.get("DB_SHARD_URIS")
+    if not uris:
+        return [get_postgres_uri()]
+    return [uri.strip() for uri in uris.split(",") if uri.strip()]
+
+
+def get_replica_uris() -> List[str]:
+    """参照系の処理を振り分けるread replicaのURI一覧. 未設定の場合は空(全てprimaryで処理する)."""
+    uris = os.environ.get("DB_REPLICA_URIS", "")
+    return [uri.strip() for uri in uris.split(",") if uri.strip()]
+
+
+def get_hot_skus() -> List[str]:
+    """ワーカー起動時に先読みしておくSKUの一覧."""
+    skus = os.environ.get("HOT_SKUS", "")
+    return [sku.strip() for sku in skus.split(",") if sku.strip()]
+
+
+def get_redis_host_and_port() -> dict:
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 63791 if host == "localhost" else 6379
+    return dict(host=host, port=port)
+
+
+def get_allocation_fast_path() -> bool:
+    """Trueなら、単純な割り当てはProductを読み込まずにSQLで直接処理する(SqlAlchemyRepository.allocate_fast)."""
+    return os.environ.get("ALLOCATION_FAST_PATH", "") in ("1", "true", "yes")
+
+
+def get_reallocate_on_arrival() -> bool:
+    """Trueなら、batchの入荷時に、まだ出荷中のbatchに割り当てられているラインを入荷したbatchへ移す."""
+    return os.environ.get("REALLOCATE_ON_ARRIVAL", "") in ("1", "true", "yes")
+
+
+def get_profiling_enabled() -> bool:
+    """Trueなら、起動時にprofiling(リクエスト毎のtraceとstackのsampling)を有効にする."""
+    return os.environ.get("PROFILING", "") in ("1", "true", "yes")
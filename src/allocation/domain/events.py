@@ -33,9 +33,58 @@ class AllocationRequired(Event):
     qty: int
 
 
+@dataclass
+class SplitAllocationRequired(Event):
+    """orderlineを、必要なら複数のbatchに分けて割り当てるevent"""
+
+    orderid: str
+    sku: str
+    qty: int
+
+
 @dataclass
 class BatchQuantityChanged(Event):
     """特定のBatchのQuantityを変更するevent"""
 
     ref: str
     qty: int
+
+
+@dataclass
+class Allocated(Event):
+    """orderlineがbatchに割り当てられた結果を表すevent"""
+
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class AllocationConfirmed(Event):
+    """リトライされた割り当てで、オーダーラインが既に割り当て済みだった事を表すevent.
+    最初の処理でcommit後のAllocatedの発行に失敗していても、リトライで発行し直せる様にする."""
+
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class Deallocated(Event):
+    """orderlineのbatchへの割り当てが外された結果を表すevent"""
+
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class BatchArrived(Event):
+    """出荷中のbatchがETAを過ぎ、倉庫に入荷した事を表すevent"""
+
+    ref: str
+    sku: str
+    eta: date
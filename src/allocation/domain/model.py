@@ -1,6 +1,8 @@
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass
 from datetime import date
-from typing import List, Optional, Set
+from itertools import accumulate
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
 from src.allocation.domain import events
 from src.allocation.domain.events import Event, OutOfStock
@@ -68,6 +70,74 @@ class Batch:
         return self._purchased_quantity - self.allocated_quantity
 
 
+class CountingBatch(Batch):
+    """割り当て数量を逐次保持するBatch. `allocated_quantity`を毎回合計し直さずに済む様にする.
+    `_allocations`を直接変更せず、allocate/deallocateを経由する場面(シミュレーション・in-memoryのbackend)で使う."""
+
+    def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
+        super().__init__(ref, sku, qty, eta)
+        self._allocated_quantity = 0
+
+    def allocate(self, line: OrderLine):
+        if line not in self._allocations and self.can_allocate(line):
+            self._allocations.add(line)
+            self._allocated_quantity += line.qty
+
+    def deallocate(self, line: OrderLine):
+        if line in self._allocations:
+            self._allocations.remove(line)
+            self._allocated_quantity -= line.qty
+
+    def deallocate_one(self) -> OrderLine:
+        line = self._allocations.pop()
+        self._allocated_quantity -= line.qty
+        return line
+
+    @property
+    def allocated_quantity(self) -> int:
+        return self._allocated_quantity
+
+
+class BatchPriority:
+    """割り当ての優先順(倉庫在庫 -> ETAの早い順 -> 追加された順)に並べたbatch. `sorted(batches)`と同じ順になる.
+    永続化はせず、Productを読み込む(ORMのload・repositoryのコピー)度に、最初に必要になった時点で並べる.
+    以降は同じProductのインスタンスの中で、batchの追加・入荷の度に全体を並べ直さず、bisectで該当するbatchだけを
+    出し入れする(allocate_manyやシミュレーションの様に、1つのインスタンスで続けて操作する場合に効く).
+    前回から末尾にbatchが追加されただけならその分を挿入し、それ以外(ORMがbatchesを読み直して並びや中身が
+    変わった場合等)は作り直す.
+    """
+
+    def __init__(self) -> None:
+        self._keys: List[Tuple[bool, date, int]] = []
+        self._batches: List[Batch] = []
+        self._key_by_ref: Dict[str, Tuple[bool, date, int]] = {}
+        self._order: List[Batch] = []  # 前回のbatchesの並び(追加された順)
+
+    def sync(self, batches: List[Batch]) -> List[Batch]:
+        """batchesの末尾に追加されたbatchを挿入し、優先順のリストを返す."""
+        if len(batches) < len(self._order) or any(a is not b for a, b in zip(batches, self._order)):
+            self.__init__()
+        self._order.extend(batches[len(self._order) :])
+        for seq in range(len(self._batches), len(batches)):
+            batch = batches[seq]
+            self._insert(batch, (batch.eta is not None, batch.eta or date.min, seq))
+        return self._batches
+
+    def promote(self, batch: Batch) -> None:
+        """入荷して倉庫在庫(eta=None)になったbatchを、倉庫在庫の位置へ移す."""
+        key = self._key_by_ref[batch.reference]
+        i = bisect_left(self._keys, key)
+        del self._keys[i]
+        del self._batches[i]
+        self._insert(batch, (False, date.min, key[2]))
+
+    def _insert(self, batch: Batch, key: Tuple[bool, date, int]) -> None:
+        i = bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self._batches.insert(i, batch)
+        self._key_by_ref[batch.reference] = key
+
+
 class Product:
     """Aggregate クラス= 全ての操作が一貫した状態(consistent state)で終了する事を確認する境界線"""
 
@@ -86,25 +156,180 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events: List[Event] = []
+        self._priority: Optional[BatchPriority] = None
+
+    def batches_by_priority(self) -> List[Batch]:
+        """割り当ての優先順に並べたbatch. 並び順は最初に必要になった時に作り、以降はbatchの追加・入荷の分だけ更新する."""
+        if self._priority is None:
+            self._priority = BatchPriority()
+        return self._priority.sync(self.batches)
 
     def allocate(self, line: OrderLine) -> str:
         """`allocate()` Domain Service を `Product` 集合体のメソッドに移動させてくる. = Domain Service
         Domain Service
         ある優先順でbatch在庫達を並び替え、
         最も優先順位の高いbatch在庫にオーダーラインを割り当てる.
+        既に割り当て済みのオーダーラインであれば、割り当て先のbatchのreferenceをそのまま返す(リトライ対策).
+        その場合も、割り当ての結果を発行し直せる様にAllocationConfirmedを発行する.
         """
-        try:
-            batch: Batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1  # allocateする度にversion numberをincrement
-            return batch.reference
-        except StopIteration:
+        allocated = next((b for b in self.batches if line in b._allocations), None)
+        if allocated is not None:
+            self.events.append(events.AllocationConfirmed(line.orderid, line.sku, line.qty, allocated.reference))
+            return allocated.reference
+        return self._allocate_to_first_batch(line)
+
+    def _allocate_to_first_batch(self, line: OrderLine) -> Optional[str]:
+        """割り当て済みかどうかを確認せずに、優先順で最初に入るbatchへ割り当てる.
+        分割されたラインは同じ数量の部分が別のbatchに残っている事があるので、同じラインを持つbatchは除く
+        (Batch._allocationsはsetなので、同じラインを追加しても数量が増えない)."""
+        batch = next(
+            (b for b in self.batches_by_priority() if line not in b._allocations and b.can_allocate(line)), None
+        )
+        if batch is None:
             self.events.append(OutOfStock(line.sku))
             return None
+        batch.allocate(line)
+        self.version_number += 1  # allocateする度にversion numberをincrement
+        self.events.append(events.Allocated(line.orderid, line.sku, line.qty, batch.reference))
+        return batch.reference
+
+    def allocate_split(
+        self, line: OrderLine, archived: Sequence[Tuple[str, int]] = ()
+    ) -> Optional[List[Tuple[str, int]]]:
+        """1つのbatchで足りなければ、優先順に複数のbatchへ分けて割り当て、(batchref, 数量)のリストを返す.
+        1つのbatchに収まる場合は`allocate`と同じ割り当てになる(無闇に分割しない).
+        分割する場合は、優先順に並べたbatchの利用可能数の累積和から、何番目のbatchまで使えば足りるかを二分探索で求める.
+        分割された各部分は、数量だけが異なるオーダーラインとして各batchに割り当てる.
+        archivedは集約から外された(アーカイブ済みのbatchの)同じorderidの部分で、リトライ対策の確認に含める.
+        """
+        ordered = [b for b in self.batches_by_priority() if b.sku == line.sku]
+        pieces = list(archived)
+        pieces += [(b.reference, l.qty) for b in ordered for l in b._allocations if l.orderid == line.orderid]
+        if pieces and sum(qty for _, qty in pieces) == line.qty:  # リトライ対策
+            self.events.extend(events.AllocationConfirmed(line.orderid, line.sku, qty, ref) for ref, qty in pieces)
+            return pieces
+        if any(b.can_allocate(line) for b in ordered):
+            return [(self.allocate(line), line.qty)]
+
+        cumulative = list(accumulate(max(b.available_quantity, 0) for b in ordered))
+        if not cumulative or cumulative[-1] < line.qty:
+            self.events.append(OutOfStock(line.sku))
+            return None
+        last = bisect_left(cumulative, line.qty)
+        allocated, filled = [], 0
+        for batch, total in zip(ordered[: last + 1], cumulative):
+            qty = min(total, line.qty) - filled
+            if qty <= 0:
+                continue  # 利用可能数が0のbatch
+            batch.allocate(OrderLine(line.orderid, line.sku, qty))
+            filled += qty
+            allocated.append((batch.reference, qty))
+            self.events.append(events.Allocated(line.orderid, line.sku, qty, batch.reference))
+        self.version_number += 1
+        return allocated
+
+    def receive_batch(self, ref: str, reallocate: bool = False) -> None:
+        """ETAを過ぎて入荷したbatchを、倉庫在庫(eta=None)として扱う. 既に倉庫在庫であれば何もしない.
+        reallocateがTrueなら、まだ出荷中のbatchに割り当てられているラインを、ETAの遅いbatchのものから
+        入荷したbatchに入るだけ移す.
+        """
+        batch = next((b for b in self.batches if b.reference == ref), None)
+        if batch is None or batch.eta is None:
+            return
+        self.batches_by_priority()  # etaを変える前の位置で並び順に載せておく.
+        batch.eta = None
+        self._priority.promote(batch)
+        self.version_number += 1
+        if not reallocate:
+            return
+        parked = [(b, l) for b in self.batches if b.eta is not None for l in b._allocations]
+        parked.sort(key=lambda bl: (bl[0].eta, bl[1].qty, bl[1].orderid), reverse=True)
+        for source, line in parked:
+            if line not in batch._allocations and batch.can_allocate(line):
+                source.deallocate(line)
+                batch.allocate(line)
+                self.events.append(events.Deallocated(line.orderid, line.sku, line.qty, source.reference))
+                self.events.append(events.Allocated(line.orderid, line.sku, line.qty, batch.reference))
 
     def change_batch_quantity(self, ref: str, qty: int):
+        """batchの数量を変更し、足りなくなった分のオーダーラインを外して別のbatchへ再割り当てする.
+        外すラインはできるだけ少なくなる様に選び、再割り当てはmessagebusを経由せずに集約内で一度に行う.
+        """
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(events.AllocationRequired(line.orderid, line.sku, line.qty))
+        shortfall = -batch.available_quantity
+        if shortfall <= 0:
+            return
+        evicted = select_lines_to_evict(batch._allocations, shortfall)
+        for line in evicted:
+            batch.deallocate(line)
+            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty, batch.reference))
+        for line in sorted(evicted, key=lambda l: l.qty, reverse=True):
+            # 分割されたラインの部分は、同じ数量の別の部分がリトライ対策の確認に一致してしまうので、確認せずに割り当て直す.
+            self._allocate_to_first_batch(line)
+
+
+_EVICTION_SEARCH_BUDGET = 10_000  # select_lines_to_evictの分枝限定法で調べる組の上限
+
+
+def select_lines_to_evict(lines: Iterable[OrderLine], shortfall: int) -> List[OrderLine]:
+    """合計がshortfall以上になるラインの組のうち、本数が最少で、その中でも合計ができるだけ小さい組を選ぶ.
+
+    本数の最小値kは大きい順に取る貪欲法で求まる. 合計は、まず各枠について「残りの枠を最大のラインで埋めても
+    不足分を満たせる、最も小さいライン」を選んだ組(O(k·n))を暫定解とし、k本の組を分枝限定法で探して改善する.
+    探索が`_EVICTION_SEARCH_BUDGET`を超えた場合は、それまでの最良の組を返す(合計が最小とは限らない).
+    """
+    remaining = sorted(lines, key=lambda l: (l.qty, l.orderid))
+    qtys = [l.qty for l in remaining]
+    k, total = 0, 0
+    for q in reversed(qtys):
+        if total >= shortfall:
+            break
+        total += q
+        k += 1
+
+    chosen: List[OrderLine] = []
+    need = shortfall
+    for slot in range(k, 0, -1):
+        top = sum(qtys[len(qtys) - (slot - 1) :]) if slot > 1 else 0
+        i = bisect_left(qtys, need - top)
+        qtys.pop(i)
+        line = remaining.pop(i)
+        chosen.append(line)
+        need -= line.qty
+    return _improve_eviction(sorted(chosen + remaining, key=lambda l: (-l.qty, l.orderid)), k, shortfall, chosen)
+
+
+def _improve_eviction(ordered: List[OrderLine], k: int, shortfall: int, best: List[OrderLine]) -> List[OrderLine]:
+    """qtyの大きい順に並べたorderedからk本を選ぶ組のうち、合計がshortfall以上で最小のものを深さ優先で探す.
+    残りの枠を最大のラインで埋めても足りない枝と、最小のラインで埋めても暫定解を下回れない枝は調べない."""
+    qtys = [l.qty for l in ordered]
+    prefix = [0, *accumulate(qtys)]
+    n = len(qtys)
+    best_total = sum(l.qty for l in best)
+    path: List[int] = []
+    budget = _EVICTION_SEARCH_BUDGET
+
+    def search(start: int, slots: int, total: int) -> None:
+        nonlocal best, best_total, budget
+        if slots == 0:
+            if shortfall <= total < best_total:
+                best, best_total = [ordered[i] for i in path], total
+            return
+        for i in range(start, n - slots + 1):
+            if budget <= 0 or best_total == shortfall:
+                return
+            if i > start and qtys[i] == qtys[i - 1]:
+                continue  # 同じ数量のラインを選び直しても同じ合計にしかならない.
+            if total + prefix[i + slots] - prefix[i] < shortfall:
+                return  # これ以降のラインはより小さいので、どれを選んでも足りない.
+            if max(shortfall, total + qtys[i] + prefix[n] - prefix[n - slots + 1]) >= best_total:
+                continue
+            budget -= 1
+            path.append(i)
+            search(i + 1, slots - 1, total + qtys[i])
+            path.pop()
+
+    if best_total > shortfall:
+        search(0, k, 0)
+    return best
@@ -0,0 +1,130 @@
+"""message brokerからeventを読み、messagebusで処理するentrypoint.
+
+上流のシステムがまとめて送ってくるAllocationRequired・BatchQuantityChanged等を、`batch_size`件ずつ読んで処理する.
+- 処理はstreamの順に行うので、同じSKUのeventの順序は保たれる. 連続するAllocationRequiredは
+  SKU毎にまとめて`messagebus.handle_allocations`で1つのUoW・1回のcommitで処理する.
+- ackはcommitの後に行う. 失敗したメッセージ以降はackせずに残し、次の読み込みでpendingから順に再処理する.
+  (既に割り当て済みのラインを再処理しても、Product.allocateは同じbatchrefを返すだけなので安全)
+- 処理できないメッセージ(decodeできない・不正なSKU・batchref)や、`max_deliveries`回配送されても失敗するものはdead letter streamへ移す.
+  配送の回数はbrokerが数える(`Message.deliveries`)ので、consumerを再起動しても上限は変わらない.
+- commit後にAllocatedの発行に失敗した場合も、再処理でProduct.allocateがAllocationConfirmedを発行し、
+  messagebusがAllocatedとして発行し直す.
+
+実行: python -m src.allocation.entrypoints.broker_consumer
+"""
+import logging
+import socket
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.allocation.adapters import broker, serialization
+from src.allocation.domain import events
+from src.allocation.service_layer import handler, messagebus, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+Decoded = Tuple[broker.Message, events.Event]
+
+
+def _segments(decoded: List[Decoded]) -> Iterator[List[Decoded]]:
+    """処理の単位に分ける. 連続するAllocationRequiredはSKU毎に1つにまとめ、それ以外は1件ずつ."""
+    allocations: "OrderedDict[str, List[Decoded]]" = OrderedDict()
+    for message, event in decoded:
+        if isinstance(event, events.AllocationRequired):
+            allocations.setdefault(event.sku, []).append((message, event))
+            continue
+        yield from allocations.values()
+        allocations.clear()
+        yield [(message, event)]
+    yield from allocations.values()
+
+
+class BrokerConsumer:
+    def __init__(
+        self,
+        message_broker: broker.AbstractBroker,
+        uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork] = unit_of_work.SqlAlchemyUnitOfWork,
+        streams: Sequence[str] = (broker.INBOUND_STREAM,),
+        group: str = "allocation",
+        consumer: Optional[str] = None,
+        batch_size: int = 100,
+        block_ms: int = 1000,
+        max_deliveries: int = 5,
+    ) -> None:
+        self.broker = message_broker
+        self.uow_factory = uow_factory
+        self.streams = list(streams)
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.max_deliveries = max_deliveries
+
+    def run_once(self) -> int:
+        """1バッチ分を読んで処理し、ackした件数を返す. 前回失敗したメッセージがあればそれを先に処理する."""
+        messages = self.broker.read(self.streams, self.group, self.consumer, self.batch_size, pending=True)
+        if not messages:
+            messages = self.broker.read(self.streams, self.group, self.consumer, self.batch_size, self.block_ms)
+        return self.process(messages)
+
+    def run(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            self.run_once()
+
+    def process(self, messages: List[broker.Message]) -> int:
+        decoded = []
+        acked = 0
+        for message in messages:
+            try:
+                decoded.append((message, serialization.decode(message.payload)))
+            except Exception:  # 未知のschema・壊れたpayload(struct.error, UnicodeDecodeError等)は何度読んでも同じ.
+                logger.exception("undecodable message %s", message.id)
+                acked += self._dead_letter([message])
+
+        for segment in _segments(decoded):
+            batch = [m for m, _ in segment]
+            try:
+                self._handle([e for _, e in segment])
+            except (handler.InvalidSku, handler.InvalidBatchref):
+                logger.exception("invalid message %s", [m.id for m in batch])
+                acked += self._dead_letter(batch)
+                continue
+            except Exception:
+                logger.exception("failed to handle %s", [m.id for m in batch])
+                if max(m.deliveries for m in batch) >= self.max_deliveries:
+                    acked += self._dead_letter(batch)
+                    continue
+                return acked  # 順序を保つ為、以降のメッセージもackせずに再配送を待つ.
+            acked += self._ack(batch)
+        return acked
+
+    def _handle(self, batch: List[events.Event]) -> None:
+        if isinstance(batch[0], events.AllocationRequired):
+            messagebus.handle_allocations(batch, self.uow_factory())
+        else:
+            messagebus.handle(batch[0], self.uow_factory())
+
+    def _ack(self, batch: List[broker.Message]) -> int:
+        by_stream: Dict[str, List[str]] = {}
+        for message in batch:
+            by_stream.setdefault(message.stream, []).append(message.id)
+        for stream, ids in by_stream.items():
+            self.broker.ack(stream, self.group, ids)
+        return len(batch)
+
+    def _dead_letter(self, batch: List[broker.Message]) -> int:
+        for message in batch:
+            self.broker.add(broker.DEAD_LETTER_STREAM, message.payload)
+        return self._ack(batch)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    message_broker = broker.RedisStreamsBroker()
+    broker.DEFAULT_PUBLISHER = message_broker
+    BrokerConsumer(message_broker).run(threading.Event())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""利用可能数が0になったbatchをarchive用のテーブルへ移すコマンド. cron等で定期的に実行する.
+
+実行: python -m src.allocation.entrypoints.compact_batches [chunk_size]
+"""
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src.allocation import config
+from src.allocation.adapters import archive
+
+
+def main() -> None:
+    chunk_size = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for uri in config.get_shard_uris():
+        archived = archive.compact(sessionmaker(bind=create_engine(uri)), chunk_size=chunk_size)
+        print(f"archived {archived} batches")
+
+
+if __name__ == "__main__":
+    main()
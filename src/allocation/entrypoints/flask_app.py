@@ -1,19 +1,86 @@
+import json
+import math
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from flask import Flask, Response, jsonify, request
-from hypothesis import event
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from flask import Flask, Response, g, jsonify, request
+from sqlalchemy.exc import DBAPIError
 
-import config
-from adapters import orm, repository
-from domain import events, model
-from service_layer import handler, messagebus, unit_of_work
+from src.allocation import config
+from src.allocation.adapters import idempotency, orm
+from src.allocation.domain import events
+from src.allocation.service_layer import (
+    admission,
+    availability_cache,
+    group_commit,
+    handler,
+    messagebus,
+    profiling,
+    unit_of_work,
+)
 
-orm.start_mappers()
-get_session = sessionmaker(bind=create_engine(config.get_postgres_uri()))
+# engineの作成とマッピングは、最初に必要になった時(またはwarm_up)まで遅らせる.
+get_session = unit_of_work.DEFAULT_SESSION_FACTORY
 app = Flask(__name__)
+idempotency_cache = idempotency.IdempotencyCache(idempotency.SqlAlchemyIdempotencyStore(get_session))
+
+
+def warm_up(hot_skus: Optional[List[str]] = None, pool_connections: int = 4) -> None:
+    """ワーカーがリクエストを受け付ける前に呼ぶ初期化処理(例: gunicornの`post_worker_init`から).
+    マッピング・遅延importを済ませ、接続プールを埋め、よく使われるSKUを一度読み込んでおく."""
+    from src.allocation.service_layer import availability  # noqa: F401  numpyの読み込みを済ませておく.
+
+    orm.ensure_mappers_started()
+    engine = unit_of_work.primary_engine()
+    connections = [engine.connect() for _ in range(pool_connections)]
+    for connection in connections:
+        connection.close()  # 接続はプールに戻り、最初のリクエストで再利用される.
+
+    hot_skus = config.get_hot_skus() if hot_skus is None else hot_skus
+    if hot_skus:
+        with unit_of_work.SqlAlchemyUnitOfWork(read_only=True) as uow:
+            for sku in hot_skus:
+                product = uow.products.get(sku=sku)
+                if product is not None:
+                    for batch in product.batches:
+                        batch.available_quantity  # allocationsのlazy loadとクエリのコンパイルを済ませる.
+
+
+@app.before_request
+def _ensure_mappers_started() -> None:
+    orm.ensure_mappers_started()
+
+
+if config.get_profiling_enabled():
+    profiling.enable()
+
+
+@app.before_request
+def _start_trace() -> None:
+    if profiling.current() is not None:
+        g.profiling_trace = profiling.trace(f"{request.method} {request.path}")
+        g.profiling_trace.__enter__()
+
+
+@app.teardown_request
+def _finish_trace(_exc) -> None:
+    trace = g.pop("profiling_trace", None)
+    if trace is not None:
+        trace.__exit__(None, None, None)
+
+
+def _allocate_batch(batch: List[events.AllocationRequired]) -> List[Optional[str]]:
+    return messagebus.handle_allocations(batch, unit_of_work.SqlAlchemyUnitOfWork())
+
+
+# 同じSKUへのリクエストは数ミリ秒の間集めて1つのトランザクションでcommitし(group commit)、
+# それでも捌ききれない分はadmission controlで429を返す.
+group_committer = group_commit.GroupCommitter(_allocate_batch, window=0.002)
+admission_controller = admission.AdmissionController(max_in_flight=64, max_queue=64)
+
+
+def _allocate_via_group_commit(batch: List[events.AllocationRequired]) -> List[Optional[str]]:
+    return [group_committer.submit(event.sku, event) for event in batch]
 
 
 @app.route("/allocate", methods=["POST"])
@@ -26,22 +93,169 @@ def allocate_endpoint() -> Tuple[Dict[str, str], int]:
     sku: str = request.json["sku"]
     qty: int = request.json["qty"]
 
+    client_key = request.headers.get("Idempotency-Key")
+    if client_key is not None and len(client_key) > idempotency.MAX_KEY_LENGTH:
+        return {"message": f"Idempotency-Key must be at most {idempotency.MAX_KEY_LENGTH} characters"}, 400
+
+    if request.json.get("split"):
+        return _allocate_split(orderid, sku, qty)
+
+    # リトライされたリクエストは同じkeyになるので、前回の割り当て結果がそのまま返る.
+    # (キャッシュにヒットしたリクエストはadmission controlの枠も消費しない)
+    key = client_key or idempotency.key_for(orderid, sku, qty)
+    batchref = idempotency_cache.get(key)
+    if batchref is not None:
+        return {"batchref": batchref}, 201
+
     try:
         event = events.AllocationRequired(orderid, sku, qty)
-        results = messagebus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())
-        batchref = results.pop(0)
+        batchref = admission_controller.submit(sku, event, _allocate_via_group_commit)
     except handler.InvalidSku as e:
         return {"message": str(e)}, 400
+    except admission.Overloaded as e:
+        return {"message": str(e)}, 429, {"Retry-After": str(math.ceil(e.retry_after))}
 
+    if batchref is not None:
+        idempotency_cache.put(key, batchref)
     return {"batchref": batchref}, 201
 
 
+def _allocate_split(orderid: str, sku: str, qty: int) -> Tuple[Dict, int]:
+    """複数のbatchへの分割を許す割り当て. 通常の割り当てと同じくidempotency keyとadmission controlを通すが、
+    group commitはしない(分割は1件ずつ、通常の割り当てとは別のhandlerで処理する).
+    結果が大きくキャッシュに入らない場合でも、リトライにはドメインモデルが既存の割り当てを返す."""
+    key = request.headers.get("Idempotency-Key") or "split:" + idempotency.key_for(orderid, sku, qty)
+    cached = idempotency_cache.get(key)
+    if cached is not None:
+        allocations = [tuple(a) for a in json.loads(cached)]
+    else:
+        try:
+            event = events.SplitAllocationRequired(orderid, sku, qty)
+            allocations = admission_controller.submit(sku, event, _allocate_split_batch)
+        except handler.InvalidSku as e:
+            return {"message": str(e)}, 400
+        except admission.Overloaded as e:
+            return {"message": str(e)}, 429, {"Retry-After": str(math.ceil(e.retry_after))}
+        encoded = json.dumps(allocations, separators=(",", ":"))
+        if allocations is not None and len(encoded) <= _MAX_CACHED_RESULT:
+            idempotency_cache.put(key, encoded)
+
+    if allocations is None:
+        return {"batchref": None, "allocations": []}, 201
+    return {
+        "batchref": allocations[0][0],
+        "allocations": [{"batchref": batchref, "qty": qty} for batchref, qty in allocations],
+    }, 201
+
+
+_MAX_CACHED_RESULT = 255  # idempotency_keys.batchrefの長さ
+
+
+def _allocate_split_batch(batch: List[events.SplitAllocationRequired]):
+    return [messagebus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())[0] for event in batch]
+
+
 @app.route("/add_batch", methods=["POST"])
 def add_batch() -> Tuple[str, int]:
-    session = get_session()
-    repo = repository.SqlAlchemyRepository(session)
     eta = request.json["eta"]
     if eta is not None:
         eta = datetime.fromisoformat(eta).date()
-    handler.add_batch(request.json["ref"], request.json["sku"], request.json["qty"], eta, repo, session)
+    event = events.BatchCreated(request.json["ref"], request.json["sku"], request.json["qty"], eta)
+    messagebus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())
     return "OK", 201
+
+
+@app.route("/change_batch_quantity", methods=["POST"])
+def change_batch_quantity_endpoint() -> Tuple[Dict[str, str], int]:
+    """batchの数量を変更する. 同時に割り当てが行われて衝突した場合は409を返すので、クライアントがやり直す."""
+    event = events.BatchQuantityChanged(request.json["ref"], request.json["qty"])
+    try:
+        messagebus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())
+    except handler.InvalidBatchref as e:
+        return {"message": str(e)}, 404
+    except DBAPIError as e:
+        if not group_commit.is_retryable(e):
+            raise
+        return {"message": f"conflict: {type(e).__name__}"}, 409
+    return {"ref": event.ref}, 200
+
+
+@app.route("/availability", methods=["GET"])
+def availability_endpoint() -> Tuple[Dict[str, Dict], int]:
+    """全SKUの利用可能数と、最優先で割り当てられるbatchを返す.
+    read modelはworker毎に持つので、未構築(プロセス起動直後)か一定時間毎にデータベースから構築し直す."""
+    from src.allocation.service_layer import availability
+
+    index = availability.DEFAULT_INDEX
+    if index.needs_rebuild():
+        # 参照のみなのでreplicaから読む. 数秒程度の遅れは、後続のeventで追いつくので許容する.
+        with unit_of_work.SqlAlchemyUnitOfWork(read_only=True, max_staleness=5.0) as uow:
+            index.rebuild_from_rows(availability.batch_rows(uow.session))
+    available = index.available_by_sku()
+    earliest = index.earliest_allocatable()
+    body = {sku: {"available": qty, "earliest_batchref": earliest[sku]} for sku, qty in available.items()}
+
+    # ?eta_buckets=2021-01-01,2021-02-01 の様に区切りの日付を渡すと、ETA別の在庫も返す.
+    eta_buckets = request.args.get("eta_buckets")
+    if eta_buckets:
+        edges = sorted(datetime.fromisoformat(d).date() for d in eta_buckets.split(","))
+        for sku, stock in index.stock_by_eta(edges).items():
+            body[sku]["stock_by_eta"] = stock
+    return body, 200
+
+
+@app.route("/products/<sku>/availability", methods=["GET"])
+def product_availability_endpoint(sku: str):
+    """SKU毎の在庫状況. キャッシュにあり、If-None-Matchが一致すればデータベースに触れずに304を返す.
+    キャッシュは在庫の変わるeventを受け取ったhandlerが無効化する."""
+    cache = availability_cache.DEFAULT_CACHE
+    entry = cache.get(sku)
+    if entry is None:
+        generation = cache.generation(sku)
+        with unit_of_work.SqlAlchemyUnitOfWork(read_only=True) as uow:
+            product = uow.products.get(sku=sku)
+            if product is None:
+                return {"message": f"Invalid sku {sku}"}, 404
+            entry = cache.put(product, generation)
+
+    headers = {"ETag": f'"{entry.etag}"', "Cache-Control": "no-cache"}
+    if request.if_none_match.contains(entry.etag):
+        return Response(status=304, headers=headers)
+    return entry.body, 200, headers
+
+
+@app.route("/metrics/admission", methods=["GET"])
+def admission_metrics_endpoint() -> Tuple[Dict, int]:
+    metrics = admission_controller.metrics()
+    return {
+        "admitted": metrics.admitted,
+        "rejected": metrics.rejected,
+        "timed_out": metrics.timed_out,
+        "batches": metrics.batches,
+        "max_queue_depth": metrics.max_queue_depth,
+        "queue_depth": metrics.queue_depth,
+    }, 200
+
+
+@app.route("/metrics/group_commit", methods=["GET"])
+def group_commit_metrics_endpoint() -> Tuple[Dict, int]:
+    return {"groups": group_committer.groups, "retries": group_committer.retries}, 200
+
+
+@app.route("/debug/profile", methods=["GET"])
+def profile_endpoint():
+    """所要時間の長かったリクエストのspanのtree. ?n=件数. profilingが無効なら404."""
+    profiler = profiling.current()
+    if profiler is None:
+        return {"message": "profiling is disabled"}, 404
+    return Response(profiler.dump(request.args.get("n", type=int)), mimetype="application/json")
+
+
+@app.route("/debug/profile/flamegraph", methods=["GET"])
+def flamegraph_endpoint():
+    """所要時間の長かったリクエストのcollapsed stack. ?n=件数&source=samples(既定)|spans."""
+    profiler = profiling.current()
+    if profiler is None:
+        return {"message": "profiling is disabled"}, 404
+    samples = request.args.get("source", "samples") != "spans"
+    return Response(profiler.flamegraph(request.args.get("n", type=int), samples=samples), mimetype="text/plain")
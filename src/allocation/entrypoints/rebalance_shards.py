@@ -0,0 +1,22 @@
+"""shard構成(DB_SHARD_URIS)の変更後に、所属が変わったProductを移動するコマンド.
+
+実行: DB_SHARD_URIS=postgresql://...,postgresql://... python -m src.allocation.entrypoints.rebalance_shards
+"""
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src.allocation import config
+from src.allocation.adapters import sharding
+
+
+def main() -> None:
+    # shard名はURIの並び順から決める. 末尾にshardを追加すれば、移動するのはおよそ1/N件で済む.
+    session_factories = {
+        f"shard{i}": sessionmaker(bind=create_engine(uri)) for i, uri in enumerate(config.get_shard_uris())
+    }
+    moved = sharding.rebalance(session_factories, sharding.ConsistentHashRing(session_factories))
+    print(f"moved {len(moved)} products")
+
+
+if __name__ == "__main__":
+    main()
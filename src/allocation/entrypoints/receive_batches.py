@@ -0,0 +1,56 @@
+"""ETAを過ぎたbatchを入荷したものとして扱うworker.
+
+新しく追加された出荷中のbatchをidの順に読んでschedulerに登録し、ETAを迎えたbatchのBatchArrivedを処理する.
+入荷時に出荷中のラインを移すかどうかは REALLOCATE_ON_ARRIVAL で設定する.
+
+実行: python -m src.allocation.entrypoints.receive_batches [poll_interval秒]
+"""
+import logging
+import sys
+import threading
+
+from sqlalchemy import select
+from sqlalchemy.orm.session import Session
+
+from src.allocation.adapters import orm
+from src.allocation.service_layer import unit_of_work
+from src.allocation.service_layer.eta_scheduler import EtaScheduler
+
+logger = logging.getLogger(__name__)
+
+
+def schedule_new_batches(session: Session, scheduler: EtaScheduler, after_id: int = 0) -> int:
+    """idがafter_idより大きい出荷中のbatchをschedulerに登録し、読んだ最大のidを返す."""
+    b = orm.batches
+    rows = session.execute(
+        select(b.c.id, b.c.reference, b.c.sku, b.c.eta).where(b.c.id > after_id, b.c.eta.isnot(None)).order_by(b.c.id)
+    ).all()
+    for row in rows:
+        scheduler.schedule(row.reference, row.sku, row.eta)
+    return rows[-1].id if rows else after_id
+
+
+def run(scheduler: EtaScheduler, stop: threading.Event, poll_interval: float = 60.0) -> None:
+    after_id = 0
+    while not stop.is_set():
+        try:
+            session = unit_of_work.DEFAULT_SESSION_FACTORY()
+            try:
+                after_id = schedule_new_batches(session, scheduler, after_id)
+            finally:
+                session.close()
+            scheduler.run_pending(unit_of_work.SqlAlchemyUnitOfWork())
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("failed to process arrivals")  # データベースの一時的な障害等. 次のpollで再試行する.
+        stop.wait(poll_interval)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    orm.start_mappers()
+    poll_interval = float(sys.argv[1]) if len(sys.argv) > 1 else 60.0
+    run(EtaScheduler(), threading.Event(), poll_interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""SKU毎の流入制御(admission control)とbackpressure.
+
+同じSKUへのリクエストは同じProductのversion_numberを取り合うので、
+同時に処理する数を `max_in_flight` に制限し、待ち行列も `max_queue` までに抑える.
+それを超えたリクエストは待たせずに `Overloaded` で即座に断る(APIでは429 + Retry-After).
+`coalesce=True` の場合、空いた枠を得たスレッドが待ち行列の先頭からまとめて取り出し、1つのUoWで処理する.
+"""
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, Generic, List, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class Overloaded(Exception):
+    def __init__(self, sku: str, retry_after: float) -> None:
+        super().__init__(f"Too many concurrent requests for sku {sku}")
+        self.sku = sku
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Ticket(Generic[T]):
+    item: T
+    taken: bool = False
+    done: bool = False
+    result: Any = None
+    error: Optional[BaseException] = None
+
+
+@dataclass
+class _SkuState:
+    condition: threading.Condition
+    in_flight: int = 0
+    waiting: Deque[_Ticket] = field(default_factory=deque)
+
+
+@dataclass
+class AdmissionMetrics:
+    admitted: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    batches: int = 0
+    max_queue_depth: int = 0
+    queue_depth: Dict[str, int] = field(default_factory=dict)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_in_flight: int = 1,
+        max_queue: int = 16,
+        queue_timeout: float = 2.0,
+        retry_after: float = 1.0,
+        coalesce: bool = False,
+        max_batch: int = 32,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.max_batch = max_batch if coalesce else 1
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._states: Dict[str, _SkuState] = {}
+        self._metrics = AdmissionMetrics()
+
+    def submit(self, sku: str, item: T, run_batch: Callable[[List[T]], List[R]]) -> R:
+        """itemを処理できる枠が空くまで待ち、run_batchの結果のうち自分の分を返す.
+        run_batchは同じSKUのitemのリストを受け取り、同じ順で結果を返す."""
+        ticket = _Ticket(item)
+        self._lock.acquire()
+        try:
+            state = self._admit(sku, ticket)
+            deadline = self.clock() + self.queue_timeout
+            while not ticket.done:
+                if state.in_flight < self.max_in_flight and state.waiting:
+                    self._run_head_of_queue(state, run_batch)
+                    continue
+                if ticket.taken:
+                    state.condition.wait()  # 他のスレッドが処理中なので結果を待つ.
+                    continue
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    state.waiting.remove(ticket)
+                    self._metrics.timed_out += 1
+                    raise Overloaded(sku, self.retry_after)
+                state.condition.wait(remaining)
+        finally:
+            self._release_state_if_idle(sku)
+            self._lock.release()
+        if ticket.error is not None:
+            raise ticket.error
+        return ticket.result
+
+    def metrics(self) -> AdmissionMetrics:
+        with self._lock:
+            return AdmissionMetrics(
+                admitted=self._metrics.admitted,
+                rejected=self._metrics.rejected,
+                timed_out=self._metrics.timed_out,
+                batches=self._metrics.batches,
+                max_queue_depth=self._metrics.max_queue_depth,
+                queue_depth={sku: len(s.waiting) for sku, s in self._states.items() if s.waiting},
+            )
+
+    def _admit(self, sku: str, ticket: _Ticket) -> _SkuState:
+        state = self._states.get(sku)
+        if state is None:
+            state = self._states[sku] = _SkuState(threading.Condition(self._lock))
+        if state.in_flight >= self.max_in_flight and len(state.waiting) >= self.max_queue:
+            self._metrics.rejected += 1
+            raise Overloaded(sku, self.retry_after)
+        state.waiting.append(ticket)
+        self._metrics.admitted += 1
+        self._metrics.max_queue_depth = max(self._metrics.max_queue_depth, len(state.waiting))
+        return state
+
+    def _run_head_of_queue(self, state: _SkuState, run_batch: Callable[[List[T]], List[R]]) -> None:
+        """ロックを保持した状態で呼ばれ、run_batchの実行中だけロックを手放す."""
+        batch = [state.waiting.popleft() for _ in range(min(len(state.waiting), self.max_batch))]
+        for ticket in batch:
+            ticket.taken = True
+        state.in_flight += 1
+        self._metrics.batches += 1
+        self._lock.release()
+        results: List[Any] = []
+        error: Optional[BaseException] = None
+        try:
+            results = run_batch([t.item for t in batch])
+        except Exception as e:  # 同じSKUのまとまりなので、エラーは全員に返す.
+            error = e
+        finally:
+            self._lock.acquire()
+        state.in_flight -= 1
+        for i, ticket in enumerate(batch):
+            ticket.done = True
+            if error is not None:
+                ticket.error = error
+            else:
+                ticket.result = results[i]
+        state.condition.notify_all()
+
+    def _release_state_if_idle(self, sku: str) -> None:
+        state = self._states.get(sku)
+        if state is not None and state.in_flight == 0 and not state.waiting:
+            del self._states[sku]
@@ -0,0 +1,184 @@
+"""全SKUの在庫状況をまとめて問い合わせる為の、NumPyによる列指向のread model.
+
+batch毎に (sku id, eta, 購入数, 割り当て数) を列として保持し、
+SKU毎の利用可能数・最優先で割り当て可能なbatch・ETA別の在庫をベクトル演算で求める.
+domain eventを受け取る度に該当する行だけを更新する.
+- indexはプロセス(worker)毎に保持される. 他のworkerで発生したeventは届かないので、
+  `needs_rebuild`が一定時間(`max_age`)毎にTrueを返すので、呼び出し側でデータベースから構築し直す.
+- データベースから一度も構築していない間のeventは無視する(構築時にデータベースから読み込まれる).
+- eventの反映(messagebusのスレッド)と問い合わせ(Flaskのスレッド)が並行するので、列の更新と読み出しはロックの中で行う.
+"""
+import threading
+import time
+from datetime import date
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm.session import Session
+
+from src.allocation.adapters import orm
+from src.allocation.domain import events
+from src.allocation.domain.model import Product
+
+_IN_STOCK = -1  # eta=None(倉庫在庫)を表すeta列の値. 出荷中のbatchより優先される.
+DEFAULT_MAX_AGE = 60.0  # 秒. これより古いindexは、次の問い合わせでデータベースから構築し直す.
+
+BatchRow = Tuple[str, str, int, Optional[date], int]  # ref, sku, 購入数, eta, 割り当て数
+
+
+def batch_rows(session: Session) -> List[BatchRow]:
+    """batch毎の割り当て数を1回の集計クエリで読む. Productを読み込むとbatch毎に割り当ての読み込みが発生する為."""
+    b, a, l = orm.batches, orm.allocations, orm.order_lines
+    query = (
+        select(b.c.reference, b.c.sku, b.c._purchased_quantity, b.c.eta, func.coalesce(func.sum(l.c.qty), 0))
+        .select_from(b.outerjoin(a, a.c.batch_id == b.c.id).outerjoin(l, l.c.id == a.c.orderline_id))
+        .group_by(b.c.id, b.c.reference, b.c.sku, b.c._purchased_quantity, b.c.eta)
+        .order_by(b.c.id)  # 同順位のbatchはProductへの追加順に並べる.
+    )
+    return [tuple(row) for row in session.execute(query)]
+
+
+class AvailabilityIndex:
+    def __init__(self, capacity: int = 1024, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear(capacity)
+
+    def clear(self, capacity: int = 1024) -> None:
+        with self._lock:
+            self._clear(capacity)
+
+    def _clear(self, capacity: int) -> None:
+        self.built_at: Optional[float] = None  # 最後にデータベースから構築した時刻. 未構築ならNone
+        self._size = 0
+        self._sku_ids = np.zeros(capacity, dtype=np.int64)
+        self._etas = np.zeros(capacity, dtype=np.int64)
+        self._purchased = np.zeros(capacity, dtype=np.int64)
+        self._allocated = np.zeros(capacity, dtype=np.int64)
+        self._refs: List[str] = []
+        self._row_by_ref: Dict[str, int] = {}
+        self._skus: List[str] = []
+        self._sku_id_by_sku: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._size
+
+    @classmethod
+    def from_products(cls, products: Iterable[Product]) -> "AvailabilityIndex":
+        index = cls()
+        index.rebuild(products)
+        return index
+
+    def rebuild(self, products: Iterable[Product]) -> None:
+        self.rebuild_from_rows(
+            (b.reference, b.sku, b._purchased_quantity, b.eta, b.allocated_quantity) for p in products for b in p.batches
+        )
+
+    def rebuild_from_rows(self, rows: Iterable[BatchRow]) -> None:
+        """`batch_rows`の行から構築し直す. 構築中の状態は他のスレッドから見えない."""
+        rows = list(rows)
+        with self._lock:
+            self._clear(capacity=len(self._sku_ids))
+            for ref, sku, qty, eta, allocated in rows:
+                self._add_batch(ref, sku, qty, eta, allocated)
+            self.built_at = self.clock()
+
+    def needs_rebuild(self, max_age: float = DEFAULT_MAX_AGE) -> bool:
+        return self.built_at is None or self.clock() - self.built_at > max_age
+
+    def add_batch(self, ref: str, sku: str, qty: int, eta: Optional[date], allocated: int = 0) -> None:
+        with self._lock:
+            self._add_batch(ref, sku, qty, eta, allocated)
+
+    def _add_batch(self, ref: str, sku: str, qty: int, eta: Optional[date], allocated: int) -> None:
+        if ref in self._row_by_ref:
+            return
+        if self._size == len(self._sku_ids):
+            self._grow()
+        sku_id = self._sku_id_by_sku.get(sku)
+        if sku_id is None:
+            sku_id = self._sku_id_by_sku[sku] = len(self._skus)
+            self._skus.append(sku)
+        row = self._size
+        self._sku_ids[row] = sku_id
+        self._etas[row] = eta.toordinal() if eta is not None else _IN_STOCK
+        self._purchased[row] = qty
+        self._allocated[row] = allocated
+        self._refs.append(ref)
+        self._row_by_ref[ref] = row
+        self._size += 1
+
+    def _grow(self) -> None:
+        capacity = max(len(self._sku_ids) * 2, 1)
+        for name in ("_sku_ids", "_etas", "_purchased", "_allocated"):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            setattr(self, name, grown)
+
+    def apply(self, event: events.Event) -> None:
+        """domain eventを受け取り、該当するbatchの行を更新する. 未構築の間は何もしない."""
+        with self._lock:
+            if self.built_at is not None:
+                self._apply(event)
+
+    def _apply(self, event: events.Event) -> None:
+        if isinstance(event, events.BatchCreated):
+            self._add_batch(event.ref, event.sku, event.qty, event.eta, 0)
+        elif isinstance(event, events.BatchQuantityChanged):
+            row = self._row_by_ref.get(event.ref)
+            if row is not None:
+                self._purchased[row] = event.qty
+        elif isinstance(event, events.Allocated):
+            row = self._row_by_ref.get(event.batchref)
+            if row is not None:
+                self._allocated[row] += event.qty
+        elif isinstance(event, events.Deallocated):
+            row = self._row_by_ref.get(event.batchref)
+            if row is not None:
+                self._allocated[row] -= event.qty
+        elif isinstance(event, events.BatchArrived):
+            row = self._row_by_ref.get(event.ref)
+            if row is not None:
+                self._etas[row] = _IN_STOCK
+
+    def _available(self) -> np.ndarray:
+        return self._purchased[: self._size] - self._allocated[: self._size]
+
+    def available_by_sku(self) -> Dict[str, int]:
+        with self._lock:
+            totals = np.bincount(self._sku_ids[: self._size], weights=self._available(), minlength=len(self._skus))
+            return dict(zip(self._skus, totals.astype(np.int64).tolist()))
+
+    def earliest_allocatable(self, qty: int = 1) -> Dict[str, Optional[str]]:
+        """SKU毎に、`Product.allocate`と同じ優先順でqtyを割り当て可能な最初のbatchのrefを返す."""
+        with self._lock:
+            n = self._size
+            sku_ids, etas = self._sku_ids[:n], self._etas[:n]
+            order = np.lexsort((etas, sku_ids))  # sku -> eta(倉庫在庫が先頭) の順. 同順位は追加順を保つ.
+            order = order[self._available()[order] >= qty]
+            found_sku_ids, first = np.unique(sku_ids[order], return_index=True)
+            result: Dict[str, Optional[str]] = dict.fromkeys(self._skus)
+            for sku_id, row in zip(found_sku_ids.tolist(), order[first].tolist()):
+                result[self._skus[sku_id]] = self._refs[row]
+            return result
+
+    def stock_by_eta(self, bucket_edges: List[date]) -> Dict[str, List[int]]:
+        """SKU毎のETA別在庫. 先頭は倉庫在庫(eta=None)、以降は`bucket_edges`で区切ったETAの区間毎の数量."""
+        with self._lock:
+            n = self._size
+            edges = np.array([d.toordinal() for d in bucket_edges], dtype=np.int64)
+            etas = self._etas[:n]
+            buckets = np.where(etas == _IN_STOCK, 0, np.searchsorted(edges, etas, side="right") + 1)
+            n_buckets = len(edges) + 2
+            totals = np.bincount(
+                self._sku_ids[:n] * n_buckets + buckets,
+                weights=self._available(),
+                minlength=len(self._skus) * n_buckets,
+            ).reshape(len(self._skus), n_buckets)
+            return dict(zip(self._skus, totals.astype(np.int64).tolist()))
+
+
+DEFAULT_INDEX = AvailabilityIndex()
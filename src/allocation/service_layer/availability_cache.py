@@ -0,0 +1,113 @@
+"""SKU毎の在庫状況のキャッシュ. 店頭ページからの頻繁なポーリングにProductを読み込まずに応える.
+
+エントリはmessagebusのhandlerが在庫の変わるevent(BatchCreated, BatchQuantityChanged, Allocated, Deallocated)を
+受け取った時に無効化する. 他のワーカーで処理されたeventは届かないので、`ttl`秒で必ず読み直す.
+エントリ・batchref -> SKUの対応・無効化の世代は、いずれも`maxsize`程度までしか保持しない.
+"""
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from src.allocation.domain.model import Product
+
+
+@dataclass(frozen=True)
+class CachedAvailability:
+    body: dict
+    etag: str
+    cached_at: float
+
+
+def availability_view(product: Product) -> dict:
+    """割り当ての優先順に並べたbatch毎の利用可能数"""
+    batches = [
+        {
+            "ref": b.reference,
+            "available": b.available_quantity,
+            "eta": b.eta.isoformat() if b.eta is not None else None,
+        }
+        for b in product.batches_by_priority()
+    ]
+    return {"sku": product.sku, "available": sum(b["available"] for b in batches), "batches": batches}
+
+
+def etag_for(body: dict) -> str:
+    """内容から決まるETag. 無効化された後に読み直しても、内容が同じなら同じ値になる."""
+    return hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AvailabilityCache:
+    def __init__(self, maxsize: int = 10_000, ttl: float = 30.0, clock: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CachedAvailability]" = OrderedDict()
+        # キャッシュしているProductのbatchだけを覚える. 知らないbatchrefはhandlerがUoWで引く.
+        self._sku_by_batchref: Dict[str, str] = {}
+        self._batchrefs_by_sku: Dict[str, List[str]] = {}
+        # 無効化の度に全SKUで共通のカウンタから振る世代. 読み込み中に無効化された結果を、古いままキャッシュしない為に使う.
+        # maxsizeを超えたら古いものから捨て、捨てた中で最大の世代を、記録の無いSKUの世代(_floor)にする.
+        # (読み込み中のSKUの記録が捨てられても、_floorが読み込み開始時の値から進むので、その結果はキャッシュしない)
+        self._generations: "OrderedDict[str, int]" = OrderedDict()
+        self._counter = itertools.count(1)
+        self._floor = 0
+
+    def get(self, sku: str) -> Optional[CachedAvailability]:
+        with self._lock:
+            entry = self._entries.get(sku)
+            if entry is None:
+                return None
+            if self.clock() - entry.cached_at > self.ttl:
+                self._drop(sku)
+                return None
+            self._entries.move_to_end(sku)
+            return entry
+
+    def generation(self, sku: str) -> int:
+        with self._lock:
+            return self._generations.get(sku, self._floor)
+
+    def put(self, product: Product, generation: int) -> CachedAvailability:
+        body = availability_view(product)
+        entry = CachedAvailability(body, etag_for(body), self.clock())
+        with self._lock:
+            if self._generations.get(product.sku, self._floor) != generation:
+                return entry  # 読み込み中に無効化されたので、返すだけでキャッシュしない.
+            self._drop(product.sku)
+            self._entries[product.sku] = entry
+            refs = self._batchrefs_by_sku[product.sku] = [b.reference for b in product.batches]
+            for ref in refs:
+                self._sku_by_batchref[ref] = product.sku
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, sku: str) -> None:
+        with self._lock:
+            self._drop(sku)
+            self._generations[sku] = next(self._counter)
+            self._generations.move_to_end(sku)
+            while len(self._generations) > self.maxsize:
+                _, generation = self._generations.popitem(last=False)
+                self._floor = max(self._floor, generation)
+
+    def _drop(self, sku: str) -> None:
+        """ロックを保持した状態で呼ぶ. エントリと、そのbatchrefの対応を取り除く."""
+        self._entries.pop(sku, None)
+        for ref in self._batchrefs_by_sku.pop(sku, ()):
+            if self._sku_by_batchref.get(ref) == sku:
+                del self._sku_by_batchref[ref]
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        """キャッシュしたProductのbatchであれば、そのSKUを返す."""
+        with self._lock:
+            return self._sku_by_batchref.get(batchref)
+
+
+DEFAULT_CACHE = AvailabilityCache()
@@ -0,0 +1,106 @@
+"""ETAを過ぎたbatchを入荷したものとして扱う為のscheduler.
+
+出荷中のbatchのETAを最小ヒープで持ち、`due`でclockの日付までにETAを迎えたbatchのBatchArrivedを取り出す.
+BatchArrivedのhandlerがbatchを倉庫在庫(eta=None)に変え、集約の優先順もそのbatchの分だけ更新する.
+- ETAの変更・取り消しはヒープから探して消さず、取り出した時に最新の登録と一致しないものを捨てる(lazy deletion).
+- clockは注入できるので、テストでは実時間を待たずに日付を進められる.
+- `run_pending`は1件ずつ取り出して処理し、handlerが失敗したbatchは登録し直して次回に再試行する.
+"""
+import heapq
+import logging
+import threading
+from datetime import date
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.allocation.domain import events
+from src.allocation.domain.model import Product
+from src.allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class EtaScheduler:
+    def __init__(self, clock: Callable[[], date] = date.today) -> None:
+        self.clock = clock
+        self._heap: List[Tuple[date, str, str]] = []  # (eta, batchref, sku)
+        self._eta_by_ref: Dict[str, date] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._eta_by_ref)
+
+    def schedule(self, ref: str, sku: str, eta: date) -> None:
+        """batchの入荷予定を登録する. 同じbatchを登録し直した場合は新しいETAが有効になる."""
+        with self._lock:
+            self._eta_by_ref[ref] = eta
+            heapq.heappush(self._heap, (eta, ref, sku))
+            if len(self._heap) > 2 * len(self._eta_by_ref) + 1024:
+                self._heap = [entry for entry in self._heap if self._eta_by_ref.get(entry[1]) == entry[0]]
+                heapq.heapify(self._heap)
+
+    def schedule_products(self, products: Iterable[Product]) -> None:
+        """Productの出荷中のbatchを全て登録する(起動時など)."""
+        for product in products:
+            for batch in product.batches:
+                if batch.eta is not None:
+                    self.schedule(batch.reference, batch.sku, batch.eta)
+
+    def cancel(self, ref: str) -> None:
+        with self._lock:
+            self._eta_by_ref.pop(ref, None)
+
+    def next_eta(self) -> Optional[date]:
+        with self._lock:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def due(self) -> List[events.BatchArrived]:
+        """clockの日付までにETAを迎えたbatchを、ETAの早い順に取り出す."""
+        today = self.clock()
+        arrived = []
+        event = self._pop_due(today)
+        while event is not None:
+            arrived.append(event)
+            event = self._pop_due(today)
+        return arrived
+
+    def run_pending(self, uow: unit_of_work.AbstractUnitOfWork) -> List[events.BatchArrived]:
+        """ETAを迎えたbatchのBatchArrivedをmessagebusで処理し、処理できたeventを返す.
+        handlerが失敗したbatchはログに残して登録し直し、残りのbatchの処理を続ける."""
+        from src.allocation.service_layer import messagebus  # messagebus -> handler -> ... の循環importを避ける.
+
+        today = self.clock()
+        handled, failed = [], []
+        event = self._pop_due(today)
+        while event is not None:
+            try:
+                messagebus.handle(event, uow)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("failed to handle %s", event)
+                failed.append(event)
+            else:
+                handled.append(event)
+            event = self._pop_due(today)
+        for event in failed:
+            self._restore(event)
+        return handled
+
+    def _pop_due(self, today: date) -> Optional[events.BatchArrived]:
+        with self._lock:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > today:
+                return None
+            eta, ref, sku = heapq.heappop(self._heap)
+            del self._eta_by_ref[ref]
+            return events.BatchArrived(ref, sku, eta)
+
+    def _restore(self, event: events.BatchArrived) -> None:
+        """処理に失敗したbatchを登録し直す. 処理中に新しいETAで登録し直されていれば、そちらを優先する."""
+        with self._lock:
+            if event.ref not in self._eta_by_ref:
+                self._eta_by_ref[event.ref] = event.eta
+                heapq.heappush(self._heap, (event.eta, event.ref, event.sku))
+
+    def _discard_stale(self) -> None:
+        while self._heap and self._eta_by_ref.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
@@ -0,0 +1,123 @@
+"""SKU毎のgroup commit.
+
+同じSKUへの割り当て要求を短い時間窓(window)の間だけ集め、1つのProductに順に適用して1回でcommitする.
+N件の同時リクエストがN個のトランザクションとなり、1件以外がoptimistic lockingで衝突する事を避ける.
+同じSKUのグループは1つずつ実行され、実行中に到着した要求は次のグループとして集められる.
+"""
+import threading
+import zlib
+from typing import Any, Callable, Dict, Generic, List, Optional, TypeVar
+
+from sqlalchemy.exc import DBAPIError
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# PostgreSQLのSQLSTATE. REPEATABLE READでの直列化エラー(40001)とデッドロック(40P01)は、グループごとやり直せば解消する.
+# (version_numberはversion_id_colにマッピングしていないので、同じProductの同時更新はこの直列化エラーとして現れる)
+RETRYABLE_SQLSTATES = frozenset({"40001", "40P01"})
+
+
+def is_retryable(error: BaseException) -> bool:
+    """直列化エラー・デッドロックであればTrue. 接続断や構文エラー等の他のOperationalErrorはやり直さない."""
+    if not isinstance(error, DBAPIError):
+        return False
+    code = getattr(error.orig, "pgcode", None) or getattr(error.orig, "sqlstate", None)  # psycopg2 / psycopg 3
+    return code in RETRYABLE_SQLSTATES
+
+
+class _Group(Generic[T]):
+    def __init__(self) -> None:
+        self.items: List[T] = []
+        self.closed = False
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results: List[Any] = []
+        self.error: Optional[BaseException] = None
+
+
+class GroupCommitter(Generic[T, R]):
+    def __init__(
+        self,
+        run_batch: Callable[[List[T]], List[R]],
+        window: float = 0.002,
+        max_batch: int = 64,
+        max_retries: int = 3,
+        retry_if: Callable[[BaseException], bool] = is_retryable,
+        n_stripes: int = 64,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        run_batch : Callable[[List[T]], List[R]]
+            同じSKUの要求のリストを1つのUoWで処理し、同じ順で結果を返す関数
+        window : float, optional
+            最初の要求が届いてから、後続の要求を待つ秒数, by default 0.002
+        max_batch : int, optional
+            1グループの最大件数. 達した時点でwindowを待たずに実行する, by default 64
+        retry_if : Callable[[BaseException], bool], optional
+            グループごとやり直すエラーかどうか, by default is_retryable
+        """
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.retry_if = retry_if
+        self._lock = threading.Lock()
+        self._open: Dict[str, _Group] = {}
+        self.groups = 0  # 実行したグループの数
+        self.retries = 0  # 衝突によるやり直しの回数
+        # 同じSKUのグループを直列に実行する為のロック. SKU毎に作ると増え続けるのでハッシュで共有する.
+        self._run_locks = [threading.Lock() for _ in range(n_stripes)]
+
+    def submit(self, sku: str, item: T) -> R:
+        with self._lock:
+            group = self._open.get(sku)
+            is_leader = group is None
+            if is_leader:
+                group = self._open[sku] = _Group()
+            group.items.append(item)
+            index = len(group.items) - 1
+            if len(group.items) >= self.max_batch:
+                self._close(sku, group)
+
+        if is_leader:
+            self._lead(sku, group)
+        else:
+            group.done.wait()
+        if group.error is not None:
+            raise group.error
+        return group.results[index]
+
+    def _close(self, sku: str, group: _Group) -> None:
+        """ロックを保持した状態で呼ぶ. 以降の要求は新しいグループに入る."""
+        group.closed = True
+        group.full.set()
+        if self._open.get(sku) is group:
+            del self._open[sku]
+
+    def _lead(self, sku: str, group: _Group) -> None:
+        group.full.wait(self.window)
+        with self._run_locks[zlib.crc32(sku.encode("utf-8")) % len(self._run_locks)]:
+            # 前のグループの実行を待っている間も要求を集め続け、実行直前に締め切る.
+            with self._lock:
+                if not group.closed:
+                    self._close(sku, group)
+                self.groups += 1
+            try:
+                group.results = self._run_with_retries(list(group.items))
+            except Exception as e:  # 同じSKUのまとまりなので、エラーは全員に返す.
+                group.error = e
+            finally:
+                group.done.set()
+
+    def _run_with_retries(self, items: List[T]) -> List[R]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.run_batch(items)
+            except Exception as e:
+                if attempt == self.max_retries or not self.retry_if(e):
+                    raise
+                with self._lock:
+                    self.retries += 1
+        raise AssertionError("unreachable")
@@ -1,15 +1,27 @@
 from datetime import date
-from typing import List, Optional
+from typing import Callable, List, Optional, Tuple
 
+from src.allocation.config import get_reallocate_on_arrival
 from src.allocation.domain import events
 from src.allocation.domain.model import Batch, OrderLine, Product
-from src.allocation.service_layer import unit_of_work
+from src.allocation.service_layer import availability_cache, unit_of_work
 
 
 class InvalidSku(Exception):
     pass
 
 
+class InvalidBatchref(Exception):
+    pass
+
+
+def read_only(handler: Callable) -> Callable:
+    """データベースへ書き込まないhandlerである事を宣言する.
+    messagebusはこのhandlerに参照用のUoW(`uow.for_reads()`)を渡す."""
+    handler.read_only = True
+    return handler
+
+
 def is_valid_sku(sku: str, batches: List[Batch]) -> bool:
     return sku in {b.sku for b in batches}
 
@@ -21,6 +33,8 @@ def add_batch(event: events.BatchCreated, uow: unit_of_work.AbstractUnitOfWork):
         if product is None:
             product = Product(event.sku, batches=[])
             uow.products.add(product)
+        elif any(b.reference == event.ref for b in product.batches) or uow.products.is_archived(event.sku, event.ref):
+            return  # 再配信されたBatchCreated. (アーカイブ済みのbatchを含め)既にあるbatchは追加しない.
         product.batches.append(
             Batch(
                 event.ref,
@@ -32,6 +46,16 @@ def add_batch(event: events.BatchCreated, uow: unit_of_work.AbstractUnitOfWork):
         uow._commit()
 
 
+def _archived_batchref(line: OrderLine, uow: unit_of_work.AbstractUnitOfWork) -> Optional[str]:
+    """同じラインがアーカイブ済みのbatchに割り当てられていれば、そのbatchrefを返す(リトライ対策).
+    アーカイブされたラインは集約から見えないので、Product.allocateの確認だけでは二重に割り当ててしまう."""
+    archived = uow.products.archived_allocations(line.orderid, line.sku)
+    batchref = next((batchref for batchref, qty in archived if qty == line.qty), None)
+    if batchref is not None:
+        uow.products.events.append(events.AllocationConfirmed(line.orderid, line.sku, line.qty, batchref))
+    return batchref
+
+
 def allocate(
     event: events.AllocationRequired,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -42,13 +66,57 @@ def allocate(
     OrderLine型を受け取るのではなくprimitiveなデータ型を受け取る -> Domain への依存を切り離す為.
     """
     line = OrderLine(event.orderid, event.sku, event.qty)
+    with uow:
+        archived = _archived_batchref(line, uow)
+        if archived is not None:
+            return archived
+        uow.products.record(event)
+        # 単純な割り当てで済むなら、repositoryがProductを読み込まずに処理する. それ以外はドメインモデルで割り当てる.
+        batchref = uow.products.allocate_fast(line)
+        if batchref is None:
+            product = uow.products.get(sku=line.sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {line.sku}")
+            batchref = product.allocate(line)
+        uow._commit()
+    return batchref
+
+
+def allocate_split(
+    event: events.SplitAllocationRequired,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> Optional[List[Tuple[str, int]]]:
+    """1つのbatchで足りない場合に、複数のbatchへ分けて割り当てる事を許すallocate. (batchref, 数量)のリストを返す."""
+    line = OrderLine(event.orderid, event.sku, event.qty)
     with uow:
         product = uow.products.get(sku=line.sku)
         if product is None:
             raise InvalidSku(f"Invalid sku {line.sku}")
-        batchref = product.allocate(line)
+        uow.products.record(event)
+        allocations = product.allocate_split(line, archived=uow.products.archived_allocations(line.orderid, line.sku))
         uow._commit()
-    return batchref
+    return allocations
+
+
+def allocate_many(
+    batch: List[events.AllocationRequired],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Optional[str]]:
+    """同じSKUへの複数のオーダーラインを、1つのUoW・1回のcommitで順に割り当てる.
+    結果はbatchと同じ順で、割り当てられなかったラインはNone(OutOfStock)になる."""
+    sku = batch[0].sku
+    assert all(e.sku == sku for e in batch), "allocate_many expects lines for a single sku"
+    with uow:
+        product = uow.products.get(sku=sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {sku}")
+        batchrefs = []
+        for e in batch:
+            line = OrderLine(e.orderid, e.sku, e.qty)
+            uow.products.record(e)
+            batchrefs.append(_archived_batchref(line, uow) or product.allocate(line))
+        uow._commit()
+    return batchrefs
 
 
 def reallocate(line: OrderLine, uow: unit_of_work.AbstractUnitOfWork) -> str:
@@ -67,10 +135,25 @@ def change_batch_quantity(
 ):
     with uow:
         product = uow.products.get_by_batchref(batchref=event.ref)
+        if product is None:
+            raise InvalidBatchref(f"Invalid batchref {event.ref}")
         product.change_batch_quantity(ref=event.ref, qty=event.qty)
         uow.commit()
 
 
+def receive_batch(
+    event: events.BatchArrived,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    """ETAを過ぎたbatchを倉庫在庫として扱う. 設定によっては出荷中のbatchのラインを入荷したbatchへ移す."""
+    with uow:
+        product = uow.products.get_by_batchref(batchref=event.ref)
+        if product is None:
+            return
+        product.receive_batch(event.ref, reallocate=get_reallocate_on_arrival())
+        uow.commit()
+
+
 def send_out_of_stock_notification(
     event: events.OutOfStock,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -79,3 +162,34 @@ def send_out_of_stock_notification(
         "stock@made.com",
         f"Out of stock for {event.sku}",
     )
+
+
+@read_only
+def update_availability(
+    event: events.Event,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    """在庫のread model(AvailabilityIndex)を、発生したeventの分だけ更新する."""
+    # numpyの読み込みは重いので、最初にeventが届いた時点まで遅らせる.
+    from src.allocation.service_layer import availability
+
+    availability.DEFAULT_INDEX.apply(event)
+
+
+@read_only
+def invalidate_availability_cache(
+    event: events.Event,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    """在庫の変わったSKUを、SKU毎の在庫状況のキャッシュから取り除く. 次の問い合わせで読み直される.
+    BatchQuantityChangedにはSKUが無いので、キャッシュが知らないbatchであれば参照用のUoWで引く."""
+    cache = availability_cache.DEFAULT_CACHE
+    if isinstance(event, events.BatchQuantityChanged):
+        sku = cache.sku_for_batchref(event.ref)
+        if sku is None:
+            with uow:
+                sku = uow.products.sku_for_batchref(event.ref)
+        if sku is not None:
+            cache.invalidate(sku)
+    else:
+        cache.invalidate(event.sku)
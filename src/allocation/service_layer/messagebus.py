@@ -1,36 +1,103 @@
-from typing import Any, Callable, Dict, List, Type
+from typing import Any, Callable, Dict, List, Optional, Type, Union
 
+from src.allocation.adapters import broker
+from src.allocation.adapters.idempotency import IdempotencyCache
 from src.allocation.adapters.my_email import send_mail
 from src.allocation.domain import events
-from src.allocation.service_layer import handler, unit_of_work
+from src.allocation.service_layer import handler, profiling, unit_of_work
 
 
 def handle(
     event: events.Event,
     uow: unit_of_work.AbstractUnitOfWork,  # messagebusが起動する度にuowが渡されるようになった.
+    idempotency_key: Optional[str] = None,
+    idempotency_cache: Optional[IdempotencyCache] = None,
 ) -> List[Any]:
-    """messagebusの役割を持つ関数?"""
+    """messagebusの役割を持つ関数?
+    返り値は最初に渡されたeventに対するhandlerの結果のみ(後続eventのhandlerの結果は含まない).
+    idempotency keyが渡され、以前の結果がキャッシュにあれば、handlerもUoWも実行せずにその結果を返す.
+    """
+    use_cache = idempotency_key is not None and idempotency_cache is not None
+    if use_cache:
+        cached = idempotency_cache.get(idempotency_key)
+        if cached is not None:
+            return [cached]
+
+    with profiling.trace(f"messagebus.handle {type(event).__name__}"):
+        results = _dispatch(event, uow)
+    if use_cache and results and results[0] is not None:
+        idempotency_cache.put(idempotency_key, results[0])
+    return results
+
+
+def handle_allocations(
+    batch: List[events.AllocationRequired],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Optional[str]]:
+    """同じSKUへのAllocationRequiredをまとめて1つのUoWで処理し、後続のeventは通常通りhandlerへ流す."""
+    with profiling.trace("messagebus.handle_allocations"):
+        with profiling.span("allocate_many"):
+            results = handler.allocate_many(batch, uow)
+        for event in list(uow.collect_new_events()):
+            _dispatch(event, uow)
+    return results
+
+
+def _dispatch(event: events.Event, uow: unit_of_work.AbstractUnitOfWork) -> List[Any]:
     results = []
+    initial_event = event
     queue = [event]  # 最初のイベントの処理を開始するとき、キューを開始する.
     while queue:
         event = queue.pop(0)  # eventをqueueの先頭から取得し、対応するhandlerを呼び出す.
         for handler in HANDLERS[type(event)]:
-            results.append(handler(event, uow))  # messagebusは、UoWを各ハンドラに受け渡す.
+            # messagebusは、UoWを各ハンドラに受け渡す(参照のみのhandlerには参照用のUoWを渡す).
+            with profiling.span(f"{handler.__name__} {type(event).__name__}"):
+                result = handler(event, uow.for_reads() if getattr(handler, "read_only", False) else uow)
+            if event is initial_event:
+                results.append(result)
             queue.extend(uow.collect_new_events())  # 各ハンドラの終了後、新たに発生したeventを収集し、queue に追加する.
 
     return results
 
 
-def send_out_of_stock_notification(event: events.OutOfStock):
+@handler.read_only
+def send_out_of_stock_notification(
+    event: events.OutOfStock,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
     send_mail(
         "stock@made.com",
         f"Out of stock for {event.sku}",
     )
 
 
+@handler.read_only
+def publish_allocated_event(
+    event: Union[events.Allocated, events.AllocationConfirmed],
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    """割り当ての結果をmessage brokerへ発行する. commitの後に呼ばれる.
+    リトライで既に割り当て済みだった場合(AllocationConfirmed)も、Allocatedとして発行し直す.
+    (前回の発行がcommit後に失敗していても結果が失われない. 受け取る側は同じAllocatedの重複を許容する)"""
+    broker.publish(broker.OUTBOUND_STREAM, events.Allocated(event.orderid, event.sku, event.qty, event.batchref))
+
+
 HANDLERS: Dict[Type[events.Event], List[Callable]] = {
-    events.BatchCreated: [handler.add_batch],
-    events.BatchQuantityChanged: [handler.change_batch_quantity],
+    events.BatchCreated: [handler.add_batch, handler.update_availability, handler.invalidate_availability_cache],
+    events.BatchQuantityChanged: [
+        handler.change_batch_quantity,
+        handler.update_availability,
+        handler.invalidate_availability_cache,
+    ],
     events.AllocationRequired: [handler.allocate],
+    events.SplitAllocationRequired: [handler.allocate_split],
+    events.Allocated: [
+        handler.update_availability,
+        handler.invalidate_availability_cache,
+        publish_allocated_event,
+    ],
+    events.AllocationConfirmed: [publish_allocated_event],
+    events.Deallocated: [handler.update_availability, handler.invalidate_availability_cache],
     events.OutOfStock: [send_out_of_stock_notification],
+    events.BatchArrived: [handler.receive_batch, handler.update_availability, handler.invalidate_availability_cache],
 }
@@ -0,0 +1,320 @@
+"""opt-inのprofiling. リクエスト毎のspanのtraceと、stackのsampling.
+
+- 無効(既定)の間は、`trace`/`span`が共有の何もしないcontext managerを返すだけなので、ほぼコストがかからない.
+- `enable`すると、flaskのリクエスト・`messagebus.handle`の呼び出し毎にtraceを作り、
+  messagebusのhandler・UoWのcommit・SQLの実行をspanとして入れ子で記録する(bus -> handler -> UoW -> SQL).
+- sampling用のthreadが、trace中のthreadのstackを一定間隔で記録する.
+- 所要時間の長い上位N件のtraceだけを保持し、`flamegraph`でcollapsed stack形式(flamegraph.pl・speedscope用)に書き出す.
+"""
+import contextvars
+import heapq
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    end: float = 0.0
+    children: List["Span"] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    @property
+    def self_time(self) -> float:
+        return self.duration - sum(child.duration for child in self.children)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "duration_ms": round(self.duration * 1000, 3),
+            "children": [child.to_dict() for child in self.children],
+        }
+
+
+@dataclass
+class Trace:
+    root: Span
+    samples: Counter = field(default_factory=Counter)  # collapsed stack -> sample数
+
+    @property
+    def name(self) -> str:
+        return self.root.name
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration
+
+    def to_dict(self) -> dict:
+        return {**self.root.to_dict(), "samples": sum(self.samples.values())}
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("profiling_span", default=None)
+
+
+class _NullSpan:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+# samplingで対象外になったリクエストの間、_currentに置く印. 入れ子のtrace(messagebus.handle等)も記録しない.
+_SAMPLED_OUT = Span("sampled out", 0.0)
+
+
+class _SampledOutContext:
+    __slots__ = ("token",)
+
+    def __enter__(self) -> None:
+        self.token = _current.set(_SAMPLED_OUT)
+        return None
+
+    def __exit__(self, *exc) -> None:
+        _current.reset(self.token)
+
+
+class _SpanContext:
+    __slots__ = ("profiler", "name", "token", "span")
+
+    def __init__(self, profiler: "Profiler", name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self) -> Span:
+        self.span = Span(self.name, self.profiler.clock())
+        _current.get().children.append(self.span)
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc) -> None:
+        self.span.end = self.profiler.clock()
+        _current.reset(self.token)
+
+
+class _TraceContext:
+    __slots__ = ("profiler", "name", "token", "trace")
+
+    def __init__(self, profiler: "Profiler", name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self) -> Span:
+        self.trace = Trace(Span(self.name, self.profiler.clock()))
+        self.token = _current.set(self.trace.root)
+        self.profiler._active[threading.get_ident()] = self.trace
+        return self.trace.root
+
+    def __exit__(self, *exc) -> None:
+        self.trace.root.end = self.profiler.clock()
+        _current.reset(self.token)
+        self.profiler._active.pop(threading.get_ident(), None)
+        self.profiler._finish(self.trace)
+
+
+class Profiler:
+    def __init__(
+        self,
+        slowest_n: int = 20,
+        sample_rate: float = 1.0,
+        sample_interval: float = 0.005,
+        clock: Callable[[], float] = time.perf_counter,
+        rng: Callable[[], float] = random.random,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        slowest_n : int, optional
+            保持するtraceの数. 所要時間の長いものから残す, by default 20
+        sample_rate : float, optional
+            traceを取るリクエストの割合, by default 1.0
+        sample_interval : float, optional
+            stackをsamplingする間隔(秒), by default 0.005
+        """
+        self.slowest_n = slowest_n
+        self.sample_rate = sample_rate
+        self.sample_interval = sample_interval
+        self.clock = clock
+        self.rng = rng
+        self._slowest: List[Tuple[float, int, Trace]] = []  # 所要時間の最小ヒープ
+        self._seq = itertools.count()
+        self._active: Dict[int, Trace] = {}  # thread id -> trace中のTrace
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def trace(self, name: str):
+        """traceを開始する. 既にtrace中であれば、その中のspanになる.
+        samplingで対象外になった場合は、その中の入れ子のtraceも改めて抽選せずに記録しない."""
+        current = _current.get()
+        if current is _SAMPLED_OUT:
+            return _NULL_SPAN
+        if current is not None:
+            return _SpanContext(self, name)
+        if self.sample_rate < 1.0 and self.rng() >= self.sample_rate:
+            return _SampledOutContext()
+        return _TraceContext(self, name)
+
+    def span(self, name: str):
+        current = _current.get()
+        if current is None or current is _SAMPLED_OUT:
+            return _NULL_SPAN
+        return _SpanContext(self, name)
+
+    def _finish(self, trace: Trace) -> None:
+        entry = (trace.duration, next(self._seq), trace)
+        with self._lock:
+            if len(self._slowest) < self.slowest_n:
+                heapq.heappush(self._slowest, entry)
+            elif entry[0] > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self, n: Optional[int] = None) -> List[Trace]:
+        with self._lock:
+            traces = [trace for _, _, trace in sorted(self._slowest, reverse=True)]
+        return traces[:n]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._slowest.clear()
+
+    def sample_once(self) -> None:
+        """trace中の各threadのstackを1回ずつ記録する. samplesはflamegraph等が読むので、ロックを取って更新する."""
+        frames = sys._current_frames()
+        collected = []
+        for thread_id, trace in list(self._active.items()):
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            collected.append((trace, ";".join(reversed(stack))))
+        with self._lock:
+            for trace, stack in collected:
+                trace.samples[stack] += 1
+
+    def start_sampler(self) -> None:
+        if self._sampler is not None:
+            return
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._run_sampler, name="profiling-sampler", daemon=True)
+        self._sampler.start()
+
+    def stop_sampler(self) -> None:
+        if self._sampler is None:
+            return
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+
+    def _run_sampler(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            self.sample_once()
+
+    def flamegraph(self, n: Optional[int] = None, samples: bool = True) -> str:
+        """上位n件のtraceを、collapsed stack形式("frame;frame;... 値"の行)で返す.
+        samplesがTrueならstackのsample数、Falseならspanの自己時間(マイクロ秒)を値にする."""
+        folded: Counter = Counter()
+        for trace in self.slowest(n):
+            if samples:
+                with self._lock:
+                    counts = list(trace.samples.items())
+                for stack, count in counts:
+                    folded[f"{trace.name};{stack}"] += count
+            else:
+                _fold_spans(trace.root, "", folded)
+        return "".join(f"{stack} {value}\n" for stack, value in sorted(folded.items()) if value > 0)
+
+    def dump(self, n: Optional[int] = None) -> str:
+        traces = self.slowest(n)
+        with self._lock:
+            return json.dumps([trace.to_dict() for trace in traces])
+
+
+def _fold_spans(span: Span, prefix: str, folded: Counter) -> None:
+    path = f"{prefix};{span.name}" if prefix else span.name
+    folded[path] += round(span.self_time * 1_000_000)
+    for child in span.children:
+        _fold_spans(child, path, folded)
+
+
+_profiler: Optional[Profiler] = None
+
+
+def enable(profiler: Optional[Profiler] = None) -> Profiler:
+    """profilingを有効にする. SQLの実行をspanとして記録するhookを登録し、samplingを開始する."""
+    global _profiler
+    disable()
+    _profiler = profiler or Profiler()
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+    _profiler.start_sampler()
+    return _profiler
+
+
+def disable() -> None:
+    global _profiler
+    if _profiler is None:
+        return
+    _profiler.stop_sampler()
+    event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.remove(Engine, "handle_error", _handle_error)
+    _profiler = None
+
+
+def current() -> Optional[Profiler]:
+    return _profiler
+
+
+def trace(name: str):
+    """traceを開始する(flaskのリクエスト・messagebus.handle). profilingが無効なら何もしない."""
+    if _profiler is None:
+        return _NULL_SPAN
+    return _profiler.trace(name)
+
+
+def span(name: str):
+    """trace中であればspanを記録する. profilingが無効、またはtrace中でなければ何もしない."""
+    if _profiler is None:
+        return _NULL_SPAN
+    return _profiler.span(name)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    profiler = _profiler
+    if profiler is None:
+        return
+    span_context = profiler.span("sql: " + " ".join(statement.split())[:80])
+    span_context.__enter__()
+    conn.info.setdefault("profiling_spans", []).append(span_context)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    spans = conn.info.get("profiling_spans")
+    if spans:
+        spans.pop().__exit__(None, None, None)
+
+
+def _handle_error(exception_context) -> None:
+    connection = exception_context.connection
+    spans = connection.info.get("profiling_spans") if connection is not None else None
+    if spans:
+        spans.pop().__exit__(None, None, None)
@@ -0,0 +1,173 @@
+"""記録されたevent logをin-memoryのProductに対して直接再生するreplay/what-ifシミュレーション.
+
+messagebus と UoW を経由せずに、eventをProductのメソッドへ直接適用する.
+SKU毎にProduct(Aggregate)が独立しているので、SKUで分割して複数プロセスで並列に再生できる.
+"""
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import date
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from src.allocation.adapters.event_store import decode_events, encode_event
+from src.allocation.domain import events
+from src.allocation.domain.model import CountingBatch, OrderLine, Product
+
+EventTransform = Callable[[events.Event], events.Event]
+
+
+@dataclass
+class SimulationReport:
+    events_replayed: int = 0
+    lines_requested: int = 0
+    qty_requested: int = 0
+    qty_allocated: int = 0
+    out_of_stock: int = 0
+    reallocations: int = 0
+    unknown_batchrefs: int = 0  # 作成が記録されていないbatchへのBatchQuantityChanged(読み飛ばす)
+
+    @property
+    def fill_rate(self) -> float:
+        """最終状態で割り当てられている数量 / 要求された数量"""
+        return self.qty_allocated / self.qty_requested if self.qty_requested else 1.0
+
+    def merge(self, other: "SimulationReport") -> "SimulationReport":
+        return SimulationReport(
+            events_replayed=self.events_replayed + other.events_replayed,
+            lines_requested=self.lines_requested + other.lines_requested,
+            qty_requested=self.qty_requested + other.qty_requested,
+            qty_allocated=self.qty_allocated + other.qty_allocated,
+            out_of_stock=self.out_of_stock + other.out_of_stock,
+            reallocations=self.reallocations + other.reallocations,
+            unknown_batchrefs=self.unknown_batchrefs + other.unknown_batchrefs,
+        )
+
+
+def with_eta(ref: str, eta: Optional[date]) -> EventTransform:
+    """what-if用: 指定したbatchのETAを差し替えるtransform"""
+
+    def transform(event: events.Event) -> events.Event:
+        if isinstance(event, events.BatchCreated) and event.ref == ref:
+            return replace(event, eta=eta)
+        return event
+
+    return transform
+
+
+def read_event_log(path: Path) -> List[events.Event]:
+    """`write_event_log` のlog、またはEventStoreの `<sku>.events` を読む.
+    streamに記録された割り当ての結果(Allocated等)は、再生時には読み飛ばされる."""
+    return [e for e, _ in decode_events(memoryview(Path(path).read_bytes()))]
+
+
+def write_event_log(path: Path, history: Iterable[events.Event]) -> None:
+    Path(path).write_bytes(b"".join(encode_event(e, 0) for e in history))
+
+
+class Simulator:
+    """eventを順にin-memoryのProductへ適用し、結果を集計する."""
+
+    def __init__(self) -> None:
+        self.products: Dict[str, Product] = {}
+        self.sku_by_batchref: Dict[str, str] = {}
+        self.report = SimulationReport()
+
+    def replay(self, history: Iterable[events.Event]) -> SimulationReport:
+        products = self.products
+        report = self.report
+        for event in history:
+            report.events_replayed += 1
+            if isinstance(event, events.AllocationRequired):
+                report.lines_requested += 1
+                report.qty_requested += event.qty
+                product = products.get(event.sku)
+                if product is None:
+                    report.out_of_stock += 1
+                    continue
+                product.allocate(OrderLine(event.orderid, event.sku, event.qty))
+                self._drain(product)
+            elif isinstance(event, events.BatchCreated):
+                product = products.get(event.sku)
+                if product is None:
+                    product = products[event.sku] = Product(event.sku, batches=[])
+                product.batches.append(CountingBatch(event.ref, event.sku, event.qty, event.eta))
+                self.sku_by_batchref[event.ref] = event.sku
+            elif isinstance(event, events.BatchQuantityChanged):
+                sku = self.sku_by_batchref.get(event.ref)
+                if sku is None:
+                    report.unknown_batchrefs += 1
+                    continue
+                product = products[sku]
+                product.change_batch_quantity(ref=event.ref, qty=event.qty)
+                self._drain(product)
+        report.qty_allocated = sum(b.allocated_quantity for p in products.values() for b in p.batches)
+        return report
+
+    def _drain(self, product: Product) -> None:
+        """Productが発行したeventを、messagebusの代わりにその場で集計する."""
+        report = self.report
+        while product.events:
+            event = product.events.pop(0)
+            if isinstance(event, events.OutOfStock):
+                report.out_of_stock += 1
+            elif isinstance(event, events.Deallocated):
+                report.reallocations += 1  # 外されたラインはProduct内で再割り当て済み.
+
+
+def _replay_partition(history: List[events.Event]) -> SimulationReport:
+    return Simulator().replay(history)
+
+
+def partition_by_sku(history: Iterable[events.Event], n_partitions: int) -> List[List[events.Event]]:
+    """SKU毎の順序を保ったままeventをn個に分割する. BatchQuantityChangedはrefからSKUを引く.
+    作成が記録されていないrefは、再生時に数えられる様に先頭のpartitionへ入れる."""
+    partitions: List[List[events.Event]] = [[] for _ in range(n_partitions)]
+    sku_by_batchref: Dict[str, str] = {}
+    for event in history:
+        if isinstance(event, events.BatchQuantityChanged):
+            sku = sku_by_batchref.get(event.ref)
+            if sku is None:
+                partitions[0].append(event)
+                continue
+        else:
+            sku = event.sku
+            if isinstance(event, events.BatchCreated):
+                sku_by_batchref[event.ref] = sku
+        partitions[zlib.crc32(sku.encode("utf-8")) % n_partitions].append(event)
+    return partitions
+
+
+def simulate(
+    history: Iterable[events.Event],
+    transforms: Iterable[EventTransform] = (),
+    processes: int = 1,
+) -> SimulationReport:
+    """event logを(transformを適用した上で)再生し、fill rate等のレポートを返す.
+
+    Parameters
+    ----------
+    history : Iterable[events.Event]
+        記録されたevent log
+    transforms : Iterable[EventTransform], optional
+        what-if用に各eventを書き換える関数(例: `with_eta`)
+    processes : int, optional
+        2以上の場合、SKUで分割して複数プロセスで再生する, by default 1
+    """
+    transforms = list(transforms)
+    if transforms:
+        history = (_apply_transforms(e, transforms) for e in history)
+    if processes <= 1:
+        return Simulator().replay(history)
+
+    report = SimulationReport()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for partial in pool.map(_replay_partition, partition_by_sku(history, processes)):
+            report = report.merge(partial)
+    return report
+
+
+def _apply_transforms(event: events.Event, transforms: List[EventTransform]) -> events.Event:
+    for transform in transforms:
+        event = transform(event)
+    return event
@@ -1,19 +1,37 @@
 import abc
-from typing import Iterator
+import functools
+import threading
+from typing import Callable, Dict, Iterator, Optional
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
 
-from src.allocation.adapters.repository import AbstractRepository, SqlAlchemyRepository
-from src.allocation.config import get_postgres_uri
+from src.allocation.adapters.event_store import EventStore
+from src.allocation.adapters.replicas import ReplicaPool
+from src.allocation.adapters.repository import (
+    AbstractRepository,
+    EventStoreRepository,
+    InMemoryRepository,
+    InMemoryStore,
+    SqlAlchemyRepository,
+)
+from src.allocation.adapters.sharding import BatchrefDirectory, ConsistentHashRing, ShardedSqlAlchemyRepository
+from src.allocation.config import get_allocation_fast_path, get_database_uri, get_replica_uris
 from src.allocation.domain import events
+from src.allocation.service_layer import profiling
+
+
+class ReadOnlyUnitOfWorkError(Exception):
+    pass
 
 
 class AbstractUnitOfWork(abc.ABC):
     """Abstract Base Class(クラスが何をする必要があるのかを明示的に示す為に作る)"""
 
     products: AbstractRepository  # このpropertyによってbatchesリポジトリにアクセスできる.
+    read_only: bool = False
 
     def __enter__(self) -> "AbstractUnitOfWork":
         """context managerの為のmethod.
@@ -32,11 +50,17 @@ class AbstractUnitOfWork(abc.ABC):
         self._commit()
         self.collect_new_events()
 
+    def for_reads(self) -> "AbstractUnitOfWork":
+        """参照のみを行うhandlerに渡すUoW. 既定では自分自身を返す."""
+        return self
+
     def collect_new_events(self) -> Iterator[events.Event]:
         """各Product(Aggregate)クラス毎に溜まったEventを取得する."""
         for product in self.products.seen:
             while product.events:
                 yield product.events.pop(0)  # eventsの先頭から(queue的な取り出し方)
+        while self.products.events:
+            yield self.products.events.pop(0)
 
     @abc.abstractmethod
     def _commit(self):
@@ -48,23 +72,110 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-    )
+class LazySessionFactory:
+    """初めて呼び出された時にengineとsessionmakerを作るsession factory.
+    import時にDBドライバの読み込みや接続プールの作成を行わない様にする為のもの."""
+
+    def __init__(self, build: Callable[[], sessionmaker]) -> None:
+        self._build = build
+        self._factory: Optional[sessionmaker] = None
+        self._lock = threading.Lock()
+
+    @property
+    def factory(self) -> sessionmaker:
+        if self._factory is None:
+            with self._lock:
+                if self._factory is None:
+                    self._factory = self._build()
+        return self._factory
+
+    def __call__(self, **kwargs) -> Session:
+        return self.factory(**kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def primary_engine() -> Engine:
+    uri = get_database_uri()
+    if uri.startswith("sqlite"):
+        # ローカルでの負荷試験用. SQLiteは書き込みを直列化するので、分離レベルは指定しない.
+        return create_engine(uri, connect_args={"check_same_thread": False, "timeout": 30})
+    return create_engine(uri, isolation_level="REPEATABLE READ")
+
+
+def _read_engine() -> Engine:
+    engine = primary_engine()
+    if engine.dialect.name == "sqlite":
+        return engine
+    return engine.execution_options(isolation_level="READ COMMITTED")
+
+
+def _replica_session_factory(uri: str) -> sessionmaker:
+    return sessionmaker(bind=create_engine(uri, isolation_level="READ COMMITTED"))
+
+
+DEFAULT_SESSION_FACTORY = LazySessionFactory(lambda: sessionmaker(bind=primary_engine()))
+# 参照のみの場合は、primaryの接続プールを共有しつつ軽い分離レベルを使う.
+DEFAULT_READ_SESSION_FACTORY = LazySessionFactory(lambda: sessionmaker(bind=_read_engine()))
+DEFAULT_REPLICA_POOL = ReplicaPool(
+    [LazySessionFactory(functools.partial(_replica_session_factory, uri)) for uri in get_replica_uris()]
 )
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY) -> None:
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        read_only: bool = False,
+        replicas: ReplicaPool = DEFAULT_REPLICA_POOL,
+        max_staleness: Optional[float] = None,
+        read_session_factory=None,
+        fast_path: Optional[bool] = None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        read_only : bool, optional
+            Trueの場合はreplicaに振り分け、flushもcommitもしない, by default False
+        max_staleness : Optional[float], optional
+            read_only時に許容するreplicaの遅延(秒). これを超えるreplicaしかなければprimaryを使う.
+            Noneなら遅延を確認しない, by default None
+        read_session_factory : optional
+            read_only時に、遅延の許容できるreplicaが無い場合に使うsession factory.
+            Noneならsession_factoryと同じデータベースを使う(既定のsession_factoryならDEFAULT_READ_SESSION_FACTORY),
+            by default None
+        fast_path : Optional[bool], optional
+            単純な割り当てをSQLで直接処理するか. Noneなら環境変数(ALLOCATION_FAST_PATH)に従う, by default None
+        """
         self.session_factory = session_factory
+        self.read_only = read_only
+        self.replicas = replicas
+        self.max_staleness = max_staleness
+        if read_session_factory is None:
+            is_default = session_factory is DEFAULT_SESSION_FACTORY
+            read_session_factory = DEFAULT_READ_SESSION_FACTORY if is_default else session_factory
+        self.read_session_factory = read_session_factory
+        self.fast_path = get_allocation_fast_path() if fast_path is None else fast_path
+
+    def for_reads(self) -> "SqlAlchemyUnitOfWork":
+        if self.read_only:
+            return self
+        return SqlAlchemyUnitOfWork(
+            self.session_factory,
+            read_only=True,
+            replicas=self.replicas,
+            max_staleness=self.max_staleness,
+            read_session_factory=self.read_session_factory,
+        )
 
     def __enter__(self):
         """データベースセッションを開始し、そのセッションを使用できる
         実際のリポジトリのインスタンスを作成する役割を担う"""
-        self.session: Session = self.session_factory()
-        self.batches = SqlAlchemyRepository(self.session)
+        if self.read_only:
+            factory = self.replicas.pick(self.max_staleness) or self.read_session_factory
+            self.session: Session = factory(autoflush=False)
+        else:
+            self.session = self.session_factory()
+        self.products = SqlAlchemyRepository(self.session, fast_path=self.fast_path and not self.read_only)
         return super().__enter__()
 
     def __exit__(self, *args):
@@ -72,7 +183,94 @@ class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
         self.session.close()
 
     def _commit(self):
-        self.session.commit()
+        if self.read_only:
+            raise ReadOnlyUnitOfWorkError("cannot commit a read-only unit of work")
+        with profiling.span("uow.commit"):
+            self.session.commit()
 
     def rollback(self):
         self.session.rollback()
+
+
+class EventStoreUnitOfWork(AbstractUnitOfWork):
+    """EventStoreをbackendにするUnit of Work. commit時にProductの変更をeventとして追記する."""
+
+    def __init__(self, store: EventStore) -> None:
+        self.store = store
+        self.products = EventStoreRepository(self.store)
+
+    def __enter__(self):
+        self.products = EventStoreRepository(self.store)
+        return super().__enter__()
+
+    def _commit(self):
+        self.products.save_changes()
+
+    def rollback(self):
+        # 未commitの変更はこのUoWのidentity mapにしか存在しないので、破棄されるだけでよい.
+        pass
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    """プロセス内のInMemoryStoreをbackendにするUnit of Work. シミュレーションや負荷試験で、データベースの代わりに使う.
+    同じstoreを共有するUoW同士はスレッドをまたいで使え、同じProductを同時に変更した場合は後のcommitが失敗する."""
+
+    def __init__(self, store: Optional[InMemoryStore] = None) -> None:
+        self.store = store if store is not None else InMemoryStore()
+        self.products = InMemoryRepository(self.store)
+
+    def __enter__(self):
+        self.products = InMemoryRepository(self.store)
+        return super().__enter__()
+
+    def _commit(self):
+        self.products.commit()
+
+    def rollback(self):
+        self.products.rollback()
+
+
+class ShardedSqlAlchemyUnitOfWork(AbstractUnitOfWork):
+    """SKUをconsistent hashingで複数のデータベースへ振り分けるUnit of Work.
+    shard毎のsessionは、そのshardのProductに初めて触れた時に開始する."""
+
+    def __init__(self, session_factories: Dict[str, sessionmaker], directory_session_factory: Optional[sessionmaker] = None):
+        self.session_factories = session_factories
+        self.ring = ConsistentHashRing(session_factories)
+        # ディレクトリの置き場所が指定されなければ、先頭のshardに置く.
+        self.directory = BatchrefDirectory(directory_session_factory or next(iter(session_factories.values())))
+
+    def __enter__(self):
+        self.sessions: Dict[str, Session] = {}
+        self.products = ShardedSqlAlchemyRepository(self._session_for_shard, self.ring, self.directory)
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        for session in self.sessions.values():
+            session.close()
+
+    def _session_for_shard(self, shard_name: str) -> Session:
+        if shard_name not in self.sessions:
+            self.sessions[shard_name] = self.session_factories[shard_name]()
+        return self.sessions[shard_name]
+
+    def _commit(self):
+        # ディレクトリを先に登録しておけば、batchが見つからない事はあっても、refが迷子になる事はない.
+        # shardのcommitに失敗したら、そのshardのSKUについて登録したrefを取り消す(登録は同じSKUなら冪等なので、
+        # 取り消しに失敗して残っても、リトライで登録し直せる).
+        registered = self.products.register_new_batchrefs()
+        committed = set()
+        try:
+            for shard_name, session in self.sessions.items():
+                session.commit()
+                committed.add(shard_name)
+        except Exception:
+            self.directory.unregister(
+                ref for sku, refs in registered.items() if self.ring.shard_for(sku) not in committed for ref in refs
+            )
+            raise
+
+    def rollback(self):
+        for session in self.sessions.values():
+            session.rollback()
@@ -0,0 +1,78 @@
+# pylint: disable=redefined-outer-name
+from datetime import date, timedelta
+
+import pytest
+from hypothesis import HealthCheck, given, settings
+from hypothesis import strategies as st
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.domain import events, model
+from src.allocation.service_layer import handler, unit_of_work
+
+today = date(2021, 1, 1)
+
+
+@pytest.fixture
+def mappers():
+    start_mappers()
+    yield
+    clear_mappers()
+
+
+def make_db(batches, existing_lines):
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    product = model.Product(
+        "LAMP",
+        [
+            model.Batch(f"b{i}", "LAMP", qty, today + timedelta(days=eta) if eta is not None else None)
+            for i, (eta, qty) in enumerate(batches)
+        ],
+    )
+    for orderid, qty in existing_lines:  # OrderLineもマッピングされるので、データベース毎に作る.
+        product.allocate(model.OrderLine(orderid, "LAMP", qty))
+    session.add(product)
+    session.commit()
+    session.close()
+    return session_factory
+
+
+def state(session_factory):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory, fast_path=False) as uow:
+        product = uow.products.get("LAMP")
+        return product.version_number, {b.reference: b.available_quantity for b in product.batches}
+
+
+def allocate(session_factory, orderid, qty, fast_path):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, fast_path=fast_path)
+    batchref = handler.allocate(events.AllocationRequired(orderid, "LAMP", qty), uow)
+    return batchref, list(uow.collect_new_events())
+
+
+@settings(max_examples=100, deadline=None, suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(
+    batches=st.lists(st.tuples(st.one_of(st.none(), st.integers(0, 3)), st.integers(0, 20)), max_size=5),
+    existing_qtys=st.lists(st.integers(1, 8), max_size=6),
+    qty=st.integers(1, 12),
+    retry=st.booleans(),
+)
+def test_fast_path_matches_the_domain_model(mappers, batches, existing_qtys, qty, retry):
+    existing = [(f"o{i}", q) for i, q in enumerate(existing_qtys)]
+    orderid, qty = existing[-1] if retry and existing else ("new-order", qty)
+
+    via_domain, via_sql = make_db(batches, existing), make_db(batches, existing)
+    assert allocate(via_sql, orderid, qty, fast_path=True) == allocate(via_domain, orderid, qty, fast_path=False)
+    assert state(via_sql) == state(via_domain)
+
+
+def test_fast_path_does_not_load_the_product(mappers):
+    session_factory = make_db([(None, 10), (1, 10)], [])
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory, fast_path=True) as uow:
+        assert uow.products.allocate_fast(model.OrderLine("o1", "LAMP", 4)) == "b0"
+        assert uow.products.seen == set()
+        uow.commit()
+    assert state(session_factory) == (1, {"b0": 6, "b1": 10})
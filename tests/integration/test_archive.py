@@ -0,0 +1,110 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters import archive
+from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.domain import events
+from src.allocation.service_layer import messagebus, unit_of_work
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'archive.db'}")
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+def load(session_factory, sku):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get(sku)
+        return product.version_number, {b.reference: b.available_quantity for b in product.batches}
+
+
+def test_compaction_moves_exhausted_batches_out_of_the_aggregate(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    for i in range(5):
+        messagebus.handle(events.BatchCreated(f"b{i}", "LAMP", 10, None), uow)
+    for i in range(4):
+        messagebus.handle(events.AllocationRequired(f"o{i}", "LAMP", 10), uow)
+    messagebus.handle(events.AllocationRequired("o-partial", "LAMP", 3), uow)
+    version_before, _ = load(session_factory, "LAMP")
+
+    assert archive.compact(session_factory, chunk_size=3) == 4
+
+    version, batches = load(session_factory, "LAMP")
+    assert batches == {"b4": 7}
+    assert version > version_before
+    session = session_factory()
+    assert session.execute("SELECT COUNT(*) FROM archived_batches").scalar() == 4
+    assert session.execute("SELECT COUNT(*) FROM archived_allocations").scalar() == 4
+    assert session.execute("SELECT COUNT(*) FROM order_lines").scalar() == 1
+    assert archive.compact(session_factory) == 0
+
+
+def test_changing_an_archived_batch_restores_it(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+    messagebus.handle(events.BatchCreated("b2", "LAMP", 50, None), uow)
+    messagebus.handle(events.AllocationRequired("o1", "LAMP", 10), uow)
+    assert archive.compact(session_factory) == 1
+
+    messagebus.handle(events.BatchQuantityChanged("b1", 5), uow)
+
+    _, batches = load(session_factory, "LAMP")
+    assert batches == {"b1": 5, "b2": 40}  # o1はb2へ再割り当てされる.
+
+
+def test_redelivered_allocation_of_an_archived_line_is_not_allocated_again(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+    messagebus.handle(events.BatchCreated("b2", "LAMP", 50, None), uow)
+    [batchref] = messagebus.handle(events.AllocationRequired("o1", "LAMP", 10), uow)
+    assert archive.compact(session_factory) == 1
+
+    assert messagebus.handle(events.AllocationRequired("o1", "LAMP", 10), uow) == [batchref]
+
+    _, batches = load(session_factory, "LAMP")
+    assert batches == {"b2": 50}
+
+
+def test_batches_restocked_after_selection_are_not_archived(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+    messagebus.handle(events.AllocationRequired("o1", "LAMP", 10), uow)
+    session = session_factory()
+    batch_ids = archive.exhausted_batch_ids(session)
+    messagebus.handle(events.BatchQuantityChanged("b1", 20), uow)
+
+    assert archive.archive_batches(session, batch_ids, 0.0) == []
+    session.commit()
+
+    _, batches = load(session_factory, "LAMP")
+    assert batches == {"b1": 10}
+
+
+def test_ids_of_archived_rows_are_not_reused(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+    messagebus.handle(events.AllocationRequired("o1", "LAMP", 10), uow)
+    assert archive.compact(session_factory) == 1
+
+    messagebus.handle(events.BatchCreated("b2", "LAMP", 10, None), uow)
+    messagebus.handle(events.AllocationRequired("o2", "LAMP", 10), uow)
+    assert archive.compact(session_factory) == 1
+    assert session_factory().execute("SELECT COUNT(*) FROM archived_allocations").scalar() == 2
+
+
+def test_redelivered_batch_created_of_an_archived_batch_is_ignored(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+    messagebus.handle(events.AllocationRequired("o1", "LAMP", 10), uow)
+    assert archive.compact(session_factory) == 1
+
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+
+    _, batches = load(session_factory, "LAMP")
+    assert batches == {}
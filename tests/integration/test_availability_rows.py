@@ -0,0 +1,43 @@
+# pylint: disable=redefined-outer-name
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.domain import events
+from src.allocation.service_layer import availability, messagebus, unit_of_work
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'availability.db'}")
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+def test_index_built_from_aggregate_rows_matches_products(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    for event in [
+        events.BatchCreated("shipment", "BLUE-VASE", 20, date(2021, 1, 2)),
+        events.BatchCreated("in-stock", "BLUE-VASE", 10, None),
+        events.BatchCreated("empty", "RED-VASE", 5, None),
+        events.AllocationRequired("o1", "BLUE-VASE", 4),
+        events.AllocationRequired("o2", "BLUE-VASE", 3),
+        events.AllocationRequired("o3", "BLUE-VASE", 8),
+    ]:
+        messagebus.handle(event, uow)
+
+    from_rows = availability.AvailabilityIndex()
+    from_rows.rebuild_from_rows(availability.batch_rows(session_factory()))
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as check:
+        from_products = availability.AvailabilityIndex.from_products(
+            [check.products.get("BLUE-VASE"), check.products.get("RED-VASE")]
+        )
+
+    assert from_rows.available_by_sku() == from_products.available_by_sku() == {"BLUE-VASE": 15, "RED-VASE": 5}
+    assert from_rows.earliest_allocatable(qty=5) == from_products.earliest_allocatable(qty=5)
+    assert from_rows.stock_by_eta([date(2021, 1, 1)]) == from_products.stock_by_eta([date(2021, 1, 1)])
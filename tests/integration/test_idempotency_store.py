@@ -0,0 +1,16 @@
+from sqlalchemy.orm import sessionmaker
+
+from src.allocation.adapters import idempotency
+
+
+def test_sqlalchemy_store_is_shared_and_ignores_duplicates(in_memory_db):
+    store = idempotency.SqlAlchemyIdempotencyStore(sessionmaker(bind=in_memory_db))
+    store.put("o1:abc", "batch1", created_at=100.0)
+    store.put("o1:abc", "batch2", created_at=101.0)
+
+    assert store.get("o1:abc", min_created_at=50.0) == "batch1"
+    assert store.get("o1:abc", min_created_at=150.0) is None
+    assert store.get("missing", min_created_at=0.0) is None
+
+    store.purge(older_than=150.0)
+    assert store.get("o1:abc", min_created_at=0.0) is None
@@ -0,0 +1,106 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.adapters.replicas import ReplicaPool, postgres_replication_lag
+from src.allocation.domain import model
+from src.allocation.service_layer import unit_of_work
+
+
+def make_db(path, sku):
+    engine = create_engine(f"sqlite:///{path}")
+    metadata.create_all(engine)
+    engine.execute("INSERT INTO products (sku, version_number) VALUES (:sku, 0)", sku=sku)
+    return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def dbs(tmp_path):
+    start_mappers()
+    # primaryとreplicaに別々のSKUを入れて、どちらから読んだのかを区別する.
+    yield make_db(tmp_path / "primary.db", "ON-PRIMARY"), make_db(tmp_path / "replica.db", "ON-REPLICA")
+    clear_mappers()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def read_skus(uow):
+    with uow:
+        return [p.sku for p in uow.session.query(model.Product).all()]
+
+
+def test_read_only_uow_reads_from_replica(dbs):
+    primary, replica = dbs
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary, read_only=True, replicas=ReplicaPool([replica]))
+    assert read_skus(uow) == ["ON-REPLICA"]
+
+
+def test_read_only_uow_cannot_commit(dbs):
+    primary, replica = dbs
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary, read_only=True, replicas=ReplicaPool([replica]))
+    with pytest.raises(unit_of_work.ReadOnlyUnitOfWorkError):
+        with uow:
+            uow.products.add(model.Product("NEW", batches=[]))
+            uow.commit()
+
+
+def test_falls_back_to_primary_when_replica_lags(dbs):
+    primary, replica = dbs
+    lags = [30.0]
+    clock = FakeClock()
+    pool = ReplicaPool([replica], lag_probe=lambda session: lags[0], lag_ttl=1.0, clock=clock)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        primary, read_only=True, replicas=pool, max_staleness=5.0, read_session_factory=primary
+    )
+    assert read_skus(uow) == ["ON-PRIMARY"]
+
+    lags[0] = 0.5
+    assert read_skus(uow) == ["ON-PRIMARY"]  # 計測結果はlag_ttlの間キャッシュされる.
+    clock.now += 2
+    assert read_skus(uow) == ["ON-REPLICA"]
+
+
+def test_for_reads_keeps_configuration(dbs):
+    primary, replica = dbs
+    pool = ReplicaPool([replica])
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary, replicas=pool, max_staleness=3.0)
+    reader = uow.for_reads()
+    assert reader.read_only and not uow.read_only
+    assert reader.replicas is pool and reader.max_staleness == 3.0
+    assert reader.for_reads() is reader
+
+
+def test_read_only_uow_without_replicas_uses_the_given_session_factory(dbs):
+    primary, _ = dbs
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary, read_only=True, replicas=ReplicaPool([]))
+    assert uow.read_session_factory is primary
+    assert read_skus(uow) == ["ON-PRIMARY"]
+    assert read_skus(unit_of_work.SqlAlchemyUnitOfWork(primary).for_reads()) == ["ON-PRIMARY"]
+
+
+class FakeLagSession:
+    """postgres_replication_lagの問い合わせに(pg_is_in_recovery, 受信LSN=適用LSN, 経過秒数)を返す."""
+
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, query):
+        return self
+
+    def one(self):
+        return self.row
+
+
+def test_idle_replica_that_replayed_everything_is_not_lagging():
+    # primaryに書き込みが無い間は、最後のトランザクションからの経過秒数だけが増える.
+    assert postgres_replication_lag(FakeLagSession((True, True, 3600.0))) == 0.0
+    assert postgres_replication_lag(FakeLagSession((True, False, 12.5))) == 12.5
+    assert postgres_replication_lag(FakeLagSession((False, None, None))) == 0.0  # primary
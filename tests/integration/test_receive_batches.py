@@ -0,0 +1,58 @@
+# pylint: disable=redefined-outer-name
+import threading
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.domain import events
+from src.allocation.entrypoints import receive_batches
+from src.allocation.entrypoints.receive_batches import schedule_new_batches
+from src.allocation.service_layer import messagebus, unit_of_work
+from src.allocation.service_layer.eta_scheduler import EtaScheduler
+
+today = date(2021, 1, 1)
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+def test_arrivals_are_persisted_as_warehouse_stock(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, today + timedelta(days=1)), uow)
+    messagebus.handle(events.BatchCreated("b2", "LAMP", 10, None), uow)
+    scheduler = EtaScheduler(lambda: today + timedelta(days=1))
+
+    last_id = schedule_new_batches(session_factory(), scheduler)
+    assert schedule_new_batches(session_factory(), scheduler, last_id) == last_id
+    assert len(scheduler) == 1
+    assert [e.ref for e in scheduler.run_pending(uow)] == ["b1"]
+
+    session = session_factory()
+    assert session.execute("SELECT reference, eta FROM batches ORDER BY id").all() == [("b1", None), ("b2", None)]
+    assert session.execute("SELECT version_number FROM products").scalar() == 1
+
+
+def test_run_loop_survives_a_failed_poll(session_factory, monkeypatch):
+    stop = threading.Event()
+    polls = []
+
+    class FlakyScheduler(EtaScheduler):
+        def run_pending(self, uow):
+            polls.append(uow)
+            if len(polls) == 1:
+                raise ConnectionError("database went away")
+            stop.set()
+            return []
+
+    monkeypatch.setattr(unit_of_work, "DEFAULT_SESSION_FACTORY", session_factory)
+    receive_batches.run(FlakyScheduler(), stop, poll_interval=0)
+    assert len(polls) == 2
@@ -0,0 +1,182 @@
+# pylint: disable=redefined-outer-name
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters import archive, sharding
+from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.domain import events
+from src.allocation.service_layer import messagebus, unit_of_work
+
+
+def make_shards(tmp_path, n):
+    factories = {}
+    for i in range(n):
+        engine = create_engine(f"sqlite:///{tmp_path / f'shard{i}.db'}")
+        metadata.create_all(engine)
+        factories[f"shard{i}"] = sessionmaker(bind=engine)
+    return factories
+
+
+@pytest.fixture
+def shards(tmp_path):
+    start_mappers()
+    yield make_shards(tmp_path, 3)
+    clear_mappers()
+
+
+def count_products(factory):
+    return factory().execute("SELECT COUNT(*) FROM products").scalar()
+
+
+def test_ring_is_deterministic_and_spreads_skus():
+    ring = sharding.ConsistentHashRing(["shard0", "shard1", "shard2"])
+    owners = [ring.shard_for(f"sku{i}") for i in range(300)]
+    assert owners == [ring.shard_for(f"sku{i}") for i in range(300)]
+    assert set(owners) == {"shard0", "shard1", "shard2"}
+
+
+def test_adding_a_shard_moves_only_a_fraction_of_skus():
+    before = sharding.ConsistentHashRing(["shard0", "shard1", "shard2"])
+    after = sharding.ConsistentHashRing(["shard0", "shard1", "shard2", "shard3"])
+    skus = [f"sku{i}" for i in range(1000)]
+    moved = [sku for sku in skus if before.shard_for(sku) != after.shard_for(sku)]
+    assert all(after.shard_for(sku) == "shard3" for sku in moved)
+    assert len(moved) < 400
+
+
+def test_products_are_routed_to_their_shard_and_found_by_batchref(shards):
+    uow = unit_of_work.ShardedSqlAlchemyUnitOfWork(shards)
+    skus = [f"SKU-{i}" for i in range(12)]
+    for sku in skus:
+        messagebus.handle(events.BatchCreated(f"{sku}-batch", sku, 100, None), uow)
+        messagebus.handle(events.AllocationRequired(f"{sku}-order", sku, 10), uow)
+
+    ring = sharding.ConsistentHashRing(shards)
+    for name, factory in shards.items():
+        expected = len([sku for sku in skus if ring.shard_for(sku) == name])
+        assert count_products(factory) == expected
+
+    messagebus.handle(events.BatchQuantityChanged("SKU-7-batch", 5), uow)
+    with unit_of_work.ShardedSqlAlchemyUnitOfWork(shards) as check:
+        product = check.products.get_by_batchref("SKU-7-batch")
+        assert product.sku == "SKU-7"
+        assert product.batches[0].available_quantity == 5
+
+
+def test_rebalance_moves_products_to_new_shard(shards, tmp_path):
+    uow = unit_of_work.ShardedSqlAlchemyUnitOfWork(shards)
+    skus = [f"SKU-{i}" for i in range(20)]
+    for sku in skus:
+        messagebus.handle(events.BatchCreated(f"{sku}-batch", sku, 100, date(2021, 1, 1)), uow)
+        messagebus.handle(events.AllocationRequired(f"{sku}-order", sku, 10), uow)
+
+    (tmp_path / "extra").mkdir()
+    grown = dict(shards, shard3=make_shards(tmp_path / "extra", 1)["shard0"])
+    moved = sharding.rebalance(grown, sharding.ConsistentHashRing(grown))
+
+    assert moved
+    assert count_products(grown["shard3"]) == len(moved)
+    assert sum(count_products(f) for f in grown.values()) == len(skus)
+    with unit_of_work.ShardedSqlAlchemyUnitOfWork(grown, directory_session_factory=shards["shard0"]) as check:
+        for sku in moved:
+            [batch] = check.products.get(sku).batches
+            assert batch.available_quantity == 90
+
+
+def test_failed_shard_commit_unregisters_its_batchrefs_and_can_be_retried(shards):
+    ring = sharding.ConsistentHashRing(shards)
+    owner = ring.shard_for("LAMP")
+
+    def failing_session():
+        session = shards[owner]()
+        session.commit = lambda: (_ for _ in ()).throw(ConnectionError("shard went away"))
+        return session
+
+    failing = unit_of_work.ShardedSqlAlchemyUnitOfWork(dict(shards, **{owner: failing_session}))
+    with pytest.raises(ConnectionError):
+        messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), failing)
+    directory = sharding.BatchrefDirectory(next(iter(shards.values())))
+    assert directory.lookup("b1") is None
+
+    # 取り消しに失敗して登録が残っていても、同じSKUであればリトライできる.
+    directory.register("LAMP", ["b1"])
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), unit_of_work.ShardedSqlAlchemyUnitOfWork(shards))
+    assert directory.lookup("b1") == "LAMP"
+    with pytest.raises(sharding.BatchrefConflict):
+        directory.register("TABLE", ["b1"])
+
+
+def test_rebalance_skips_products_modified_while_being_moved(shards, tmp_path, monkeypatch):
+    uow = unit_of_work.ShardedSqlAlchemyUnitOfWork(shards)
+    skus = [f"SKU-{i}" for i in range(20)]
+    for sku in skus:
+        messagebus.handle(events.BatchCreated(f"{sku}-batch", sku, 100, None), uow)
+    (tmp_path / "extra").mkdir()
+    grown = dict(shards, shard3=make_shards(tmp_path / "extra", 1)["shard0"])
+    ring = sharding.ConsistentHashRing(grown)
+    original_merge = sharding._merge_into
+    modified = []
+
+    def merge_then_modify(target, sku, *args):
+        original_merge(target, sku, *args)
+        if not modified:  # コピーの最中に、元のshardで最初のSKUが割り当てられる.
+            modified.append(sku)
+            messagebus.handle(events.AllocationRequired("o1", sku, 10), uow)
+
+    monkeypatch.setattr(sharding, "_merge_into", merge_then_modify)
+    moved = sharding.rebalance(grown, ring)
+
+    assert modified and modified[0] not in moved
+    assert count_products(grown["shard3"]) == len(moved)
+    monkeypatch.setattr(sharding, "_merge_into", original_merge)
+    assert sharding.rebalance(grown, ring) == modified
+    with unit_of_work.ShardedSqlAlchemyUnitOfWork(grown, directory_session_factory=shards["shard0"]) as check:
+        assert check.products.get(modified[0]).batches[0].available_quantity == 90
+
+
+def test_rebalance_merges_into_a_product_already_created_on_the_new_shard(shards, tmp_path):
+    uow = unit_of_work.ShardedSqlAlchemyUnitOfWork(shards)
+    skus = [f"SKU-{i}" for i in range(20)]
+    for sku in skus:
+        messagebus.handle(events.BatchCreated(f"{sku}-batch", sku, 100, None), uow)
+        messagebus.handle(events.AllocationRequired(f"{sku}-order", sku, 10), uow)
+    (tmp_path / "extra").mkdir()
+    grown = dict(shards, shard3=make_shards(tmp_path / "extra", 1)["shard0"])
+    ring = sharding.ConsistentHashRing(grown)
+    sku = next(sku for sku in skus if ring.shard_for(sku) == "shard3")
+    # ringの変更後、rebalanceの前に新しいshardで同じSKUのbatchが作られる.
+    messagebus.handle(events.BatchCreated("new-batch", sku, 20, None), unit_of_work.SqlAlchemyUnitOfWork(grown["shard3"]))
+
+    assert sku in sharding.rebalance(grown, ring)
+
+    with unit_of_work.ShardedSqlAlchemyUnitOfWork(grown, directory_session_factory=shards["shard0"]) as check:
+        batches = {b.reference: b.available_quantity for b in check.products.get(sku).batches}
+    assert batches == {f"{sku}-batch": 90, "new-batch": 20}
+    assert sum(count_products(f) for f in grown.values()) == len(skus)
+
+
+def test_archived_batches_are_moved_and_can_be_restored_on_the_new_shard(shards, tmp_path):
+    uow = unit_of_work.ShardedSqlAlchemyUnitOfWork(shards)
+    skus = [f"SKU-{i}" for i in range(20)]
+    for sku in skus:
+        messagebus.handle(events.BatchCreated(f"{sku}-b1", sku, 10, None), uow)
+        messagebus.handle(events.BatchCreated(f"{sku}-b2", sku, 50, None), uow)
+        messagebus.handle(events.AllocationRequired(f"{sku}-order", sku, 10), uow)
+    assert sum(archive.compact(f) for f in shards.values()) == len(skus)
+
+    (tmp_path / "extra").mkdir()
+    grown = dict(shards, shard3=make_shards(tmp_path / "extra", 1)["shard0"])
+    moved = sharding.rebalance(grown, sharding.ConsistentHashRing(grown))
+
+    assert moved
+    archived = {name: f().execute("SELECT COUNT(*) FROM archived_batches").scalar() for name, f in grown.items()}
+    assert archived["shard3"] == len(moved)
+    assert sum(archived.values()) == len(skus)
+    grown_uow = unit_of_work.ShardedSqlAlchemyUnitOfWork(grown, directory_session_factory=shards["shard0"])
+    messagebus.handle(events.BatchQuantityChanged(f"{moved[0]}-b1", 5), grown_uow)
+    with unit_of_work.ShardedSqlAlchemyUnitOfWork(grown, directory_session_factory=shards["shard0"]) as check:
+        batches = {b.reference: b.available_quantity for b in check.products.get(moved[0]).batches}
+    assert batches == {f"{moved[0]}-b1": 5, f"{moved[0]}-b2": 40}  # 注文はb2へ再割り当てされる.
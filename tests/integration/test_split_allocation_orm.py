@@ -0,0 +1,38 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.domain import events
+from src.allocation.service_layer import messagebus, unit_of_work
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+def test_partial_allocations_are_persisted_per_batch(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 4, None), uow)
+    messagebus.handle(events.BatchCreated("b2", "LAMP", 5, None), uow)
+    [allocations] = messagebus.handle(events.SplitAllocationRequired("o1", "LAMP", 7), uow)
+    assert allocations == [("b1", 4), ("b2", 3)]
+
+    session = session_factory()
+    rows = session.execute(
+        "SELECT b.reference, ol.qty FROM allocations a"
+        " JOIN order_lines ol ON ol.id = a.orderline_id JOIN batches b ON b.id = a.batch_id"
+        " WHERE ol.orderid = 'o1' ORDER BY b.reference"
+    ).all()
+    assert [tuple(r) for r in rows] == [("b1", 4), ("b2", 3)]
+
+    # 読み直した集約でも同じ割り当てになり、リトライは二重に割り当てない.
+    [retried] = messagebus.handle(events.SplitAllocationRequired("o1", "LAMP", 7), uow)
+    assert retried == allocations
+    assert session.execute("SELECT COUNT(*) FROM order_lines").scalar() == 2
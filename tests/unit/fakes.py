@@ -0,0 +1,59 @@
+"""unit testで共有するFakeRepository・FakeUnitOfWork."""
+import abc
+from typing import List
+
+from src.allocation.adapters import repository
+from src.allocation.domain import events, model
+from src.allocation.service_layer import unit_of_work
+
+
+class FakeRepository(repository.AbstractRepository):
+    def __init__(self, products: List[model.Product]):
+        super().__init__()
+        self._products = set(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    def _get(self, sku):
+        return next((p for p in self._products if p.sku == sku), None)
+
+    def _get_by_batchref(self, batchref) -> model.Product:
+        return next((p for p in self._products for b in p.batches if b.reference == batchref), None)
+
+
+class FakeSession(abc.ABC):
+    committed: bool = False
+
+    def commit(self) -> None:
+        self.committed = True
+
+
+class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    def __init__(self):
+        self.products = FakeRepository([])
+        # FakeUnitOfWorkとFakeRepositoryは、realのUnitOfWorkとRepositoryクラスと同じように、
+        # 密に結合している.
+        self.committed = False
+
+    def _commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+class FakeUnitOfWorkWithFakeMessageBus(FakeUnitOfWork):
+    def __init__(self):
+        super().__init__()
+        self.events_published: List[events.Event] = []
+
+    def publish_events(self):
+        for product in self.products.seen:
+            while product.events:
+                self.events_published.append(product.events.pop(0))
+
+    def collect_new_events(self):
+        # 後続のhandlerは呼ばずに、発行されたeventを記録するだけにする.
+        self.publish_events()
+        return iter([])
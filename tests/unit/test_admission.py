@@ -0,0 +1,123 @@
+import threading
+import time
+from typing import List
+
+import pytest
+
+from src.allocation.domain import events
+from src.allocation.service_layer import admission, messagebus
+from tests.unit.fakes import FakeUnitOfWork
+
+
+class BlockingRunner:
+    """最初のbatchをreleaseされるまで止めておくrun_batch"""
+
+    def __init__(self) -> None:
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.batches: List[List[str]] = []
+
+    def __call__(self, batch):
+        self.batches.append(list(batch))
+        self.started.set()
+        self.release.wait(timeout=5)
+        return [f"result-{item}" for item in batch]
+
+
+def submit_in_thread(controller, runner, item, results):
+    def target():
+        try:
+            results[item] = controller.submit("SKU", item, runner)
+        except admission.Overloaded as e:
+            results[item] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread
+
+
+def wait_for_queue_depth(controller, depth):
+    deadline = time.monotonic() + 5
+    while controller.metrics().queue_depth.get("SKU", 0) < depth:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_rejects_immediately_when_queue_is_full():
+    controller = admission.AdmissionController(max_in_flight=1, max_queue=1, retry_after=3)
+    runner, results = BlockingRunner(), {}
+    threads = [submit_in_thread(controller, runner, "a", results)]
+    runner.started.wait(timeout=5)
+    threads.append(submit_in_thread(controller, runner, "b", results))
+    wait_for_queue_depth(controller, 1)
+
+    with pytest.raises(admission.Overloaded) as e:
+        controller.submit("SKU", "c", runner)
+    assert e.value.retry_after == 3
+
+    runner.release.set()
+    for t in threads:
+        t.join()
+    assert results == {"a": "result-a", "b": "result-b"}
+    metrics = controller.metrics()
+    assert (metrics.admitted, metrics.rejected, metrics.max_queue_depth) == (2, 1, 1)
+
+
+def test_coalesces_queued_lines_into_one_batch():
+    controller = admission.AdmissionController(max_in_flight=1, max_queue=10, coalesce=True)
+    runner, results = BlockingRunner(), {}
+    threads = [submit_in_thread(controller, runner, "a", results)]
+    runner.started.wait(timeout=5)
+    for item in ["b", "c", "d"]:
+        threads.append(submit_in_thread(controller, runner, item, results))
+    wait_for_queue_depth(controller, 3)
+
+    runner.release.set()
+    for t in threads:
+        t.join()
+    assert runner.batches[0] == ["a"]
+    assert sorted(runner.batches[1]) == ["b", "c", "d"]
+    assert results == {item: f"result-{item}" for item in "abcd"}
+
+
+def test_times_out_while_waiting_in_queue():
+    controller = admission.AdmissionController(max_in_flight=1, max_queue=10, queue_timeout=0.05)
+    runner, results = BlockingRunner(), {}
+    thread = submit_in_thread(controller, runner, "a", results)
+    runner.started.wait(timeout=5)
+
+    with pytest.raises(admission.Overloaded):
+        controller.submit("SKU", "b", runner)
+
+    runner.release.set()
+    thread.join()
+    assert controller.metrics().timed_out == 1
+
+
+def test_errors_are_returned_to_the_caller():
+    controller = admission.AdmissionController()
+
+    def failing(batch):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        controller.submit("SKU", "a", failing)
+
+
+def test_handle_allocations_commits_once_and_returns_per_line_results():
+    uow = FakeUnitOfWork()
+    messagebus.handle(events.BatchCreated("batch1", "HOT-SOFA", 15, None), uow)
+    commits = []
+    uow._commit = lambda: commits.append(True)
+
+    results = messagebus.handle_allocations(
+        [
+            events.AllocationRequired("o1", "HOT-SOFA", 10),
+            events.AllocationRequired("o2", "HOT-SOFA", 10),
+            events.AllocationRequired("o3", "HOT-SOFA", 5),
+        ],
+        uow,
+    )
+
+    assert results == ["batch1", None, "batch1"]
+    assert len(commits) == 1
@@ -0,0 +1,95 @@
+from datetime import date, timedelta
+
+from src.allocation.domain import events
+from src.allocation.domain.model import Batch, OrderLine, Product
+from src.allocation.service_layer import availability, messagebus
+from tests.unit.fakes import FakeUnitOfWork
+
+today = date.today()
+tomorrow = today + timedelta(days=1)
+later = today + timedelta(days=10)
+
+
+def make_index() -> availability.AvailabilityIndex:
+    index = availability.AvailabilityIndex(capacity=1)
+    index.rebuild([])
+    index.apply(events.BatchCreated("shipment", "BLUE-VASE", 20, tomorrow))
+    index.apply(events.BatchCreated("in-stock", "BLUE-VASE", 10, None))
+    index.apply(events.BatchCreated("slow", "RED-VASE", 5, later))
+    return index
+
+
+def test_available_by_sku_sums_batches():
+    assert make_index().available_by_sku() == {"BLUE-VASE": 30, "RED-VASE": 5}
+
+
+def test_earliest_allocatable_prefers_in_stock_then_earliest_eta():
+    index = make_index()
+    assert index.earliest_allocatable() == {"BLUE-VASE": "in-stock", "RED-VASE": "slow"}
+    assert index.earliest_allocatable(qty=15) == {"BLUE-VASE": "shipment", "RED-VASE": None}
+
+
+def test_stock_by_eta_buckets():
+    index = make_index()
+    assert index.stock_by_eta([tomorrow, later]) == {
+        "BLUE-VASE": [10, 0, 20, 0],
+        "RED-VASE": [0, 0, 0, 5],
+    }
+
+
+def test_applies_allocation_and_quantity_events():
+    index = make_index()
+    index.apply(events.Allocated("o1", "BLUE-VASE", 8, "in-stock"))
+    index.apply(events.BatchQuantityChanged("shipment", 12))
+    assert index.available_by_sku()["BLUE-VASE"] == 14
+    index.apply(events.Deallocated("o1", "BLUE-VASE", 8, "in-stock"))
+    assert index.available_by_sku()["BLUE-VASE"] == 22
+
+
+def test_matches_products_after_messagebus_flow():
+    availability.DEFAULT_INDEX.rebuild([])
+    uow = FakeUnitOfWork()
+    for event in [
+        events.BatchCreated("batch1", "GREEN-VASE", 50, None),
+        events.BatchCreated("batch2", "GREEN-VASE", 50, tomorrow),
+        events.AllocationRequired("o1", "GREEN-VASE", 20),
+        events.AllocationRequired("o2", "GREEN-VASE", 20),
+        events.BatchQuantityChanged("batch1", 25),
+    ]:
+        messagebus.handle(event, uow)
+
+    product = uow.products.get("GREEN-VASE")
+    rebuilt = availability.AvailabilityIndex.from_products([product])
+    expected = sum(b.available_quantity for b in product.batches)
+    assert availability.DEFAULT_INDEX.available_by_sku()["GREEN-VASE"] == expected
+    assert rebuilt.available_by_sku()["GREEN-VASE"] == expected
+
+
+def test_rebuild_from_products():
+    batch = Batch("b1", "PINK-VASE", 10, None)
+    batch.allocate(OrderLine("o1", "PINK-VASE", 3))
+    index = availability.AvailabilityIndex.from_products([Product("PINK-VASE", [batch])])
+    assert index.available_by_sku() == {"PINK-VASE": 7}
+
+
+def test_events_before_the_first_rebuild_do_not_hide_existing_stock(monkeypatch):
+    index = availability.AvailabilityIndex()
+    monkeypatch.setattr(availability, "DEFAULT_INDEX", index)  # 起動直後のworker
+    uow = FakeUnitOfWork()
+    uow.products.add(Product("OLD-VASE", [Batch("old", "OLD-VASE", 10, None)]))
+
+    messagebus.handle(events.BatchCreated("new", "OLD-VASE", 5, None), uow)
+
+    # /availability と同じ手順: 未構築なのでデータベース(ここではrepository)から構築する.
+    assert index.needs_rebuild()
+    index.rebuild(uow.products._products)
+    assert index.available_by_sku() == {"OLD-VASE": 15}
+    assert not index.needs_rebuild()
+
+
+def test_needs_rebuild_after_max_age():
+    now = [0.0]
+    index = availability.AvailabilityIndex(clock=lambda: now[0])
+    index.rebuild([])
+    now[0] = availability.DEFAULT_MAX_AGE + 1
+    assert index.needs_rebuild()
@@ -0,0 +1,111 @@
+import pytest
+from sqlalchemy.orm import clear_mappers
+
+from src.allocation.domain import events
+from src.allocation.domain.model import Batch, Product
+from src.allocation.entrypoints import flask_app
+from src.allocation.service_layer import availability_cache, messagebus
+from tests.unit.fakes import FakeUnitOfWork
+
+
+@pytest.fixture
+def cache(monkeypatch) -> availability_cache.AvailabilityCache:
+    cache = availability_cache.AvailabilityCache()
+    monkeypatch.setattr(availability_cache, "DEFAULT_CACHE", cache)
+    return cache
+
+
+@pytest.fixture
+def client():
+    yield flask_app.app.test_client()
+    clear_mappers()  # 最初のリクエストでマッピングされるので、他のテストの為に元に戻す.
+
+
+def test_etag_depends_only_on_content():
+    first = Product("LAMP", [Batch("b1", "LAMP", 10, None)])
+    second = Product("LAMP", [Batch("b1", "LAMP", 10, None)])
+    body = availability_cache.availability_view(first)
+    assert body == {"sku": "LAMP", "available": 10, "batches": [{"ref": "b1", "available": 10, "eta": None}]}
+    assert availability_cache.etag_for(body) == availability_cache.etag_for(availability_cache.availability_view(second))
+
+
+def test_expires_after_ttl():
+    now = [0.0]
+    cache = availability_cache.AvailabilityCache(ttl=10, clock=lambda: now[0])
+    cache.put(Product("LAMP", [Batch("b1", "LAMP", 10, None)]), 0)
+    assert cache.get("LAMP") is not None
+    now[0] = 11
+    assert cache.get("LAMP") is None
+
+
+def test_does_not_cache_a_load_that_raced_with_an_invalidation():
+    cache = availability_cache.AvailabilityCache()
+    generation = cache.generation("LAMP")
+    cache.invalidate("LAMP")
+    entry = cache.put(Product("LAMP", [Batch("b1", "LAMP", 10, None)]), generation)
+    assert entry.body["available"] == 10
+    assert cache.get("LAMP") is None
+
+
+def test_messagebus_invalidates_on_allocation_and_quantity_change(cache):
+    uow = FakeUnitOfWork()
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+
+    cache.put(uow.products.get("LAMP"), cache.generation("LAMP"))
+    messagebus.handle(events.AllocationRequired("o1", "LAMP", 3), uow)
+    assert cache.get("LAMP") is None
+
+    cache.put(uow.products.get("LAMP"), cache.generation("LAMP"))
+    messagebus.handle(events.BatchQuantityChanged("b1", 5), uow)
+    assert cache.get("LAMP") is None
+
+    cache.put(uow.products.get("LAMP"), cache.generation("LAMP"))
+    messagebus.handle(events.BatchCreated("b2", "LAMP", 5, None), uow)
+    assert cache.get("LAMP") is None
+
+
+def test_quantity_change_of_a_batch_the_cache_has_not_seen_is_resolved_through_the_uow(cache):
+    uow = FakeUnitOfWork()
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+    generation = cache.generation("LAMP")  # 数量の変更前に始まった読み込み
+    loaded = Product("LAMP", [Batch("b1", "LAMP", 10, None)])
+
+    messagebus.handle(events.BatchQuantityChanged("b1", 5), uow)
+
+    cache.put(loaded, generation)
+    assert cache.get("LAMP") is None
+
+
+def test_endpoint_returns_304_from_cache_without_touching_the_database(cache, client):
+    entry = cache.put(Product("LAMP", [Batch("b1", "LAMP", 10, None)]), cache.generation("LAMP"))
+
+    response = client.get("/products/LAMP/availability")
+    assert response.status_code == 200
+    assert response.json["available"] == 10
+    assert response.headers["ETag"] == f'"{entry.etag}"'
+
+    response = client.get("/products/LAMP/availability", headers={"If-None-Match": f'"{entry.etag}"'})
+    assert response.status_code == 304
+
+
+def test_bookkeeping_stays_bounded():
+    cache = availability_cache.AvailabilityCache(maxsize=3)
+    for i in range(100):
+        sku = f"SKU-{i}"
+        cache.put(Product(sku, [Batch(f"b{i}", sku, 10, None)]), cache.generation(sku))
+        cache.invalidate(f"OTHER-{i}")
+    assert len(cache._entries) == 3
+    assert len(cache._sku_by_batchref) == 3
+    assert len(cache._generations) == 3
+    assert cache.sku_for_batchref("b99") == "SKU-99"
+    assert cache.sku_for_batchref("b0") is None
+
+
+def test_forgotten_generation_still_rejects_a_load_that_raced_with_an_invalidation():
+    cache = availability_cache.AvailabilityCache(maxsize=2)
+    generation = cache.generation("LAMP")
+    cache.invalidate("LAMP")
+    cache.invalidate("TABLE")
+    cache.invalidate("CHAIR")  # LAMPの世代の記録は捨てられる.
+    cache.put(Product("LAMP", [Batch("b1", "LAMP", 10, None)]), generation)
+    assert cache.get("LAMP") is None
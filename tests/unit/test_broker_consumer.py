@@ -0,0 +1,141 @@
+import pytest
+
+from src.allocation.adapters import broker, serialization
+from src.allocation.domain import events
+from src.allocation.entrypoints.broker_consumer import BrokerConsumer
+from tests.unit.fakes import FakeUnitOfWork
+
+INBOUND = broker.INBOUND_STREAM
+
+
+class FlakyUnitOfWork(FakeUnitOfWork):
+    """全てのUoWで同じrepositoryを共有し、最初の`failures`回は開始時に失敗する(データベースの接続断を想定)."""
+
+    def __init__(self, failures: int = 0):
+        super().__init__()
+        self.failures = failures
+
+    def __call__(self) -> "FlakyUnitOfWork":
+        return self
+
+    def __enter__(self):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("database went away")
+        return super().__enter__()
+
+
+@pytest.fixture
+def message_broker(monkeypatch) -> broker.InMemoryBroker:
+    message_broker = broker.InMemoryBroker()
+    monkeypatch.setattr(broker, "DEFAULT_PUBLISHER", message_broker)
+    return message_broker
+
+
+def make_consumer(message_broker, uow: FlakyUnitOfWork) -> BrokerConsumer:
+    return BrokerConsumer(message_broker, uow, consumer="c1", block_ms=0)
+
+
+def test_processes_a_batch_in_order_and_publishes_allocations(message_broker):
+    uow = FlakyUnitOfWork()
+    for event in [
+        events.BatchCreated("b1", "LAMP", 10, None),
+        events.BatchCreated("b2", "TABLE", 10, None),
+        events.AllocationRequired("o1", "LAMP", 4),
+        events.AllocationRequired("o2", "TABLE", 4),
+        events.AllocationRequired("o3", "LAMP", 4),
+        events.BatchQuantityChanged("b1", 5),
+    ]:
+        message_broker.publish(INBOUND, event)
+
+    assert make_consumer(message_broker, uow).run_once() == 6
+    assert message_broker.pending_count(INBOUND, "allocation") == 0
+
+    published = message_broker.events(broker.OUTBOUND_STREAM)
+    assert published[:3] == [
+        events.Allocated("o1", "LAMP", 4, "b1"),
+        events.Allocated("o3", "LAMP", 4, "b1"),
+        events.Allocated("o2", "TABLE", 4, "b2"),
+    ]
+    # 数量の変更で外れたラインは、同じbatchに入りきらないのでOutOfStockになる.
+    assert uow.products.get("LAMP").batches[0].available_quantity == 1
+
+
+def test_failed_messages_stay_pending_and_are_redelivered(message_broker):
+    uow = FlakyUnitOfWork(failures=1)
+    message_broker.publish(INBOUND, events.BatchCreated("b1", "LAMP", 10, None))
+    message_broker.publish(INBOUND, events.AllocationRequired("o1", "LAMP", 4))
+    consumer = make_consumer(message_broker, uow)
+
+    assert consumer.run_once() == 0
+    assert message_broker.pending_count(INBOUND, "allocation") == 2
+
+    assert consumer.run_once() == 2
+    assert message_broker.pending_count(INBOUND, "allocation") == 0
+    assert message_broker.events(broker.OUTBOUND_STREAM) == [events.Allocated("o1", "LAMP", 4, "b1")]
+
+
+def test_invalid_messages_go_to_the_dead_letter_stream(message_broker):
+    uow = FlakyUnitOfWork()
+    message_broker.publish(INBOUND, events.AllocationRequired("o1", "NO-SUCH-SKU", 4))
+    message_broker.add(INBOUND, b"\xff\x01\x00\x00")
+
+    assert make_consumer(message_broker, uow).run_once() == 2
+    assert message_broker.pending_count(INBOUND, "allocation") == 0
+    dead_letters = message_broker.read([broker.DEAD_LETTER_STREAM], "ops", "c1", count=10)
+    assert sorted(m.payload for m in dead_letters) == sorted(
+        [serialization.encode(events.AllocationRequired("o1", "NO-SUCH-SKU", 4)), b"\xff\x01\x00\x00"]
+    )
+
+
+def test_corrupted_payloads_are_dead_lettered_individually(message_broker):
+    uow = FlakyUnitOfWork()
+    message_broker.publish(INBOUND, events.BatchCreated("b1", "LAMP", 10, None))
+    truncated = serialization.encode(events.AllocationRequired("o1", "LAMP", 4))[:6]
+    bad_utf8 = serialization.encode(events.AllocationRequired("é", "LAMP", 4)).replace(b"\xc3\xa9", b"\xff\xfe")
+    message_broker.add(INBOUND, truncated)
+    message_broker.add(INBOUND, bad_utf8)
+    message_broker.add(INBOUND, b"")
+    message_broker.publish(INBOUND, events.AllocationRequired("o2", "LAMP", 4))
+
+    assert make_consumer(message_broker, uow).run_once() == 5
+    dead_letters = message_broker.read([broker.DEAD_LETTER_STREAM], "ops", "c1", count=10)
+    assert [m.payload for m in dead_letters] == [truncated, bad_utf8, b""]
+    assert message_broker.events(broker.OUTBOUND_STREAM) == [events.Allocated("o2", "LAMP", 4, "b1")]
+
+
+def test_messages_failing_max_deliveries_times_are_dead_lettered(message_broker):
+    uow = FlakyUnitOfWork(failures=10)
+    message_broker.publish(INBOUND, events.BatchCreated("b1", "LAMP", 10, None))
+    consumer = make_consumer(message_broker, uow)
+    consumer.max_deliveries = 3
+
+    assert [consumer.run_once() for _ in range(3)] == [0, 0, 1]
+    assert message_broker.pending_count(INBOUND, "allocation") == 0
+    assert len(message_broker.read([broker.DEAD_LETTER_STREAM], "ops", "c1", count=10)) == 1
+
+    # 配送の回数はbrokerが数えるので、consumerを作り直しても引き継がれる.
+    message_broker.publish(INBOUND, events.BatchCreated("b2", "LAMP", 10, None))
+    assert make_consumer(message_broker, uow).run_once() == 0
+    restarted = make_consumer(message_broker, uow)
+    restarted.max_deliveries = 2
+    assert restarted.run_once() == 1
+
+
+def test_allocated_is_republished_when_publishing_failed_after_commit(message_broker, monkeypatch):
+    uow = FlakyUnitOfWork()
+    message_broker.publish(INBOUND, events.BatchCreated("b1", "LAMP", 10, None))
+    message_broker.publish(INBOUND, events.AllocationRequired("o1", "LAMP", 4))
+    consumer = make_consumer(message_broker, uow)
+    original_publish = message_broker.publish
+
+    def publish_fails_once(stream, event):
+        monkeypatch.setattr(message_broker, "publish", original_publish)
+        raise ConnectionError("broker went away")
+
+    monkeypatch.setattr(message_broker, "publish", publish_fails_once)
+    assert consumer.run_once() == 1  # BatchCreatedだけがackされる.
+
+    assert consumer.run_once() == 1
+    assert message_broker.events(broker.OUTBOUND_STREAM) == [events.Allocated("o1", "LAMP", 4, "b1")]
+    assert uow.products.get("LAMP").batches[0].available_quantity == 6
@@ -0,0 +1,54 @@
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def run(script: str) -> str:
+    result = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+
+def test_importing_the_app_does_not_load_heavy_modules_or_connect():
+    output = run(
+        "import sys\n"
+        "from src.allocation.entrypoints import flask_app\n"
+        "from src.allocation.service_layer import unit_of_work\n"
+        "from src.allocation.domain import model\n"
+        "from sqlalchemy import inspect\n"
+        "print(sorted(m for m in ('hypothesis', 'numpy', 'psycopg2') if m in sys.modules))\n"
+        "print(unit_of_work.DEFAULT_SESSION_FACTORY._factory is None)\n"
+        "print(inspect(model.Product, raiseerr=False) is None)\n"
+    )
+    assert output.splitlines() == ["[]", "True", "True"]
+
+
+def test_mappers_are_started_on_first_request():
+    output = run(
+        "from src.allocation.entrypoints import flask_app\n"
+        "from src.allocation.domain import model\n"
+        "from sqlalchemy import inspect\n"
+        "flask_app.app.test_client().get('/metrics/admission')\n"
+        "print(inspect(model.Product, raiseerr=False) is not None)\n"
+    )
+    assert output == "True"
+
+
+def test_concurrent_first_requests_start_the_mappers_once():
+    output = run(
+        "import threading, time\n"
+        "from src.allocation.adapters import orm\n"
+        "calls = []\n"
+        "original = orm.start_mappers\n"
+        "def slow_start():\n"
+        "    calls.append(1)\n"
+        "    time.sleep(0.05)\n"
+        "    original()\n"
+        "orm.start_mappers = slow_start\n"
+        "threads = [threading.Thread(target=orm.ensure_mappers_started) for _ in range(8)]\n"
+        "[t.start() for t in threads]\n"
+        "[t.join() for t in threads]\n"
+        "print(len(calls))\n"
+    )
+    assert output == "1"
@@ -0,0 +1,123 @@
+import random
+from datetime import date, timedelta
+
+from src.allocation.domain import events
+from src.allocation.domain.model import Batch, OrderLine, Product
+from src.allocation.service_layer import messagebus
+from src.allocation.service_layer.eta_scheduler import EtaScheduler
+from tests.unit.fakes import FakeUnitOfWork
+
+today = date(2021, 1, 1)
+
+
+class FakeClock:
+    def __init__(self, now: date) -> None:
+        self.now = now
+
+    def __call__(self) -> date:
+        return self.now
+
+
+def test_priority_order_matches_sorting_while_batches_are_added_and_received():
+    rng = random.Random(0)
+    product = Product("LAMP", [])
+    for i in range(200):
+        eta = None if rng.random() < 0.2 else today + timedelta(days=rng.randint(0, 20))
+        product.batches.append(Batch(f"b{i}", "LAMP", 10, eta))
+        if rng.random() < 0.3:
+            product.receive_batch(rng.choice(product.batches).reference)
+        assert product.batches_by_priority() == sorted(product.batches)
+
+
+def test_priority_order_is_rebuilt_when_batches_are_reloaded_in_another_order():
+    early = Batch("early", "LAMP", 10, today)
+    late = Batch("late", "LAMP", 10, today + timedelta(days=5))
+    product = Product("LAMP", [late, early])
+    assert product.batches_by_priority() == [early, late]
+
+    # ORMがbatchesを読み直すと、同じ長さのまま並びや中身が変わる事がある(アーカイブからの復元等).
+    restored = Batch("restored", "LAMP", 10, None)
+    product.batches = [early, restored]
+    assert product.batches_by_priority() == [restored, early]
+    product.batches = [restored, early, late]
+    assert product.batches_by_priority() == sorted(product.batches)
+
+
+def test_emits_arrivals_in_eta_order_once_the_clock_passes_them():
+    clock = FakeClock(today)
+    scheduler = EtaScheduler(clock)
+    scheduler.schedule("late", "LAMP", today + timedelta(days=3))
+    scheduler.schedule("soon", "LAMP", today + timedelta(days=1))
+    scheduler.schedule("moved", "LAMP", today + timedelta(days=1))
+    scheduler.schedule("moved", "LAMP", today + timedelta(days=5))
+    scheduler.schedule("cancelled", "LAMP", today + timedelta(days=2))
+    scheduler.cancel("cancelled")
+
+    assert scheduler.due() == []
+    clock.now = today + timedelta(days=3)
+    assert [e.ref for e in scheduler.due()] == ["soon", "late"]
+    assert scheduler.due() == []
+    assert scheduler.next_eta() == today + timedelta(days=5)
+    assert len(scheduler) == 1
+
+
+def test_failed_arrival_is_retried_and_does_not_stop_the_others(monkeypatch):
+    uow = FakeUnitOfWork()
+    for ref in ["first", "broken", "last"]:
+        messagebus.handle(events.BatchCreated(ref, "LAMP", 10, today + timedelta(days=1)), uow)
+    clock = FakeClock(today)
+    scheduler = EtaScheduler(clock)
+    scheduler.schedule_products(uow.products._products)
+    handle = messagebus.handle
+
+    def failing_handle(event, uow):
+        if event.ref == "broken":
+            raise ConnectionError("database went away")
+        return handle(event, uow)
+
+    clock.now = today + timedelta(days=1)
+    monkeypatch.setattr(messagebus, "handle", failing_handle)
+    assert [e.ref for e in scheduler.run_pending(uow)] == ["first", "last"]
+    assert len(scheduler) == 1
+
+    monkeypatch.setattr(messagebus, "handle", handle)
+    assert [e.ref for e in scheduler.run_pending(uow)] == ["broken"]
+    assert len(scheduler) == 0
+
+
+def test_arrived_batch_is_preferred_for_new_allocations():
+    uow = FakeUnitOfWork()
+    messagebus.handle(events.BatchCreated("warehouse", "LAMP", 1, None), uow)
+    messagebus.handle(events.BatchCreated("early", "LAMP", 10, today + timedelta(days=1)), uow)
+    messagebus.handle(events.BatchCreated("late", "LAMP", 10, today + timedelta(days=2)), uow)
+    clock = FakeClock(today)
+    scheduler = EtaScheduler(clock)
+    scheduler.schedule_products(uow.products._products)
+
+    clock.now = today + timedelta(days=2)
+    assert [e.ref for e in scheduler.run_pending(uow)] == ["early", "late"]
+    [product] = uow.products._products
+    assert [b.eta for b in product.batches] == [None, None, None]
+    assert messagebus.handle(events.AllocationRequired("o1", "LAMP", 5), uow) == ["early"]
+
+
+def test_reallocates_lines_parked_on_later_shipments_when_asked():
+    def make_product():
+        product = Product("LAMP", [Batch("later", "LAMP", 20, today + timedelta(days=9))])
+        product.allocate(OrderLine("o1", "LAMP", 8))
+        product.allocate(OrderLine("o2", "LAMP", 3))
+        product.batches.append(Batch("arriving", "LAMP", 10, today + timedelta(days=1)))
+        product.events.clear()
+        return product
+
+    product = make_product()
+    product.receive_batch("arriving")
+    assert [b.available_quantity for b in product.batches] == [9, 10]
+
+    product = make_product()
+    product.receive_batch("arriving", reallocate=True)
+    assert [b.available_quantity for b in product.batches] == [17, 2]
+    assert product.events == [
+        events.Deallocated("o1", "LAMP", 8, "later"),
+        events.Allocated("o1", "LAMP", 8, "arriving"),
+    ]
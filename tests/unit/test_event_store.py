@@ -0,0 +1,128 @@
+import fcntl
+import threading
+from datetime import date
+
+import pytest
+
+from src.allocation.adapters.event_store import ConcurrencyError, EventStore, decode_events, encode_event
+from src.allocation.domain import events
+from src.allocation.domain.model import Product
+from src.allocation.service_layer import messagebus, unit_of_work
+
+
+def test_events_round_trip_through_binary_format():
+    history = [
+        events.BatchCreated("b1", "SQUEAKY-CHAIR", 100, date(2021, 1, 2)),
+        events.BatchCreated("b2", "SQUEAKY-CHAIR", 50),
+        events.AllocationRequired("o1", "SQUEAKY-CHAIR", 10),
+        events.Allocated("o1", "SQUEAKY-CHAIR", 10, "b1"),
+        events.BatchQuantityChanged("b1", 5),
+        events.Deallocated("o1", "SQUEAKY-CHAIR", 10, "b1"),
+        events.OutOfStock("SQUEAKY-CHAIR"),
+    ]
+    data = b"".join(encode_event(e, version=i) for i, e in enumerate(history))
+    decoded = list(decode_events(memoryview(data)))
+    assert [e for e, _ in decoded] == history
+    assert [v for _, v in decoded] == list(range(len(history)))
+
+
+def test_product_is_rebuilt_from_stream(tmp_path):
+    uow = unit_of_work.EventStoreUnitOfWork(EventStore(tmp_path))
+    messagebus.handle(events.BatchCreated("batch1", "SHINY-LAMP", 100, None), uow)
+    messagebus.handle(events.BatchCreated("batch2", "SHINY-LAMP", 100, date.today()), uow)
+    [batchref] = messagebus.handle(events.AllocationRequired("o1", "SHINY-LAMP", 10), uow)
+    assert batchref == "batch1"
+
+    product, _ = EventStore(tmp_path).load("SHINY-LAMP")
+    [batch1, batch2] = product.batches
+    assert batch1.available_quantity == 90
+    assert batch2.available_quantity == 100
+    assert product.version_number == 1
+
+
+def test_reallocation_is_recorded_and_found_by_batchref(tmp_path):
+    uow = unit_of_work.EventStoreUnitOfWork(EventStore(tmp_path))
+    for e in [
+        events.BatchCreated("batch1", "SAD-TABLE", 50, None),
+        events.BatchCreated("batch2", "SAD-TABLE", 50, date.today()),
+        events.AllocationRequired("o1", "SAD-TABLE", 20),
+        events.AllocationRequired("o2", "SAD-TABLE", 20),
+        events.BatchQuantityChanged("batch1", 25),
+    ]:
+        messagebus.handle(e, uow)
+
+    uow = unit_of_work.EventStoreUnitOfWork(EventStore(tmp_path))
+    product = uow.products.get_by_batchref("batch2")
+    [batch1, batch2] = product.batches
+    assert batch1.available_quantity == 5
+    assert batch2.available_quantity == 30
+
+
+def test_handled_allocation_required_is_recorded_before_its_result(tmp_path):
+    uow = unit_of_work.EventStoreUnitOfWork(EventStore(tmp_path))
+    messagebus.handle(events.BatchCreated("batch1", "SHINY-LAMP", 10, None), uow)
+    messagebus.handle(events.AllocationRequired("o1", "SHINY-LAMP", 10), uow)
+    messagebus.handle(events.AllocationRequired("o2", "SHINY-LAMP", 5), uow)
+
+    history = [e for e, _ in decode_events(memoryview((tmp_path / "SHINY-LAMP.events").read_bytes()))]
+    assert history[1:] == [
+        events.AllocationRequired("o1", "SHINY-LAMP", 10),
+        events.Allocated("o1", "SHINY-LAMP", 10, "batch1"),
+        events.AllocationRequired("o2", "SHINY-LAMP", 5),
+        events.OutOfStock("SHINY-LAMP"),
+    ]
+
+
+def test_batchrefs_indexed_by_another_store_are_found(tmp_path):
+    reader = EventStore(tmp_path)
+    messagebus.handle(events.BatchCreated("batch1", "SHINY-LAMP", 10, None), unit_of_work.EventStoreUnitOfWork(reader))
+    assert reader.sku_for_batchref("batch2") is None
+
+    writer = unit_of_work.EventStoreUnitOfWork(EventStore(tmp_path))
+    messagebus.handle(events.BatchCreated("batch2", "SAD-TABLE", 10, None), writer)
+
+    assert reader.sku_for_batchref("batch1") == "SHINY-LAMP"
+    assert reader.sku_for_batchref("batch2") == "SAD-TABLE"
+
+
+def test_rebuild_replays_only_events_after_snapshot(tmp_path):
+    store = EventStore(tmp_path, snapshot_interval=3)
+    uow = unit_of_work.EventStoreUnitOfWork(store)
+    messagebus.handle(events.BatchCreated("batch1", "DULL-RUG", 100, None), uow)
+    for i in range(4):
+        messagebus.handle(events.AllocationRequired(f"o{i}", "DULL-RUG", 1), uow)
+
+    assert (tmp_path / "DULL-RUG.snapshot").exists()
+    fresh = EventStore(tmp_path, snapshot_interval=3)
+    product, _ = fresh.load("DULL-RUG")
+    assert fresh._since_snapshot["DULL-RUG"] < 3
+    assert product.batches[0].available_quantity == 96
+    assert product.version_number == 4
+
+
+def test_append_checks_the_offset_under_the_stream_lock(tmp_path):
+    store = EventStore(tmp_path)
+    product = Product("LAMP", [])
+    store.append(product, [events.BatchCreated("b1", "LAMP", 10, None)], expected_offset=0)
+    offset = store.stream_offset("LAMP")
+    errors = []
+
+    def append():
+        try:
+            store.append(product, [events.BatchCreated("b2", "LAMP", 10, None)], expected_offset=offset)
+        except ConcurrencyError as e:
+            errors.append(e)
+
+    # 別のプロセスが追記の途中で、streamをロックしている.
+    with store._path("LAMP", "events").open("ab") as other:
+        fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+        thread = threading.Thread(target=append)
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()  # ロックが解放されるまで待つ.
+        other.write(encode_event(events.BatchCreated("b3", "LAMP", 10, None), 0))
+    thread.join()
+
+    assert len(errors) == 1
+    with pytest.raises(ConcurrencyError):
+        store.append(product, [events.BatchCreated("b2", "LAMP", 10, None)], expected_offset=offset)
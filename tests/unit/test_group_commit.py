@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from src.allocation.domain import events
+from src.allocation.service_layer import group_commit, messagebus
+from tests.unit.fakes import FakeUnitOfWork
+
+
+def submit_concurrently(committer, items, sku="SKU"):
+    results, errors = {}, {}
+    barrier = threading.Barrier(len(items))
+
+    def target(i, item):
+        barrier.wait()
+        try:
+            results[i] = committer.submit(sku, item)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=target, args=(i, item)) for i, item in enumerate(items)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_concurrent_requests_within_window_share_one_batch():
+    batches = []
+
+    def run_batch(items):
+        batches.append(items)
+        return [f"result-{i}" for i in items]
+
+    committer = group_commit.GroupCommitter(run_batch, window=0.2)
+    results, errors = submit_concurrently(committer, ["a", "b", "c", "d"])
+
+    assert not errors
+    assert len(batches) == 1
+    assert results == {i: f"result-{item}" for i, item in enumerate("abcd")}
+
+
+def test_full_group_runs_without_waiting_for_window():
+    batches = []
+    committer = group_commit.GroupCommitter(lambda items: batches.append(items) or items, window=10, max_batch=2)
+    results, _ = submit_concurrently(committer, ["a", "b"])
+    assert results == {0: "a", 1: "b"}
+
+
+class FakeDriverError(Exception):
+    def __init__(self, pgcode=None):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+def test_retries_whole_group_on_conflict():
+    attempts = []
+
+    def run_batch(items):
+        attempts.append(items)
+        if len(attempts) < 3:
+            raise OperationalError("UPDATE products ...", {}, FakeDriverError("40001"))
+        return items
+
+    committer = group_commit.GroupCommitter(run_batch, window=0)
+    assert committer.submit("SKU", "a") == "a"
+    assert len(attempts) == 3
+    assert (committer.groups, committer.retries) == (1, 2)
+
+
+def test_does_not_retry_other_database_errors():
+    attempts = []
+
+    def run_batch(items):
+        attempts.append(items)
+        raise OperationalError("SELECT 1", {}, FakeDriverError())  # 接続断等
+
+    committer = group_commit.GroupCommitter(run_batch, window=0)
+    with pytest.raises(OperationalError):
+        committer.submit("SKU", "a")
+    assert len(attempts) == 1
+    assert committer.retries == 0
+
+
+def test_errors_reach_every_caller_in_the_group():
+    def run_batch(items):
+        raise ValueError("boom")
+
+    committer = group_commit.GroupCommitter(run_batch, window=0.2)
+    results, errors = submit_concurrently(committer, ["a", "b"])
+    assert not results
+    assert all(isinstance(e, ValueError) for e in errors.values())
+
+
+def test_each_caller_gets_its_own_batchref_or_out_of_stock():
+    uow = FakeUnitOfWork()
+    messagebus.handle(events.BatchCreated("batch1", "HOT-LAMP", 25, None), uow)
+    committer = group_commit.GroupCommitter(lambda batch: messagebus.handle_allocations(batch, uow), window=0.2)
+
+    lines = [events.AllocationRequired(f"o{i}", "HOT-LAMP", 10) for i in range(3)]
+    results, errors = submit_concurrently(committer, lines, sku="HOT-LAMP")
+
+    assert not errors
+    assert sorted(results.values(), key=str) == [None, "batch1", "batch1"]
+    assert uow.products.get("HOT-LAMP").batches[0].available_quantity == 5
@@ -1,57 +1,10 @@
-import abc
 from datetime import date
-from typing import List
 
-from src.allocation.adapters import repository
-from src.allocation.domain import events, model
-from src.allocation.service_layer import handler, messagebus, unit_of_work
+import pytest
 
-
-class FakeRepository(repository.AbstractRepository):
-    def __init__(self, products: List[model.Product]):
-        super().__init__()
-        self._products = set(products)
-
-    def _add(self, product):
-        self._products.add(product)
-
-    def _get(self, sku):
-        return next((p for p in self._products if p.sku == sku), None)
-
-    def _get_by_batchref(self, batchref) -> model.Product:
-        return next((p for p in self._products for b in p.batches if b.reference == batchref), None)
-
-
-class FakeSession(abc.ABC):
-    committed: bool = False
-
-    def commit(self) -> None:
-        self.committed = True
-
-
-class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
-    def __init__(self):
-        self.products = FakeRepository([])
-        # FakeUnitOfWorkとFakeRepositoryは、realのUnitOfWorkとRepositoryクラスと同じように、
-        # 密に結合している.
-        self.committed = False
-
-    def _commit(self):
-        self.committed = True
-
-    def rollback(self):
-        pass
-
-
-class FakeUnitOfWorkWithFakeMessageBus(FakeUnitOfWork):
-    def __init__(self):
-        super().__init__()
-        self.events_published: List[events.Event] = []
-
-    def publish_events(self):
-        for product in self.products.seen:
-            while product.events:
-                self.events_published.append(product.events.pop(0))
+from src.allocation.domain import events
+from src.allocation.service_layer import handler, messagebus
+from tests.unit.fakes import FakeUnitOfWork, FakeUnitOfWorkWithFakeMessageBus
 
 
 class TestAddBatch:
@@ -76,6 +29,17 @@ class TestAddBatch:
         )
         assert "b2" in [b.reference for b in uow.products.get("GARISH-RUG").batches]
 
+    def test_redelivered_batch_created_is_ignored(self) -> None:
+        uow = FakeUnitOfWork()
+        messagebus.handle(events.BatchCreated("b1", "GARISH-RUG", 100, None), uow)
+        messagebus.handle(events.AllocationRequired("o1", "GARISH-RUG", 10), uow)
+        uow.committed = False
+        messagebus.handle(events.BatchCreated("b1", "GARISH-RUG", 100, None), uow)
+
+        [batch] = uow.products.get("GARISH-RUG").batches
+        assert batch.available_quantity == 90
+        assert not uow.committed
+
 
 class TestAllocate:
     def test_returns_allocation(self) -> None:
@@ -111,6 +75,11 @@ class TestChangeBatchQuantity:
 
         assert batch.available_quantity == 50
 
+    def test_errors_for_unknown_batchref(self):
+        uow = FakeUnitOfWork()
+        with pytest.raises(handler.InvalidBatchref, match="Invalid batchref nonexistent"):
+            messagebus.handle(events.BatchQuantityChanged("nonexistent", 10), uow)
+
     def test_reallocates_if_necessary(self):
         uow = FakeUnitOfWork()
         event_history = [
@@ -154,10 +123,15 @@ def test_reallocates_if_necessary_isolated() -> None:
     assert batch1.available_quantity == 10
     assert batch2.available_quantity == 50
 
+    uow.events_published.clear()
     messagebus.handle(events.BatchQuantityChanged("batch1", 25), uow)
 
     # assert on new events emitted rather than downstream side-effects
-    [reallocation_event] = uow.events_published
-    assert isinstance(reallocation_event, events.AllocationRequired)
-    assert reallocation_event.orderid in {"order1", "order2"}
+    # (外されたラインはProduct内で再割り当てされるので、AllocationRequiredは発行されない)
+    [deallocation_event, reallocation_event] = uow.events_published
+    assert isinstance(deallocation_event, events.Deallocated)
+    assert deallocation_event.orderid in {"order1", "order2"}
+    assert isinstance(reallocation_event, events.Allocated)
+    assert reallocation_event.orderid == deallocation_event.orderid
     assert reallocation_event.sku == "INDIFFERENT-TABLE"
+    assert reallocation_event.batchref == "batch2"
@@ -0,0 +1,84 @@
+from sqlalchemy.orm import clear_mappers
+
+from src.allocation.adapters import idempotency
+from src.allocation.domain import events
+from src.allocation.domain.model import Batch, OrderLine, Product
+from src.allocation.entrypoints import flask_app
+from src.allocation.service_layer import messagebus
+from tests.unit.fakes import FakeUnitOfWork
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_key_depends_on_whole_line():
+    assert idempotency.key_for("o1", "LAMP", 1) == idempotency.key_for("o1", "LAMP", 1)
+    assert idempotency.key_for("o1", "LAMP", 1) != idempotency.key_for("o1", "LAMP", 2)
+    assert idempotency.key_for("o1", "LAMP", 1).startswith("o1:")
+
+
+def test_cache_expires_after_ttl():
+    clock = FakeClock()
+    cache = idempotency.IdempotencyCache(idempotency.InMemoryIdempotencyStore(), ttl=10, clock=clock)
+    cache.put("k", "batch1")
+    clock.now += 5
+    assert cache.get("k") == "batch1"
+    clock.now += 10
+    assert cache.get("k") is None
+
+
+def test_cache_is_bounded_but_falls_back_to_shared_store():
+    store = idempotency.InMemoryIdempotencyStore()
+    cache = idempotency.IdempotencyCache(store, maxsize=2)
+    for i in range(3):
+        cache.put(f"k{i}", f"batch{i}")
+    assert list(cache._local) == ["k1", "k2"]
+    assert cache.get("k0") == "batch0"
+
+    other_worker = idempotency.IdempotencyCache(store)
+    assert other_worker.get("k2") == "batch2"
+
+
+def test_too_long_idempotency_key_is_rejected():
+    client = flask_app.app.test_client()
+    try:
+        response = client.post(
+            "/allocate",
+            json={"orderid": "o1", "sku": "LAMP", "qty": 1},
+            headers={"Idempotency-Key": "k" * (idempotency.MAX_KEY_LENGTH + 1)},
+        )
+    finally:
+        clear_mappers()
+    assert response.status_code == 400
+
+
+def test_retry_returns_cached_batchref_without_touching_uow():
+    cache = idempotency.IdempotencyCache(idempotency.InMemoryIdempotencyStore())
+    uow = FakeUnitOfWork()
+    messagebus.handle(events.BatchCreated("batch1", "TALL-LAMP", 100, None), uow)
+    key = idempotency.key_for("o1", "TALL-LAMP", 10)
+
+    [first] = messagebus.handle(events.AllocationRequired("o1", "TALL-LAMP", 10), uow, key, cache)
+    uow.committed = False
+    [retry] = messagebus.handle(events.AllocationRequired("o1", "TALL-LAMP", 10), uow, key, cache)
+
+    assert first == retry == "batch1"
+    assert not uow.committed
+    assert uow.products.get("TALL-LAMP").batches[0].available_quantity == 90
+
+
+def test_allocating_same_line_twice_does_not_double_allocate():
+    line = OrderLine("o1", "SHORT-LAMP", 10)
+    small = Batch("small", "SHORT-LAMP", 15, eta=None)
+    big = Batch("big", "SHORT-LAMP", 100, eta=None)
+    product = Product("SHORT-LAMP", [small, big])
+
+    assert product.allocate(line) == "small"
+    assert product.allocate(line) == "small"
+    assert big.available_quantity == 100
+    assert product.version_number == 1
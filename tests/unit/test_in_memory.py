@@ -0,0 +1,90 @@
+import pytest
+
+from src.allocation.adapters.event_store import ConcurrencyError
+from src.allocation.adapters.repository import InMemoryStore
+from src.allocation.domain import events
+from src.allocation.domain.model import Batch, OrderLine, Product
+from src.allocation.service_layer import messagebus, unit_of_work
+
+
+def make_uow() -> unit_of_work.InMemoryUnitOfWork:
+    return unit_of_work.InMemoryUnitOfWork(InMemoryStore([Product("LAMP", [Batch("b1", "LAMP", 10, None)])]))
+
+
+def available(uow: unit_of_work.InMemoryUnitOfWork, sku: str) -> int:
+    with uow:
+        return sum(b.available_quantity for b in uow.products.get(sku).batches)
+
+
+def test_finds_products_by_sku_and_batchref():
+    uow = make_uow()
+    with uow:
+        product = uow.products.get("LAMP")
+        assert uow.products.get_by_batchref("b1") is product
+        product.batches.append(Batch("b2", "LAMP", 5, None))
+        assert uow.products.get_by_batchref("b2") is product  # commit前に追加されたbatch
+        uow.commit()
+    with uow:
+        assert uow.products.get_by_batchref("b2").sku == "LAMP"
+        assert uow.products.get("NO-SUCH-SKU") is None
+
+
+def test_uncommitted_changes_are_discarded():
+    uow = make_uow()
+    with uow:
+        uow.products.get("LAMP").allocate(OrderLine("o1", "LAMP", 4))
+    assert available(uow, "LAMP") == 10
+
+    with uow:
+        uow.products.get("LAMP").allocate(OrderLine("o1", "LAMP", 4))
+        uow.commit()
+    assert available(uow, "LAMP") == 6
+
+
+def test_concurrent_commits_to_the_same_product_conflict():
+    first = make_uow()
+    second = unit_of_work.InMemoryUnitOfWork(first.store)
+    with first, second:
+        first.products.get("LAMP").allocate(OrderLine("o1", "LAMP", 4))
+        second.products.get("LAMP").allocate(OrderLine("o2", "LAMP", 4))
+        first.commit()
+        with pytest.raises(ConcurrencyError):
+            second.commit()
+    assert available(first, "LAMP") == 6
+
+
+def test_runs_the_messagebus_flow():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    messagebus.handle(events.BatchCreated("b1", "TABLE", 10, None), uow)
+    messagebus.handle(events.BatchCreated("b2", "TABLE", 10, None), uow)
+    [batchref] = messagebus.handle(events.AllocationRequired("o1", "TABLE", 8), uow)
+    assert batchref == "b1"
+
+    messagebus.handle(events.BatchQuantityChanged("b1", 5), uow)
+    with uow:
+        [b1, b2] = uow.products.get("TABLE").batches
+        assert (b1.available_quantity, b2.available_quantity) == (5, 2)
+
+
+def test_products_that_were_only_read_are_not_written_back():
+    store = InMemoryStore(
+        [Product("LAMP", [Batch("b1", "LAMP", 10, None)]), Product("TABLE", [Batch("b2", "TABLE", 10, None)])]
+    )
+    first = unit_of_work.InMemoryUnitOfWork(store)
+    second = unit_of_work.InMemoryUnitOfWork(first.store)
+    with first, second:
+        assert first.products.get("LAMP").batches[0].available_quantity == 10
+        first.products.get("TABLE").allocate(OrderLine("o1", "TABLE", 2))
+        second.products.get("LAMP").allocate(OrderLine("o2", "LAMP", 4))
+        second.commit()
+        first.commit()  # LAMPは読んだだけなので、secondの変更を上書きしないし衝突もしない.
+    assert available(first, "LAMP") == 6
+    assert available(first, "TABLE") == 8
+
+
+def test_changing_a_batch_quantity_is_written_back():
+    uow = make_uow()
+    with uow:
+        uow.products.get("LAMP").change_batch_quantity("b1", 20)
+        uow.commit()
+    assert available(uow, "LAMP") == 20
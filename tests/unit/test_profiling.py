@@ -0,0 +1,97 @@
+# pylint: disable=redefined-outer-name
+import itertools
+import json
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from src.allocation.adapters.orm import metadata, start_mappers
+from src.allocation.domain import events
+from src.allocation.service_layer import messagebus, profiling, unit_of_work
+from tests.unit.fakes import FakeUnitOfWork
+
+
+@pytest.fixture
+def profiler():
+    ticks = itertools.count()
+    yield profiling.enable(profiling.Profiler(slowest_n=2, sample_interval=3600, clock=lambda: next(ticks) / 1000))
+    profiling.disable()
+
+
+def names(span):
+    return [span.name, [names(child) for child in span.children]]
+
+
+def test_is_a_no_op_while_disabled():
+    assert profiling.current() is None
+    assert profiling.trace("request") is profiling.span("handler")
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), FakeUnitOfWork())
+
+
+def test_records_handlers_as_spans_of_the_bus_dispatch(profiler):
+    uow = FakeUnitOfWork()
+    messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+
+    [trace] = profiler.slowest()
+    assert names(trace.root) == [
+        "messagebus.handle BatchCreated",
+        [
+            ["add_batch BatchCreated", []],
+            ["update_availability BatchCreated", []],
+            ["invalidate_availability_cache BatchCreated", []],
+        ],
+    ]
+
+
+def test_keeps_only_the_slowest_traces(profiler):
+    for name, n_spans in [("fast", 0), ("slow", 5), ("medium", 2)]:
+        with profiling.trace(name):
+            for _ in range(n_spans):
+                with profiling.span("step"):
+                    pass
+    assert [t.name for t in profiler.slowest()] == ["slow", "medium"]
+    assert [t["name"] for t in json.loads(profiler.dump(n=1))] == ["slow"]
+    # 1回の時刻の読み出し毎に1ms進む時計なので、spanは1ms、親は入れ子の分だけ長くなる.
+    assert profiler.flamegraph(samples=False).splitlines()[:2] == ["medium 3000", "medium;step 2000"]
+
+
+def test_samples_the_stack_of_the_traced_thread(profiler):
+    with profiling.trace("request"):
+        profiler.sample_once()
+    [line] = profiler.flamegraph().splitlines()
+    assert line.startswith("request;")
+    assert "test_samples_the_stack_of_the_traced_thread (test_profiling.py:" in line
+    assert line.endswith(" 1")
+
+
+def test_nested_traces_of_a_sampled_out_request_are_not_recorded():
+    rolls = iter([0.9, 0.1])  # 外側のリクエストは対象外. 入れ子で引き直せば対象になってしまう値.
+    profiler = profiling.enable(profiling.Profiler(sample_rate=0.5, sample_interval=3600, rng=lambda: next(rolls)))
+    try:
+        with profiling.trace("request"):
+            messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), FakeUnitOfWork())
+            assert profiling.span("handler") is profiling.span("sql")
+        assert profiler.slowest() == []
+        with profiling.trace("next request"):
+            pass
+        assert [t.name for t in profiler.slowest()] == ["next request"]
+    finally:
+        profiling.disable()
+
+
+def test_sql_runs_inside_handler_and_commit_spans(profiler):
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    start_mappers()
+    try:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+        messagebus.handle(events.BatchCreated("b1", "LAMP", 10, None), uow)
+    finally:
+        clear_mappers()
+
+    [trace] = profiler.slowest()
+    add_batch = trace.root.children[0]
+    assert add_batch.children[0].name.startswith("sql: SELECT")
+    [commit] = [s for s in add_batch.children if s.name == "uow.commit"]
+    assert any(s.name.startswith("sql: INSERT INTO batches") for s in commit.children)
@@ -0,0 +1,70 @@
+import random
+from datetime import date
+from itertools import combinations
+
+from src.allocation.domain import events
+from src.allocation.domain.model import Batch, OrderLine, Product, select_lines_to_evict
+
+
+def lines(*qtys):
+    return [OrderLine(f"o{i}", "SKU", q) for i, q in enumerate(qtys)]
+
+
+def test_evicts_a_single_line_when_one_is_enough():
+    chosen = select_lines_to_evict(lines(1, 2, 3, 10), shortfall=4)
+    assert [l.qty for l in chosen] == [10]
+
+
+def test_picks_smallest_line_that_still_covers_shortfall():
+    chosen = select_lines_to_evict(lines(1, 5, 7, 10), shortfall=6)
+    assert [l.qty for l in chosen] == [7]
+
+
+def test_evicts_fewest_lines_with_least_over_eviction():
+    chosen = select_lines_to_evict(lines(1, 1, 4, 6, 9), shortfall=10)
+    assert len(chosen) == 2
+    assert sum(l.qty for l in chosen) == 10
+
+
+def test_finds_the_least_over_eviction_where_greedy_does_not():
+    chosen = select_lines_to_evict(lines(3, 15, 11, 9, 1, 10, 7), shortfall=17)
+    assert sorted(l.qty for l in chosen) == [7, 10]
+
+
+def test_matches_exhaustive_search_on_small_inputs():
+    rng = random.Random(0)
+    for _ in range(500):
+        qtys = [rng.randint(1, 20) for _ in range(rng.randint(1, 8))]
+        shortfall = rng.randint(1, sum(qtys))
+        chosen = select_lines_to_evict(lines(*qtys), shortfall)
+        k = next(k for k in range(1, len(qtys) + 1) if sum(sorted(qtys)[-k:]) >= shortfall)
+        best = min(sum(c) for c in combinations(qtys, k) if sum(c) >= shortfall)
+        assert (len(chosen), sum(l.qty for l in chosen)) == (k, best)
+
+
+def test_change_batch_quantity_reallocates_within_the_aggregate():
+    batch1 = Batch("batch1", "SKU", 30, eta=None)
+    batch2 = Batch("batch2", "SKU", 30, eta=date.today())
+    product = Product("SKU", [batch1, batch2])
+    for line in lines(2, 2, 2, 2, 12):
+        product.allocate(line)
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 15)
+
+    assert [type(e) for e in product.events] == [events.Deallocated, events.Allocated]
+    assert product.events[0].qty == 12
+    assert batch1.available_quantity == 7
+    assert batch2.available_quantity == 18
+
+
+def test_lines_that_cannot_be_reallocated_are_out_of_stock():
+    batch = Batch("batch1", "SKU", 10, eta=None)
+    product = Product("SKU", [batch])
+    product.allocate(OrderLine("o1", "SKU", 8))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 5)
+
+    assert [type(e) for e in product.events] == [events.Deallocated, events.OutOfStock]
+    assert batch.available_quantity == 5
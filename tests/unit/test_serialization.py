@@ -0,0 +1,56 @@
+from datetime import date
+
+import pytest
+
+from src.allocation.adapters import serialization
+from src.allocation.domain import events
+
+EXAMPLES = [
+    events.BatchCreated("b1", "SQUEAKY-CHAIR", 100, date(2021, 1, 2)),
+    events.BatchCreated("b2", "SQUEAKY-CHAIR", 50),
+    events.AllocationRequired("o1", "SQUEAKY-CHAIR", 10),
+    events.SplitAllocationRequired("o1", "SQUEAKY-CHAIR", 10),
+    events.BatchQuantityChanged("b1", 5),
+    events.OutOfStock("椅子"),
+    events.Allocated("o1", "SQUEAKY-CHAIR", 10, "b1"),
+    events.Deallocated("o1", "SQUEAKY-CHAIR", 10, "b1"),
+    events.BatchArrived("b1", "SQUEAKY-CHAIR", date(2021, 1, 2)),
+]
+
+
+def test_every_event_has_a_type_tag():
+    registered = {cls for cls, _ in serialization.REGISTRY.values()}
+    assert set(events.Event.__subclasses__()) == registered
+
+
+@pytest.mark.parametrize("event", EXAMPLES, ids=lambda e: type(e).__name__)
+def test_round_trips_through_binary_and_json(event):
+    assert serialization.decode(serialization.encode(event)) == event
+    assert serialization.from_json(serialization.to_json(event)) == event
+
+
+def test_decodes_a_stream_from_a_memoryview():
+    data = bytearray(serialization.encode_many(EXAMPLES))
+    assert list(serialization.iter_decode(memoryview(data))) == EXAMPLES
+
+
+def test_binary_is_smaller_than_json():
+    for event in EXAMPLES:
+        assert len(serialization.encode(event)) < len(serialization.to_json(event).encode())
+
+
+def test_rejects_unknown_versions():
+    data = bytearray(serialization.encode(EXAMPLES[0]))
+    data[1] = 99  # このプロセスより新しいschemaで書かれたデータ
+    with pytest.raises(serialization.UnknownSchemaError):
+        serialization.decode(data)
+
+
+def test_upcasts_legacy_versions(monkeypatch):
+    # BatchQuantityChanged の version 2 で、数量が文字列から整数に変わった場合を想定する.
+    monkeypatch.setitem(serialization.REGISTRY, 3, (events.BatchQuantityChanged, 2))
+    monkeypatch.setattr(serialization, "_LAYOUTS", dict(serialization._LAYOUTS))
+    serialization.register_legacy_schema(3, 1, ["ref", "qty"], "ss", lambda d: {**d, "qty": int(d["qty"])})
+
+    legacy = serialization.HEADER.pack(3, 1, 8) + b"\x02\x00\x02\x00b142"
+    assert serialization.decode(legacy) == events.BatchQuantityChanged("b1", 42)
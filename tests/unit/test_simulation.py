@@ -0,0 +1,79 @@
+from datetime import date, timedelta
+
+from src.allocation.adapters.event_store import EventStore
+from src.allocation.domain import events
+from src.allocation.service_layer import messagebus, simulation, unit_of_work
+
+today = date.today()
+next_week = today + timedelta(days=7)
+
+HISTORY = [
+    events.BatchCreated("warehouse", "FANCY-CLOCK", 10, None),
+    events.BatchCreated("shipment", "FANCY-CLOCK", 30, next_week),
+    events.AllocationRequired("o1", "FANCY-CLOCK", 10),
+    events.AllocationRequired("o2", "FANCY-CLOCK", 20),
+    events.AllocationRequired("o3", "FANCY-CLOCK", 20),
+    events.BatchCreated("other", "PLAIN-CLOCK", 5, None),
+    events.AllocationRequired("o4", "PLAIN-CLOCK", 5),
+    events.BatchQuantityChanged("warehouse", 0),
+]
+
+
+def test_reports_fill_rate_out_of_stock_and_reallocations():
+    report = simulation.simulate(HISTORY)
+    assert report.events_replayed == len(HISTORY)
+    assert report.lines_requested == 4
+    assert report.qty_requested == 55
+    # o3はout of stock, o1は倉庫から外されて出荷分に再割り当てされる.
+    assert report.out_of_stock == 1
+    assert report.reallocations == 1
+    assert report.qty_allocated == 35
+    assert report.fill_rate == 35 / 55
+
+
+def test_what_if_earlier_shipment_changes_reallocations():
+    history = [
+        events.BatchCreated("early", "ODD-VASE", 20, today),
+        events.BatchCreated("shipment", "ODD-VASE", 20, next_week),
+        events.AllocationRequired("o1", "ODD-VASE", 15),
+        events.AllocationRequired("o2", "ODD-VASE", 5),
+        events.BatchQuantityChanged("shipment", 0),
+    ]
+    as_recorded = simulation.simulate(history)
+    what_if = simulation.simulate(history, transforms=[simulation.with_eta("shipment", today - timedelta(days=1))])
+
+    assert as_recorded.reallocations == 0
+    assert what_if.reallocations == 2
+    assert as_recorded.fill_rate == what_if.fill_rate == 1.0
+
+
+def test_partitioned_replay_matches_single_process():
+    assert simulation.simulate(HISTORY, processes=2) == simulation.simulate(HISTORY)
+
+
+def test_event_log_round_trip(tmp_path):
+    path = tmp_path / "events.log"
+    simulation.write_event_log(path, HISTORY)
+    assert simulation.read_event_log(path) == HISTORY
+
+
+def test_unknown_batchrefs_are_counted_and_skipped():
+    history = HISTORY + [events.BatchQuantityChanged("never-created", 5)]
+    report = simulation.simulate(history)
+    assert report.unknown_batchrefs == 1
+    assert report.qty_allocated == simulation.simulate(HISTORY).qty_allocated
+    assert simulation.simulate(history, processes=2) == report
+
+
+def test_replays_a_stream_written_by_the_event_store(tmp_path):
+    uow = unit_of_work.EventStoreUnitOfWork(EventStore(tmp_path))
+    for event in HISTORY[:5] + HISTORY[7:]:  # FANCY-CLOCKのeventだけ
+        messagebus.handle(event, uow)
+
+    report = simulation.simulate(simulation.read_event_log(tmp_path / "FANCY-CLOCK.events"))
+
+    assert report.lines_requested == 3
+    assert report.qty_requested == 50
+    assert report.out_of_stock == 1
+    assert report.reallocations == 1
+    assert report.qty_allocated == 30
@@ -0,0 +1,69 @@
+from datetime import date, timedelta
+
+from src.allocation.domain import events
+from src.allocation.domain.model import Batch, OrderLine, Product
+from src.allocation.service_layer import messagebus
+from tests.unit.fakes import FakeUnitOfWork
+
+today = date.today()
+
+
+def make_product():
+    return Product(
+        "LAMP",
+        [
+            Batch("shipment", "LAMP", 6, today + timedelta(days=1)),
+            Batch("in-stock", "LAMP", 4, None),
+            Batch("later", "LAMP", 5, today + timedelta(days=5)),
+        ],
+    )
+
+
+def test_fills_a_line_from_batches_in_priority_order():
+    product = make_product()
+    assert product.allocate_split(OrderLine("o1", "LAMP", 12)) == [("in-stock", 4), ("shipment", 6), ("later", 2)]
+    assert [b.available_quantity for b in product.batches] == [0, 0, 3]
+    assert [e.batchref for e in product.events] == ["in-stock", "shipment", "later"]
+    assert product.version_number == 1
+
+
+def test_does_not_split_when_a_single_batch_fits():
+    product = make_product()
+    assert product.allocate_split(OrderLine("o1", "LAMP", 5)) == [("shipment", 5)]
+
+
+def test_skips_exhausted_batches_and_reports_out_of_stock_only_when_the_total_is_short():
+    product = make_product()
+    product.allocate(OrderLine("o0", "LAMP", 4))
+    assert product.allocate_split(OrderLine("o1", "LAMP", 10)) == [("shipment", 6), ("later", 4)]
+
+    assert product.allocate_split(OrderLine("o2", "LAMP", 17)) is None
+    assert isinstance(product.events[-1], events.OutOfStock)
+
+
+def test_retrying_a_split_line_returns_the_same_allocation():
+    product = make_product()
+    first = product.allocate_split(OrderLine("o1", "LAMP", 12))
+    assert product.allocate_split(OrderLine("o1", "LAMP", 12)) == first
+    assert sum(b.available_quantity for b in product.batches) == 3
+
+
+def test_split_allocation_through_the_messagebus():
+    uow = FakeUnitOfWork()
+    messagebus.handle(events.BatchCreated("b1", "TABLE", 3, None), uow)
+    messagebus.handle(events.BatchCreated("b2", "TABLE", 3, today), uow)
+    [allocations] = messagebus.handle(events.SplitAllocationRequired("o1", "TABLE", 5), uow)
+    assert allocations == [("b1", 3), ("b2", 2)]
+    assert uow.committed
+
+
+def test_reallocating_an_evicted_piece_does_not_match_its_sibling():
+    product = Product("LAMP", [Batch("A", "LAMP", 5, None), Batch("B", "LAMP", 5, None)])
+    assert product.allocate_split(OrderLine("o1", "LAMP", 10)) == [("A", 5), ("B", 5)]
+    product.batches.append(Batch("C", "LAMP", 100, None))
+
+    product.change_batch_quantity("A", 0)
+
+    allocated = {b.reference: b.allocated_quantity for b in product.batches}
+    assert allocated == {"A": 0, "B": 5, "C": 5}
+    assert isinstance(product.events[-1], events.Allocated)